@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+An asyncio interface for the FOSCAM IP cameras.
+AsyncFoscamControl mirrors control.FoscamControl but every call is a coroutine, so a single event loop can drive many
+cameras at once without a thread per camera. Argument validation, the lookup tables and the response parser are shared
+with the blocking driver in the control module.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import time
+import asyncio
+from getpass import getpass
+from http.client import HTTPMessage
+from urllib.error import HTTPError
+from urllib.parse import urlsplit, urlencode
+from mjpeg import MJPEGParser, Frame
+from limiter import for_host, NORMAL
+from control import LANES, REQUEST_ERRORS, request_metrics, RECORDS, Record, parse_vars, snapshot_args, videostream_args, control_args, preset_args, camera_control_args, ftp_args
+
+# Errors which on a reused connection most likely mean the camera closed it while it sat idle in the pool
+STALE_ERRORS = (asyncio.IncompleteReadError, ConnectionError, EOFError)
+
+async def _read_head(reader):
+    """Read an HTTP response status line and headers.
+    @return (status, reason, headers, will_close)"""
+    line = await reader.readline()
+    if not line: raise EOFError('Connection closed before response')
+    version, status, reason = (line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+    headers = HTTPMessage()
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''): break
+        k, v = line.decode('latin-1').split(':', 1)
+        headers[k.strip()] = v.strip()
+    connection = headers.get('Connection', '').lower()
+    will_close = connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive')
+    return int(status), reason, headers, will_close
+
+async def _read_body(reader, headers):
+    "Read a response body which is either chunked, has a Content-Length or ends when the connection closes"
+    if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';', 1)[0], 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''): pass # Trailers
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+    elif 'Content-Length' in headers:
+        return await reader.readexactly(int(headers['Content-Length']))
+    else:
+        return await reader.read()
+
+
+class AsyncStream(object):
+    """A streaming response such as a video stream or the camera log.
+    Read it with read() or iterate over it with async for, close it when done."""
+
+    def __init__(self, reader, writer, headers):
+        self.reader = reader
+        self.writer = writer
+        self.headers = headers
+
+    async def read(self, n=-1):
+        "Read up to n bytes, or everything until the camera closes the connection if n is -1"
+        return await self.reader.read(n)
+
+    def close(self):
+        self.writer.close()
+
+    async def frames(self, chunk=65536):
+        """Generate mjpeg.Frames from an MJPEG video stream.
+        Each frame's data is a memoryview only valid until the next frame is requested."""
+        parser = MJPEGParser()
+        while True:
+            frame = parser.next_frame()
+            if frame is not None:
+                yield Frame(time.time(), frame)
+                continue
+            data = await self.reader.read(chunk)
+            if not data: return
+            parser.feed(data)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.reader.read(65536)
+        if not chunk: raise StopAsyncIteration
+        return chunk
+
+
+class AsyncConnectionPool(object):
+    """
+    The asyncio version of connection.ConnectionPool, keeps keep-alive connections to a single host for reuse.
+    It must only be used from one event loop.
+    """
+
+    def __init__(self, url, maxsize=4, idle_timeout=30.0, timeout=10.0, retries=1):
+        """Set up an empty pool
+        @param url Base URL of the camera, e.g. http://192.168.1.10:8080
+        @param maxsize Maximum number of idle connections to keep open
+        @param idle_timeout Seconds after which an idle connection is discarded instead of reused
+        @param timeout Default timeout in seconds for each request
+        @param retries How many times to retry a request which failed on a stale reused connection
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'): raise ValueError('Unsupported URL scheme "%s"' % parts.scheme)
+        self.url = url
+        self.host = parts.hostname
+        self.ssl = parts.scheme == 'https'
+        self.port = parts.port or (443 if self.ssl else 80)
+        self.hostHeader = parts.netloc.rsplit('@', 1)[-1]
+        self.prefix = parts.path.rstrip('/')
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.idle = []
+
+    def __len__(self):
+        "Number of idle connections"
+        return len(self.idle)
+
+    def close(self):
+        "Close all idle connections."
+        idle, self.idle = self.idle, []
+        for reader, writer, lastUsed in idle:
+            writer.close()
+
+    async def _get(self):
+        """Fetch an idle connection from the pool or open a new one.
+        @return (reader, writer, reused)"""
+        now = time.time()
+        while self.idle:
+            reader, writer, lastUsed = self.idle.pop()
+            if now - lastUsed > self.idle_timeout or reader.at_eof():
+                writer.close()
+            else:
+                return reader, writer, True
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+        return reader, writer, False
+
+    def _put(self, reader, writer):
+        "Return a connection to the pool or close it if the pool is full"
+        if len(self.idle) < self.maxsize:
+            self.idle.append((reader, writer, time.time()))
+        else:
+            writer.close()
+
+    async def _send(self, path):
+        """Send a GET request, retrying on a fresh connection if a reused one turns out to be stale.
+        @return (reader, writer, status, reason, headers, will_close)"""
+        attempt = 0
+        while True:
+            reader, writer, reused = await self._get()
+            try:
+                writer.write(('GET %s HTTP/1.1\r\nHost: %s\r\nAccept-Encoding: identity\r\n\r\n' % (self.prefix + path, self.hostHeader)).encode('latin-1'))
+                await writer.drain()
+                return (reader, writer) + (await _read_head(reader))
+            except STALE_ERRORS:
+                writer.close()
+                if not reused or attempt >= self.retries: raise
+                attempt += 1
+            except BaseException: # Including being cancelled by wait_for timing out
+                writer.close()
+                raise
+
+    async def _request(self, path):
+        reader, writer, status, reason, headers, will_close = await self._send(path)
+        try:
+            body = await _read_body(reader, headers)
+        except BaseException:
+            writer.close()
+            raise
+        if status != 200:
+            writer.close()
+            raise HTTPError(path, status, reason, headers, None)
+        if will_close:
+            writer.close()
+        else:
+            self._put(reader, writer)
+        return body
+
+    async def request(self, path, timeout=None):
+        """Make a GET request and return the response body.
+        @param path Path and query string relative to the pool's URL
+        @param timeout Timeout for this request, None for the pool default
+        """
+        return await asyncio.wait_for(self._request(path), self.timeout if timeout is None else timeout)
+
+    async def open(self, path, timeout=None):
+        """Make a GET request and return an AsyncStream of the response body.
+        The connection is not returned to the pool, it is closed when the caller closes the stream."""
+        reader, writer, status, reason, headers, will_close = await asyncio.wait_for(self._send(path), self.timeout if timeout is None else timeout)
+        if status != 200:
+            writer.close()
+            raise HTTPError(path, status, reason, headers, None)
+        return AsyncStream(reader, writer, headers)
+
+
+class AsyncFoscamControl(object):
+    "The asyncio counterpart of control.FoscamControl, every camera call is a coroutine"
+
+    def __init__(self, url, user, password, defaultPreset=1, pool_size=4, idle_timeout=30.0, timeout=10.0, retries=1, name=None, limiter=None, breaker=None):
+        """Set up the camera driver
+        @param url Base URL of the camera, e.g. http://192.168.1.10:8080
+        @param user Camera user name
+        @param password Camera password, None to prompt for it
+        @param defaultPreset Preset the camera returns to when idle
+        @param pool_size Number of keep-alive connections to hold open to the camera
+        @param idle_timeout Seconds an unused connection is kept before it is discarded
+        @param timeout Timeout in seconds for each request
+        @param retries Number of times to retry a request which failed on a stale kept-alive connection
+        @param name Name of the camera in metrics, None for its URL
+        @param limiter limiter.HostLimiter to pace CGI requests with, None for the one shared by all users of the
+               camera's host or False for no limit. Video and log streams are not limited.
+        @param breaker health.CircuitBreaker to fail requests fast with while the camera is unreachable, None for none
+        """
+        self.url  = url
+        self.name = url if name is None else name
+        if password is None: password = getpass('Password for %s@%s>' % (user, url))
+        self.auth = {'user': user, 'pwd': password}
+        self.defaultPreset = defaultPreset
+        self.preset = None     # Last preset commanded, None if unknown or moved since
+        self.presetTime = 0.0  # When the last preset was commanded
+        self.pool = AsyncConnectionPool(url, pool_size, idle_timeout, timeout, retries)
+        self.limiter = for_host(url) if limiter is None else (None if limiter is False else limiter)
+        self.breaker = breaker
+        self.metric_children = {} # See control.request_metrics
+
+    def _query(self, cgi, args=None):
+        "Build the request path for a CGI call with authentication"
+        query = dict(args) if args else {}
+        query.update(self.auth)
+        return '/%s?%s' % (cgi, urlencode(query))
+
+    async def _read_raw(self, cgi, args=None, timeout=None):
+        return await self._request(cgi, self._query(cgi, args), timeout)
+
+    async def _request(self, cgi, path, timeout=None):
+        """Make a request once the limiter lets it start, recording its latency and response size or why it failed in
+        the metrics and the circuit breaker"""
+        breaker = self.breaker
+        if breaker is not None: breaker.before()
+        try:
+            if self.limiter is not None: await self.limiter.aacquire(LANES.get(cgi, NORMAL))
+        except BaseException:
+            if breaker is not None: breaker.abandon()
+            raise
+        start = time.time()
+        try:
+            body = await self.pool.request(path, timeout)
+        except asyncio.TimeoutError:
+            REQUEST_ERRORS.labels(self.name, cgi, 'timeout').inc()
+            if breaker is not None: breaker.failure(time.time() - start)
+            raise
+        except Exception as e:
+            answered = isinstance(e, HTTPError)
+            REQUEST_ERRORS.labels(self.name, cgi, 'http' if answered else 'connection').inc()
+            if breaker is not None:
+                if answered:
+                    breaker.success()
+                else:
+                    breaker.failure(time.time() - start)
+            raise
+        except BaseException: # Cancelled, whether the camera would have answered isn't known
+            if breaker is not None: breaker.abandon()
+            raise
+        finally:
+            if self.limiter is not None: self.limiter.release()
+        if breaker is not None: breaker.success()
+        name, seconds, size = request_metrics(self.metric_children, self.name, cgi)
+        seconds.observe(time.time() - start)
+        size.inc(len(body))
+        return body
+
+    async def _read_and_parse(self, cgi, args=None, timeout=None):
+        return parse_vars(await self._read_raw(cgi, args, timeout), RECORDS.get(cgi, Record))
+
+    async def snapshot(self, resolution='VGA'):
+        "Gets a still image (jpeg)"
+        return await self._read_raw('snapshot.cgi', snapshot_args(resolution))
+
+    async def videostream(self, resolution='VGA', rate='full', format='mjpeg'):
+        "Start a video stream and return an AsyncStream which can be iterated over with async for"
+        cgi, args = videostream_args(resolution, rate, format)
+        return await self.pool.open(self._query(cgi, args))
+
+    async def get_status(self, timeout=None):
+        """Obtain device status
+        @param timeout Timeout for the request, None for the driver's"""
+        return await self._read_and_parse('get_status.cgi', timeout=timeout)
+
+    async def get_camera_params(self):
+        "Obtain current camera parameters"
+        return await self._read_and_parse('get_camera_params.cgi')
+
+    async def control(self, command, onestep=None, degree=None):
+        "Control's FOSCAM's motion hardware"
+        self.preset = None
+        return await self._read_and_parse('decoder_control.cgi', control_args(command, onestep, degree))
+
+    async def pan(self, degrees):
+        "Command a horizontal movement, positive is right, negative is left"
+        if degrees > 0.0:
+            return await self.control('RIGHT', degree=degrees)
+        else:
+            return await self.control('LEFT', degree=-degrees)
+
+    async def tilt(self, degrees):
+        "Command vertical movement, positive is down, negative is up"
+        if degrees > 0.0:
+            return await self.control('DOWN', degree=degrees)
+        else:
+            return await self.control('UP', degree=-degrees)
+
+    async def goto_preset(self, preset):
+        "Go to numbered preset pan and tilt position"
+        self.preset = None
+        await self._read_raw('decoder_control.cgi', preset_args(preset))
+        self.preset = preset
+        self.presetTime = time.time()
+
+    async def set_preset(self, preset):
+        "Save the current pan and tilt position of the camera as a numbered preset"
+        await self._read_raw('decoder_control.cgi', preset_args(preset, save=True))
+
+    async def camera_control(self, resolution=None, brightness=None, contrast=None, mode=None, patrol=None):
+        "Set a parameter for the camera sensor. Only one of: resolution, brightness, contrast, mode or patrol may be not None."
+        return await self._read_and_parse('camera_control.cgi', camera_control_args(resolution, brightness, contrast, mode, patrol))
+
+    async def reboot(self):
+        "Reboot the remote camera"
+        self.preset = None
+        await self._read_raw('reboot.cgi')
+        self.pool.close()
+
+    async def get_params(self):
+        "Obtain device settings"
+        return await self._read_and_parse('get_params.cgi')
+
+    async def set_ftp(self, server, user, password, directory, port=21, retain=False, interval=0):
+        "Configure FTP upload settings"
+        await self._request('set_ftp.cgi', '/set_ftp.cgi?' + urlencode(ftp_args(self.auth, server, user, password, directory, port, retain, interval)))
+
+    async def get_misc(self):
+        "Get camera misc parameter settings"
+        return await self._read_and_parse('get_misc.cgi')
+
+    async def set_misc(self, **args):
+        "Set camera misc parameters"
+        await self._read_raw('set_misc.cgi', args)
+
+    async def open_log(self):
+        "Open an AsyncStream of the camera log, caller must read and close"
+        return await self.pool.open(self._query('get_log.cgi'))
+
+    async def get_log(self, timeout=None):
+        "Download the camera log, the raw get_log.cgi response"
+        return await self._read_raw('get_log.cgi', timeout=timeout)
+
+    def close(self):
+        "Close the idle connections to the camera"
+        self.pool.close()
@@ -0,0 +1,1076 @@
+#!/usr/bin/env python3
+"""
+Performance benchmarks for the driver and schedulers.
+Run all benchmarks with `python benchmark.py` or name the ones to run, e.g. `python benchmark.py mjpeg`. Everything
+runs against the local camera emulator, no hardware is needed. Save the results with --json and compare a later run
+against them with --compare to catch regressions.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import io
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+from collections import OrderedDict
+
+BENCHMARKS = OrderedDict()
+
+def benchmark(name):
+    "Decorator registering a benchmark function, which returns a dictionary of results"
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return register
+
+def rate(fn, count):
+    "Call fn() and return how many of count operations it completed per second"
+    start = time.perf_counter()
+    fn()
+    return count / (time.perf_counter() - start)
+
+def percentile(samples, fraction):
+    "The sample fraction of the way through the sorted samples"
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+def summary(latencies, elapsed, peak=None):
+    "Summarise a run of operations as operations per second, median and 99th percentile latency in ms and peak KiB"
+    results = OrderedDict([
+        ('per_s', len(latencies) / elapsed),
+        ('p50_ms', percentile(latencies, 0.5) * 1000.0),
+        ('p99_ms', percentile(latencies, 0.99) * 1000.0),
+    ])
+    if peak is not None: results['peak_kib'] = peak / 1024.0
+    return results
+
+def load(fn, count, threads=1, traced=100):
+    """Call fn() count times spread over threads, then traced more times with tracemalloc on to find its memory use.
+    Memory is measured in a separate pass as tracing slows everything down.
+    @return summary of the run"""
+    latencies = []
+    def worker(n):
+        for i in range(n):
+            start = time.perf_counter()
+            fn()
+            latencies.append(time.perf_counter() - start)
+    workers = [threading.Thread(target=worker, args=(count // threads + (i < count % threads),)) for i in range(threads)]
+    start = time.perf_counter()
+    for w in workers: w.start()
+    for w in workers: w.join()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        worker(traced)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    del latencies[count:]
+    return summary(latencies, elapsed, peak)
+
+def rss():
+    "Resident memory of the process in bytes, which unlike tracemalloc counts thread stacks, None without /proc"
+    try:
+        with open('/proc/self/statm') as f: return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def prefixed(prefix, results):
+    "Prefix the names of a dictionary of results"
+    return OrderedDict((prefix + '_' + k, v) for k, v in results.items())
+
+def recorded_stream(count=1000, size=30000):
+    "A stand in for a recorded camera stream: count multipart MJPEG parts of about size bytes each"
+    from emulator import fake_jpeg, mjpeg_part
+    return b''.join(mjpeg_part(fake_jpeg(n, size + n % 64)) for n in range(count))
+
+def naive_frames(stream, chunk=65536):
+    "The copy per chunk parser consumers of FoscamControl.videostream used to write, kept as a baseline"
+    from mjpeg import SOI, EOI
+    data = b''
+    while True:
+        soi = data.find(SOI)
+        eoi = data.find(EOI, soi + 2) if soi >= 0 else -1
+        if eoi >= 0:
+            yield data[soi:eoi + 2]
+            data = data[eoi + 2:]
+            continue
+        chunk_data = stream.read(chunk)
+        if not chunk_data: return
+        data += chunk_data
+
+@benchmark('mjpeg')
+def bench_mjpeg(count=1000):
+    "Frames per second extracted from a recorded MJPEG stream"
+    import mjpeg
+    stream = recorded_stream(count)
+    def run(parse):
+        n = 0
+        for frame in parse(io.BytesIO(stream)): n += 1
+        assert n == count
+    return OrderedDict([
+        ('stream_bytes', len(stream)),
+        ('naive_frames_per_s', rate(lambda: run(naive_frames), count)),
+        ('frames_per_s', rate(lambda: run(mjpeg.frames), count)),
+        ('reader_frames_per_s', rate(lambda: run(lambda s: mjpeg.FrameReader(s, policy='block')), count)),
+    ])
+
+@benchmark('fleet')
+def bench_fleet(count=50, latency=0.05):
+    "Time to take a snapshot on every camera of an emulated fleet, one after another and with FoscamFleet"
+    import control, fleet
+    from emulator import FoscamEmulator
+    emulators = [FoscamEmulator(latency=latency).start() for n in range(count)]
+    cameras = dict(('cam%d' % n, control.FoscamControl(e.url, 'admin', '')) for n, e in enumerate(emulators))
+    f = fleet.FoscamFleet(cameras, workers=count)
+    try:
+        def sequential():
+            for camera in cameras.values(): camera.snapshot()
+        def concurrent():
+            for result in f.snapshot_all():
+                if result.error: raise result.error
+        sequential() # Warm up the connection pools
+        return OrderedDict([
+            ('cameras', count),
+            ('camera_latency_s', latency),
+            ('sequential_s', count / rate(sequential, count)),
+            ('fleet_s', count / rate(concurrent, count)),
+        ])
+    finally:
+        f.close()
+        for e in emulators: e.stop()
+
+class LinearPriorityQueue(object):
+    "The insertion sorted list scheduler.PriorityQueue used to be, kept as a baseline"
+
+    def __init__(self):
+        self.q = []
+
+    def append(self, priority, obj):
+        for i, o in enumerate(self.q):
+            if priority <= o[0]:
+                self.q.insert(i, (priority, obj))
+                break
+        else:
+            self.q.append((priority, obj))
+
+    def pop(self):
+        return self.q.pop()
+
+@benchmark('queue')
+def bench_queue(sizes=(10000, 100000), operations=2000):
+    "Append and pop throughput of the scheduler priority queue with many tasks pending"
+    import random
+    import scheduler
+    random.seed(0)
+    results = OrderedDict()
+    for size in sizes:
+        priorities = [random.randint(0, 10) for n in range(size + operations)]
+        linear = LinearPriorityQueue()
+        linear.q = sorted((p, n) for n, p in enumerate(priorities[:size]))
+        heap = scheduler.PriorityQueue()
+        for n, p in enumerate(priorities[:size]): heap.append(p, n)
+        def churn(queue):
+            for n in range(size, size + operations):
+                queue.append(priorities[n], n)
+                queue.pop()
+        results['linear_%d_ops_per_s' % size] = rate(lambda: churn(linear), operations)
+        results['heap_%d_ops_per_s' % size] = rate(lambda: churn(heap), operations)
+        handles = [heap.append(p, n) for n, p in enumerate(priorities[:operations])]
+        results['heap_%d_cancel_per_s' % size] = rate(lambda: [heap.cancel(h) for h in handles], operations)
+    return results
+
+class FakeCamera(object):
+    "An in memory stand in for FoscamControl which counts the calls the schedulers make"
+
+    defaultPreset = 1
+
+    def __init__(self, moveTime=None):
+        "@param moveTime Function of (from preset, to preset) giving how long the camera moves for each seek"
+        self.preset = None
+        self.presetTime = 0.0
+        self.moveTime = moveTime
+        self.settleTime = 0.0
+        self.seeks = 0
+        self.snapshots = 0
+
+    def goto_preset(self, preset):
+        if self.moveTime is not None: self.settleTime = time.time() + self.moveTime(self.preset, preset)
+        self.preset = preset
+        self.presetTime = time.time()
+        self.seeks += 1
+
+    def snapshot(self, resolution='VGA', fresh=False):
+        self.snapshots += 1
+        if time.time() < self.settleTime: # Moving, every image is different
+            return b'\xff\xd8' + b'\0' * (self.snapshots * 997 % 5000) + b'\xff\xd9'
+        return b'\xff\xd8' + b'\0' * (1000 * (self.preset or 0)) + b'\xff\xd9'
+
+@benchmark('scheduler_idle')
+def bench_scheduler_idle(tasks=100, duration=2.0):
+    "CPU time the scheduler uses while interval tasks wait for their next snapshot"
+    import camscheduler
+    camera = FakeCamera()
+    s = camscheduler.FoscamScheduler(camera)
+    for n in range(tasks):
+        s.interval(0, n % 4 + 1, lambda *args: None, 2, 3600.0, expire=time.time() + 7200.0)
+    time.sleep(0.1)
+    cpu = time.process_time()
+    time.sleep(duration)
+    results = OrderedDict([
+        ('pending_tasks', len(s.queue)),
+        ('cpu_fraction', (time.process_time() - cpu) / duration),
+    ])
+    s.queue.purge(float('inf'))
+    with s.cond: s.cond.notify()
+    return results
+
+@benchmark('engine')
+def bench_engine(counts=(10, 100, 300), snapshots=3, period=0.5, workers=8):
+    """Scheduler threads once every camera is running, peak resident memory growth and time for every camera of a
+    growing emulated fleet to take an interval of snapshots, with a scheduler thread per camera and with the schedulers
+    sharing a scheduler.Engine. Resident memory includes the thread stacks, it isn't measured without /proc."""
+    import gc, control, scheduler, camscheduler
+    from emulator import FoscamEmulator
+    e = FoscamEmulator().start()
+    results = OrderedDict()
+    try:
+        for count in counts:
+            for mode in ('threads', 'engine'):
+                gc.collect()
+                baseline = rss()
+                engine = scheduler.Engine(workers, 'scheduler engine') if mode == 'engine' else None
+                cameras = [control.FoscamControl(e.url, 'admin', '', pool_size=1, name='cam%d' % n, limiter=False) for n in range(count)]
+                for camera in cameras: camera.preset = camera.defaultPreset # Already there, no seek
+                schedulers = [camscheduler.FoscamScheduler(camera, engine=engine) for camera in cameras]
+                done = threading.Semaphore(0)
+                first = set()
+                running = threading.Event()
+                def callback(image, preset, final, userdata):
+                    first.add(userdata)
+                    if len(first) == count: running.set() # Every scheduler has started and has snapshots to go
+                    if final: done.release()
+                peak = [baseline]
+                sampling = threading.Event()
+                def sample():
+                    while not sampling.wait(0.005): peak[0] = max(peak[0], rss())
+                if baseline is not None:
+                    sampler = threading.Thread(target=sample)
+                    sampler.start()
+                try:
+                    start = time.perf_counter()
+                    for n, s in enumerate(schedulers): s.interval(0, camera.defaultPreset, callback, snapshots, period, userdata=n)
+                    running.wait()
+                    threads = sum(1 for t in threading.enumerate() if t.name.startswith('scheduler'))
+                    for s in schedulers: done.acquire()
+                    elapsed = time.perf_counter() - start
+                finally:
+                    sampling.set()
+                    if baseline is not None: sampler.join()
+                    if engine is not None: engine.close()
+                    for camera in cameras: camera.pool.close()
+                results['%s_%d_threads' % (mode, count)] = threads
+                if baseline is not None: results['%s_%d_rss_kib' % (mode, count)] = (peak[0] - baseline) / 1024.0
+                results['%s_%d_s' % (mode, count)] = elapsed
+        return results
+    finally:
+        e.stop()
+
+@benchmark('presets')
+def bench_presets(requests=200, presets=6, seek=0.01):
+    """Simulated snapshots per hour of a FoscamScheduler with random snapshot requests over several presets, with and
+    without coalescing requests by preset. Seeks are shortened to seek seconds and the rate scaled back to real time."""
+    import random
+    import threading
+    import camscheduler
+    seekTime, camscheduler.SEEK_TIME = camscheduler.SEEK_TIME, seek
+    scale = seekTime / seek
+    random.seed(0)
+    workload = [(random.randint(0, 2), random.randint(1, presets)) for n in range(requests)]
+    results = OrderedDict()
+    try:
+        for name, options in (('before', dict(coalesce=False, minimizeTravel=False)), ('after', {})):
+            camera = FakeCamera()
+            s = camscheduler.FoscamScheduler(camera, **options)
+            done = threading.Semaphore(0)
+            start = time.time()
+            for priority, preset in workload:
+                s.snapshot(priority, preset, lambda *args: done.release())
+            for n in range(requests): done.acquire()
+            elapsed = (time.time() - start) * scale
+            results[name + '_seeks'] = camera.seeks
+            results[name + '_snapshots_per_hour'] = requests / elapsed * 3600.0
+    finally:
+        camscheduler.SEEK_TIME = seekTime
+    return results
+
+@benchmark('settle')
+def bench_settle(requests=40, presets=4, scale=100.0):
+    """Mean snapshot request latency with the fixed SEEK_TIME wait and with settle detection, on a fake camera whose
+    seeks take 3 to 8 seconds. Time runs scale times faster than real and latencies are scaled back."""
+    import random
+    import threading
+    import camscheduler
+    seekTime, camscheduler.SEEK_TIME = camscheduler.SEEK_TIME, camscheduler.SEEK_TIME / scale
+    random.seed(0)
+    moves = dict(((a, b), random.uniform(3.0, 8.0) / scale) for a in [None] + list(range(1, presets + 1)) for b in range(1, presets + 1))
+    workload = [random.randint(1, presets) for n in range(requests)]
+    results = OrderedDict()
+    try:
+        for name, settle in (('fixed', lambda c: None), ('detect', lambda c: camscheduler.SettleDetector(c, pollInterval=0.5 / scale))):
+            camera = FakeCamera(lambda a, b: moves[(a, b)])
+            s = camscheduler.FoscamScheduler(camera, coalesce=False, settle=settle(camera))
+            latencies = []
+            for preset in workload:
+                done = threading.Event()
+                start = time.time()
+                s.snapshot(0, preset, lambda *args: done.set())
+                done.wait()
+                latencies.append((time.time() - start) * scale)
+            results[name + '_mean_latency_s'] = sum(latencies) / len(latencies)
+            results[name + '_max_latency_s'] = max(latencies)
+    finally:
+        camscheduler.SEEK_TIME = seekTime
+    return results
+
+@benchmark('driver')
+def bench_driver(count=2000, threads=8, latency=0.001):
+    "Requests per second, latency and memory of FoscamControl calls to an emulated camera from several threads"
+    import control
+    from emulator import FoscamEmulator
+    e = FoscamEmulator(latency=latency).start()
+    camera = control.FoscamControl(e.url, 'admin', '', pool_size=threads, limiter=False)
+    try:
+        results = OrderedDict([('threads', threads), ('camera_latency_s', latency)])
+        results.update(prefixed('snapshot', load(camera.snapshot, count, threads)))
+        results.update(prefixed('get_status', load(camera.get_status, count, threads)))
+        results.update(prefixed('goto_preset', load(lambda: camera.goto_preset(2), count, threads)))
+        results['connections'] = e.counters['connections']
+        return results
+    finally:
+        camera.pool.close()
+        e.stop()
+
+class Timed(object):
+    "A scheduler.Scheduler runnable which records how long it waited in the queue"
+
+    def __init__(self, latencies, done):
+        self.latencies = latencies
+        self.done = done
+        self.posted = time.perf_counter()
+
+    def run(self):
+        self.latencies.append(time.perf_counter() - self.posted)
+        self.done.release()
+        return False
+
+@benchmark('scheduler')
+def bench_scheduler(count=20000):
+    "Runnables per second through scheduler.Scheduler, how long they wait to run and the memory of a full queue"
+    import random
+    import scheduler
+    random.seed(0)
+    priorities = [random.randint(0, 10) for n in range(count)]
+    s = scheduler.Scheduler()
+    latencies = []
+    done = threading.Semaphore(0)
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        with s.cond: # Queue everything before the first one runs to measure a full queue
+            for priority in priorities: s.append(priority, Timed(latencies, done))
+            peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    for n in range(count): done.acquire()
+    return summary(latencies, time.perf_counter() - start, peak)
+
+@benchmark('camqtt')
+def bench_camqtt(count=2000):
+    "Snapshot requests per second through foscamqtt.CamqttServer from request message to published image"
+    try:
+        import foscamqtt
+        import paho.mqtt.client as mqtt
+    except ImportError:
+        return OrderedDict([('skipped', 'paho-mqtt is not installed')])
+    latencies = []
+    done = threading.Semaphore(0)
+    class Server(foscamqtt.CamqttServer):
+        "Times each request to its publish instead of sending it to a broker"
+        def publish(self, topic, payload=None, qos=0, retain=False):
+            latencies.append(time.perf_counter() - sent.pop(0))
+            done.release()
+    camera = FakeCamera()
+    camera.preset = camera.defaultPreset # Already there, no seek
+    server = Server('benchmark', None, {'cam0': camera})
+    sent = []
+    def request():
+        msg = mqtt.MQTTMessage(topic=b'cam0' + server.REQUEST_SUFFIX.encode())
+        msg.payload = json.dumps(['snapshot', {'priority': 0, 'preset': camera.defaultPreset}]).encode()
+        sent.append(time.perf_counter())
+        server.on_message(server, None, msg)
+        done.acquire()
+    start = time.perf_counter()
+    for n in range(count): request()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        for n in range(100): request()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    del latencies[count:]
+    return summary(latencies, elapsed, peak)
+
+class BrokerStandIn(object):
+    "A minimal local MQTT broker stand in which accepts one client and times each PUBLISH it receives"
+
+    def __init__(self, delay=0.0):
+        "@param delay Seconds the broker spends on each PUBLISH, to stand in for a slow or distant broker"
+        import socket
+        self.delay = delay
+        self.received = [] # (time.perf_counter() received, payload)
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def _read(conn, n):
+        data = bytearray()
+        while len(data) < n:
+            chunk = conn.recv(n - len(data))
+            if not chunk: raise EOFError()
+            data += chunk
+        return bytes(data)
+
+    def _serve(self):
+        import socket, struct
+        conn = self.sock.accept()[0]
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                first = self._read(conn, 1)[0]
+                length, shift = 0, 0
+                while True:
+                    byte = self._read(conn, 1)[0]
+                    length += (byte & 127) << shift
+                    shift += 7
+                    if byte < 128: break
+                body = self._read(conn, length)
+                kind = first >> 4
+                if kind == 1: # CONNECT
+                    conn.sendall(b'\x20\x02\x00\x00')
+                elif kind == 3: # PUBLISH
+                    offset = 2 + struct.unpack('>H', body[:2])[0] + (2 if first & 6 else 0)
+                    self.received.append((time.perf_counter(), body[offset:]))
+                    if self.delay: time.sleep(self.delay)
+                elif kind == 8: # SUBSCRIBE
+                    conn.sendall(b'\x90\x03' + body[:2] + b'\x00')
+                elif kind == 12: # PINGREQ
+                    conn.sendall(b'\xd0\x00')
+                elif kind == 14: # DISCONNECT
+                    return
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+
+@benchmark('delivery')
+def bench_delivery(count=1000, rate=500.0, size=30000, slow=0.004):
+    """Snapshot to broker latency, throughput and the time the scheduler thread spends handing over each snapshot,
+    through foscamqtt.CamqttServer to a local broker stand in. Snapshots are published inline on the scheduler thread
+    as before, then through the delivery queue with each policy, to a fast broker and to one taking slow seconds per
+    message."""
+    try:
+        import foscamqtt
+        import paho.mqtt.client as mqtt
+    except ImportError:
+        return OrderedDict([('skipped', 'paho-mqtt is not installed')])
+    images = [bytes([n]) * size for n in range(8)] # Distinct objects, the server skips repeats of the same image
+    results = OrderedDict()
+    for broker_name, delay in (('fast', 0.0), ('slow', slow)):
+        for mode in ('inline', 'drop', 'block'):
+            broker = BrokerStandIn(delay)
+            server = foscamqtt.CamqttServer('benchmark', None, {}, policy='block' if mode == 'inline' else mode, queue_size=16)
+            connected = threading.Event()
+            server.on_connect = lambda *args: connected.set()
+            server.connect('127.0.0.1', broker.port)
+            server.loop_start()
+            connected.wait(5.0)
+            if mode == 'inline':
+                def handover(snapshot, preset, final, userdata): # How on_snapshot used to publish
+                    server.publish(userdata[0] + server.SNAPSHOT_SUFFIX, json.dumps({'preset': preset, 'final': final}).encode() + b'\0' + snapshot)
+            else:
+                handover = server.on_snapshot
+            sent = []
+            handovers = []
+            try:
+                start = time.perf_counter()
+                for n in range(count):
+                    delay_s = start + n / rate - time.perf_counter()
+                    if delay_s > 0.0: time.sleep(delay_s)
+                    sent.append(time.perf_counter())
+                    handover(images[n % len(images)], n, True, ('cam0', None))
+                    handovers.append(time.perf_counter() - sent[-1])
+                if mode != 'inline': server.delivery.flush(30.0)
+                deadline = time.time() + 30.0
+                while len(broker.received) < count - (server.delivery.dropped if mode == 'drop' else 0) and time.time() < deadline:
+                    time.sleep(0.01)
+                received = list(broker.received)
+            finally:
+                server.loop_stop()
+                server.close()
+                server.disconnect()
+                broker.close()
+            latencies = [t - sent[json.loads(payload[:payload.index(b'\0')].decode())['preset']] for t, payload in received]
+            prefix = '%s_%s_' % (broker_name, mode)
+            results[prefix + 'per_s'] = len(received) / (received[-1][0] - sent[0]) if received else 0.0
+            results[prefix + 'p50_ms'] = percentile(latencies, 0.5) * 1000.0 if latencies else None
+            results[prefix + 'p99_ms'] = percentile(latencies, 0.99) * 1000.0 if latencies else None
+            results[prefix + 'handover_p99_ms'] = percentile(handovers, 0.99) * 1000.0
+            results[prefix + 'dropped'] = count - len(received)
+    return results
+
+@benchmark('metrics')
+def bench_metrics(count=200000, requests=3000):
+    """Cost of the instrumentation: nanoseconds per metric update and the slow down of uninstrumented requests to an
+    emulated camera when they are instrumented"""
+    import control, metrics
+    from emulator import FoscamEmulator
+    registry = metrics.Registry()
+    counter = registry.counter('counter', 'benchmark', ('camera', 'endpoint'))
+    histogram = registry.histogram('histogram', 'benchmark', ('camera', 'endpoint'))
+    results = OrderedDict()
+    results['counter_inc_ns'] = 1e9 / rate(lambda: [counter.labels('cam', 'get_status.cgi').inc() for n in range(count)], count)
+    results['histogram_observe_ns'] = 1e9 / rate(lambda: [histogram.labels('cam', 'get_status.cgi').observe(0.001 * (n % 100)) for n in range(count)], count)
+    child = histogram.labels('cam', 'get_status.cgi')
+    results['histogram_observe_held_ns'] = 1e9 / rate(lambda: [child.observe(0.001 * (n % 100)) for n in range(count)], count)
+    children = {}
+    results['request_metrics_ns'] = 1e9 / rate(lambda: [control.request_metrics(children, 'cam', 'get_status.cgi') for n in range(count)], count)
+    e = FoscamEmulator().start()
+    camera = control.FoscamControl(e.url, 'admin', '', name='benchmark')
+    path = camera._query('get_status.cgi')
+    try:
+        for n in range(100): camera.pool.request(path) # Warm up
+        plain, instrumented = [], []
+        for n in range(5): # Interleaved to even out noise
+            plain.append(rate(lambda: [camera.pool.request(path) for n in range(requests // 5)], requests // 5))
+            instrumented.append(rate(lambda: [camera._request('get_status.cgi', path) for n in range(requests // 5)], requests // 5))
+        results['plain_requests_per_s'] = max(plain)
+        results['instrumented_requests_per_s'] = max(instrumented)
+        results['overhead_percent'] = (1.0 / max(instrumented) - 1.0 / max(plain)) * max(plain) * 100.0
+        results['render_lines'] = len(metrics.REGISTRY.render().splitlines())
+    finally:
+        camera.pool.close()
+        e.stop()
+    return results
+
+@benchmark('limiter')
+def bench_limiter(threads=16, count=800, latency=0.005, max_concurrent=2):
+    """Requests per second and failures with many threads hammering a camera which hangs up on more than max_concurrent
+    requests at once, without a limiter and with one. Also the latency of PTZ commands made during the bulk polling,
+    with and without their priority lane."""
+    import control, limiter
+    from emulator import FoscamEmulator
+    results = OrderedDict()
+    for name, make in (('unlimited', lambda: False), ('limited', lambda: limiter.HostLimiter(max_inflight=max_concurrent))):
+        e = FoscamEmulator(latency=latency, max_concurrent=max_concurrent).start()
+        camera = control.FoscamControl(e.url, 'admin', '', pool_size=threads, retries=0, limiter=make())
+        failures = []
+        def poll():
+            try:
+                camera.get_params()
+            except Exception as error:
+                failures.append(error)
+        try:
+            results[name + '_ok_requests_per_s'] = load(poll, count, threads, traced=0)['per_s'] * (count - len(failures)) / count
+            results[name + '_failures'] = len(failures)
+        finally:
+            camera.pool.close()
+            e.stop()
+    for name, lanes in (('fifo', {}), ('lanes', None)):
+        e = FoscamEmulator(latency=latency, max_concurrent=max_concurrent).start()
+        camera = control.FoscamControl(e.url, 'admin', '', pool_size=threads, limiter=limiter.HostLimiter(max_inflight=max_concurrent))
+        saved = dict(control.LANES)
+        if lanes is not None:
+            control.LANES.clear()
+            control.LANES.update(lanes)
+        running = [True]
+        def bulk():
+            while running[0]: camera.get_params()
+        pollers = [threading.Thread(target=bulk) for n in range(threads)]
+        try:
+            for p in pollers: p.start()
+            time.sleep(0.1)
+            latencies = []
+            for n in range(20):
+                start = time.perf_counter()
+                camera.control(control.CONTROL_COMMANDS['STOP_UP'])
+                latencies.append(time.perf_counter() - start)
+            results[name + '_control_p50_ms'] = percentile(latencies, 0.5) * 1000.0
+        finally:
+            running[0] = False
+            for p in pollers: p.join()
+            control.LANES.clear()
+            control.LANES.update(saved)
+            camera.pool.close()
+            e.stop()
+    return results
+
+@benchmark('health')
+def bench_health(outage=3.0, timeout=0.5, period=0.02):
+    """Outage detection and recovery time of health.HealthMonitor against an emulated camera which goes off the network,
+    and the seconds a client taking a snapshot every period wastes in requests hanging on the dead camera, with and
+    without the circuit breaker"""
+    import control, health, camscheduler
+    from emulator import FoscamEmulator
+    results = OrderedDict()
+    for mode in ('unprotected', 'breaker'):
+        e = FoscamEmulator().start()
+        camera = control.FoscamControl(e.url, 'admin', '', timeout=timeout, retries=0, limiter=False)
+        monitor = None
+        if mode == 'breaker':
+            s = camscheduler.FoscamScheduler(camera)
+            monitor = health.HealthMonitor(min_interval=0.2, timeout=timeout, reset_timeout=0.5)
+            watched = monitor.add('cam0', camera, s)
+        wasted = [0.0]
+        counts = {'failed': 0, 'rejected': 0}
+        running = threading.Event()
+        def client():
+            while not running.wait(period):
+                start = time.time()
+                try:
+                    camera.snapshot()
+                except health.CameraUnavailable:
+                    counts['rejected'] += 1
+                except Exception:
+                    counts['failed'] += 1
+                    wasted[0] += time.time() - start
+        thread = threading.Thread(target=client)
+        thread.start()
+        try:
+            time.sleep(0.5)
+            down = time.time()
+            e.down = True
+            time.sleep(outage)
+            up = time.time()
+            e.down = False
+            if monitor is not None:
+                deadline = time.time() + 10.0
+                while watched.recoveries == 0 and time.time() < deadline: time.sleep(0.01)
+                results['detection_s'] = camera.breaker.tripped - down
+                results['recovery_s'] = camera.breaker.closed - up
+                results['recoveries'] = watched.recoveries
+                results['polls'] = watched.polls
+            else:
+                time.sleep(timeout * 2)
+        finally:
+            running.set()
+            thread.join()
+            if monitor is not None: monitor.close()
+            camera.pool.close()
+            e.stop()
+        results[mode + '_wasted_s'] = wasted[0]
+        results[mode + '_failed_calls'] = counts['failed']
+        results[mode + '_rejected_calls'] = counts['rejected']
+    return results
+
+@benchmark('ptz')
+def bench_ptz(latency=0.05, rate=100.0, duration=1.0):
+    """Joystick input at rate commands per second for duration seconds to a camera with a round trip of latency seconds,
+    sent one after another as the input arrives and through a PTZChannel. The stop delay is how long the camera keeps
+    moving after the joystick is let go."""
+    import queue
+    import control, ptz
+    from emulator import FoscamEmulator
+    directions = ['LEFT', 'UP', 'RIGHT', 'DOWN']
+    inputs = [directions[int(n * 4 / (rate * duration))] for n in range(int(rate * duration))]
+    results = OrderedDict()
+    e = FoscamEmulator(latency=latency).start()
+    camera = control.FoscamControl(e.url, 'admin', '', limiter=False)
+    try:
+        # One after another: a worker sends each input in turn, as a UI event loop calling control would
+        events = queue.Queue()
+        def sender():
+            while True:
+                command = events.get()
+                if command is None: return
+                camera.control(command)
+        worker = threading.Thread(target=sender)
+        worker.start()
+        before = e.counters['requests']
+        for command in inputs:
+            events.put(command)
+            time.sleep(1.0 / rate)
+        released = time.time()
+        events.put('STOP_UP')
+        events.put(None)
+        worker.join()
+        results['direct_sent'] = e.counters['requests'] - before
+        results['direct_stop_delay_s'] = time.time() - released
+        channel = ptz.PTZChannel(camera)
+        before = e.counters['requests']
+        for command in inputs:
+            channel.control(command)
+            time.sleep(1.0 / rate)
+        released = time.time()
+        channel.stop()
+        channel.flush()
+        results['channel_sent'] = e.counters['requests'] - before
+        results['channel_stop_delay_s'] = time.time() - released
+        stats = channel.stats
+        results['channel_p50_ms'] = stats['p50'] * 1000.0
+        results['channel_p99_ms'] = stats['p99'] * 1000.0
+        channel.close()
+    finally:
+        camera.pool.close()
+        e.stop()
+    return results
+
+class RecordedCamera(object):
+    "Plays a recorded stream back as a camera's frames, with timestamps spaced as if it ran at rate frames per second"
+
+    def __init__(self, stream, rate=30.0):
+        self.stream = stream
+        self.rate = rate
+        self.done = threading.Event()
+        self.release = threading.Event()
+
+    def frames(self, resolution='VGA', rate='full'):
+        import mjpeg
+        start = time.time()
+        for n, (timestamp, data) in enumerate(mjpeg.frames(io.BytesIO(self.stream))):
+            yield mjpeg.Frame(start + n / self.rate, data)
+        self.done.set()
+        self.release.wait() # A camera stream doesn't end, hold it open until released
+
+@benchmark('recorder')
+def bench_recorder(count=3000, cameras=4, lookups=20000):
+    "Frames per second written by a Recorder for several cameras at once and frames per second found by time"
+    import random
+    import shutil
+    import tempfile
+    import recorder
+    stream = recorded_stream(count)
+    root = tempfile.mkdtemp()
+    try:
+        r = recorder.Recorder(root, segment_seconds=10.0)
+        sources = [RecordedCamera(stream) for n in range(cameras)]
+        start = time.perf_counter()
+        for n, source in enumerate(sources): r.record('cam%d' % n, source)
+        for source in sources: source.done.wait()
+        elapsed = time.perf_counter() - start
+        for n, source in enumerate(sources):
+            r.recordings['cam%d' % n].running = False
+            source.release.set()
+        r.close()
+        segments = r.segments('cam0')
+        first = recorder.Segment(segments[0]).start
+        random.seed(0)
+        times = [first + random.uniform(0.0, count / 30.0) for n in range(lookups)]
+        def lookup():
+            for t in times:
+                with r.open_segment('cam0', t) as segment:
+                    timestamp, data = segment.frame_at(t)
+                    data.release()
+        opened = [recorder.Segment(base) for base in segments]
+        starts = [segment.start for segment in opened]
+        def mapped():
+            import bisect
+            for t in times:
+                timestamp, data = opened[bisect.bisect_right(starts, t) - 1].frame_at(t)
+        results = OrderedDict([
+            ('cameras', cameras),
+            ('segments_per_camera', len(segments)),
+            ('write_frames_per_s', cameras * count / elapsed),
+            ('write_mb_per_s', cameras * len(stream) / elapsed / 1e6),
+            ('open_and_find_per_s', rate(lookup, lookups)),
+            ('mapped_find_per_s', rate(mapped, lookups)),
+        ])
+        for segment in opened: segment.close()
+        return results
+    finally:
+        shutil.rmtree(root)
+
+def legacy_parse_vars(raw):
+    "The line splitting parser control.parse_vars used to be, kept as a baseline"
+    ret = {}
+    for l in raw.split(b'\n'):
+        if not (l.startswith(b'var ') and l.endswith(b';')): continue
+        k, v = l[4:-1].split(b'=')
+        if v.isdigit():
+            ret[k] = int(v)
+        elif v.startswith(b"'") and v.endswith(b"'"):
+            ret[k] = v[1:-1]
+        else:
+            ret[k] = v
+    return ret
+
+def params_response(users=8, schedules=21):
+    "A get_params.cgi response the size of a real camera's, over a hundred variables"
+    lines = ["var id='000DC5D0ABCD';", "var sys_ver='11.37.2.49';", "var app_ver='2.0.10.7';", "var alias='porch';",
+             "var now=1357560000;", "var tz=0;", "var ntp_enable=1;", "var ntp_svr='time.nist.gov';", "var dhcpen=1;",
+             "var ip='192.168.1.10';", "var mask='255.255.255.0';", "var gateway='192.168.1.1';", "var dns='192.168.1.1';",
+             "var port=80;", "var wifi_enable=0;", "var wifi_ssid='';", "var ftp_svr='';", "var ftp_port=21;"]
+    for n in range(1, users + 1):
+        lines += ["var user%d_name='user%d';" % (n, n), "var user%d_pwd='';" % n, "var user%d_pri=%d;" % (n, n % 3)]
+    for n in range(schedules):
+        lines += ["var alarm_schedule_%s_%d=0;" % (day, n) for day in ('sun', 'mon', 'tue')]
+    return ('\n'.join(lines) + '\n').encode('ascii')
+
+@benchmark('parse')
+def bench_parse(count=2000):
+    "Responses per second parsed for the get_status, get_misc and get_params responses of the emulator and a real camera"
+    import control
+    from emulator import FoscamEmulator
+    e = FoscamEmulator().start()
+    camera = control.FoscamControl(e.url, 'admin', '', cache_ttl=control.FoscamControl.CACHE_TTL)
+    try:
+        responses = [(cgi, camera._read_raw(cgi)) for cgi in ('get_status.cgi', 'get_misc.cgi')]
+        responses.append(('get_params.cgi', params_response()))
+        results = OrderedDict()
+        for cgi, raw in responses:
+            name = cgi.split('.')[0]
+            record = control.RECORDS[cgi]
+            results[name + '_legacy_per_s'] = rate(lambda: [legacy_parse_vars(raw) for n in range(count)], count)
+            results[name + '_typed_per_s'] = rate(lambda: [control.parse_vars(raw, record) for n in range(count)], count)
+        results['uncached_get_misc_per_s'] = rate(lambda: [camera.get_misc(refresh=True) for n in range(count // 10)], count // 10)
+        results['cached_get_misc_per_s'] = rate(lambda: [camera.get_misc() for n in range(count)], count)
+        return results
+    finally:
+        camera.pool.close()
+        e.stop()
+
+def synthetic_frames(np, count, shape, seed=0):
+    "Noisy grayscale frames of a static scene with a square crossing it in the second half"
+    random = np.random.RandomState(seed)
+    height, width = shape
+    scene = random.randint(40, 200, shape).astype(np.int16)
+    frames = []
+    size = height // 4
+    for n in range(count):
+        frame = scene + random.randint(-8, 9, shape)
+        if n >= count // 2:
+            x = (n * width // 80) % (width - size)
+            frame[height // 3:height // 3 + size, x:x + size] = 250
+        frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+    return frames
+
+@benchmark('motion')
+def bench_motion(count=300, cameras=4, fps=30.0):
+    """Frames per second through motion.MotionDetector for QQVGA and QVGA frames given as arrays and, with Pillow, as
+    JPEGs, and how many cameras that keeps up with at full frame rate on one core. Each camera has its own detector."""
+    try:
+        import numpy as np
+    except ImportError:
+        return OrderedDict([('skipped', 'numpy is not installed')])
+    import motion
+    results = OrderedDict()
+    for resolution, shape in (('QQVGA', (120, 160)), ('QVGA', (240, 320))):
+        frames = synthetic_frames(np, count, shape)
+        detectors = [motion.MotionDetector() for n in range(cameras)]
+        detected = []
+        def run(frames):
+            del detected[:]
+            for frame in frames:
+                for detector in detectors: detected.append(bool(detector.feed(frame)))
+        per_s = rate(lambda: run(frames), count * cameras)
+        results[resolution + '_frames_per_s'] = per_s
+        results[resolution + '_cameras_at_full_rate'] = per_s / fps
+        results[resolution + '_motion_frames'] = sum(detected) // cameras
+        if motion.Image is not None:
+            jpegs = []
+            for frame in frames:
+                out = io.BytesIO()
+                motion.Image.fromarray(frame).save(out, 'JPEG', quality=75)
+                jpegs.append(out.getvalue())
+            per_s = rate(lambda: run(jpegs), count * cameras)
+            results[resolution + '_jpeg_frames_per_s'] = per_s
+            results[resolution + '_jpeg_cameras_at_full_rate'] = per_s / fps
+    return results
+
+@benchmark('logtail')
+def bench_logtail(size=2000, added=5, polls=200):
+    """Per poll CPU time to find the new entries of a camera log of size entries to which added entries are appended
+    between polls, parsing the whole log each time and keeping a set of the entries seen, and with logtail.LogTail"""
+    import logtail
+    lines = ['Mon, 2013-01-07 %02d:%02d:%02d user%d 192.168.1.%d access' % (n // 3600 % 24, n // 60 % 60, n % 60, n % 7, n % 250) for n in range(size + added * polls)]
+    responses = [("var log_text='%s';\n" % '\\n'.join(lines[n * added:size + n * added])).encode() for n in range(polls + 1)]
+    def full():
+        seen = set()
+        found = 0
+        for raw in responses:
+            start, end, separator = logtail.log_span(raw)
+            entries = [logtail.parse_entry(line) for line in raw[start:end].decode().split(separator.decode())]
+            found += sum(1 for entry in entries if entry.raw not in seen)
+            seen.update(entry.raw for entry in entries)
+        return found
+    def tail():
+        t = logtail.LogTail(None, name='benchmark')
+        return sum(len(t.feed(raw)) for raw in responses)
+    results = OrderedDict()
+    for name, fn in (('full', full), ('tail', tail)):
+        start = time.process_time()
+        found = fn()
+        results[name + '_ms_per_poll'] = (time.process_time() - start) / len(responses) * 1000.0
+        results[name + '_new_entries'] = found
+    return results
+
+@benchmark('timelapse')
+def bench_timelapse(ticks=1500, period=0.05, presets=(1, 2), seek=0.01, series=500, work=0.002):
+    """Timing error of timelapse.TimeLapse frames of two presets on a fake camera, time scaled so seeks take seek
+    seconds, and the drift over a FoscamScheduler.interval series whose callback takes work seconds, scheduling each
+    snapshot an interval after the last was due and, as before, an interval after it was taken"""
+    import shutil
+    import tempfile
+    import camscheduler
+    import timelapse
+    seekTime, camscheduler.SEEK_TIME = camscheduler.SEEK_TIME, seek
+    root = tempfile.mkdtemp()
+    results = OrderedDict()
+    try:
+        camera = FakeCamera()
+        s = camscheduler.FoscamScheduler(camera)
+        lapse = timelapse.TimeLapse(s, root, presets, period, start=time.time() + 0.1, end=time.time() + 0.1 + (ticks - 0.5) * period)
+        lapse.wait()
+        lapse.close()
+        stats = lapse.stats
+        for name in ('frames', 'missed', 'mean_ms', 'p50_ms', 'p99_ms', 'max_ms'): results['timelapse_' + name] = stats[name]
+        with lapse.open_segment(presets[-1], time.time()) as segment: results['timelapse_indexed_frames'] = len(segment)
+
+        class LegacyAction(camscheduler.SnapshotAction):
+            "Schedules each snapshot of a series an interval after the last one was taken"
+            def run(self):
+                number = self.number
+                repost = camscheduler.SnapshotAction.run(self)
+                if repost and self.number != number:
+                    self.nextTime = self.taken + self.interval
+                    self.start = self.nextTime - camscheduler.SEEK_TIME if self.interval > camscheduler.SEEK_TIME else self.nextTime
+                return repost
+        for name in ('legacy', 'interval'):
+            taken = []
+            done = threading.Event()
+            def callback(image, preset, final, userdata):
+                taken.append(time.time())
+                time.sleep(work)
+                if final: done.set()
+            camera.preset = presets[0]
+            if name == 'interval':
+                s.interval(0, presets[0], callback, series, period)
+            else:
+                s.append(0, LegacyAction(camera, presets[0], callback, series, period, settle=s.settle))
+            done.wait()
+            results[name + '_drift_ms'] = (taken[-1] - taken[0] - (series - 1) * period) * 1000.0
+    finally:
+        camscheduler.SEEK_TIME = seekTime
+        shutil.rmtree(root)
+    return results
+
+class JpegCamera(FakeCamera):
+    "A FakeCamera already at its default preset whose snapshots are a real VGA JPEG"
+
+    def __init__(self, jpeg):
+        FakeCamera.__init__(self)
+        self.jpeg = jpeg
+        self.preset = self.defaultPreset
+
+    def snapshot(self, resolution='VGA', fresh=False):
+        self.snapshots += 1
+        return self.jpeg
+
+@benchmark('postprocess')
+def bench_postprocess(count=100, workers=2):
+    """Snapshots per second a FoscamScheduler gets through, and the time each snapshot callback holds up the scheduler,
+    when the callback makes a thumbnail, a crop and a timestamped low quality copy of each VGA snapshot inline and with
+    a postprocess.PostProcessor with its default limits, dropping or blocking when full, how soon every result is ready
+    and how many snapshots were dropped"""
+    try:
+        import numpy as np
+        import postprocess
+    except ImportError:
+        return OrderedDict([('skipped', 'numpy is not installed')])
+    if postprocess.Image is None: return OrderedDict([('skipped', 'Pillow is not installed')])
+    import camscheduler
+    out = io.BytesIO()
+    postprocess.Image.fromarray(np.random.RandomState(0).randint(0, 256, (480, 640, 3)).astype(np.uint8)).save(out, 'JPEG', quality=90)
+    outputs = {'thumb': [postprocess.Resize(160, 120), postprocess.Recompress(60)],
+               'door': [postprocess.Crop((0.5, 0.2, 0.8, 0.9))],
+               'small': [postprocess.Timestamp(), postprocess.Recompress(40)]}
+    results = OrderedDict()
+    for mode in ('inline', 'pool', 'pool_block'):
+        processor = None if mode == 'inline' else postprocess.PostProcessor(workers, policy='block' if mode == 'pool_block' else 'drop')
+        try:
+            if processor is not None: processor.submit(out.getvalue(), outputs).result() # Start the workers
+            s = camscheduler.FoscamScheduler(JpegCamera(out.getvalue()))
+            scheduled = threading.Event()
+            processed = threading.Semaphore(0)
+            handovers = []
+            def done(images, preset, final, userdata):
+                processed.release()
+            if processor is None:
+                post = lambda image, preset, final, userdata: done(postprocess.process(image, outputs), preset, final, userdata)
+            else:
+                post = processor.wrap(done, outputs)
+            def callback(image, preset, final, userdata):
+                begin = time.perf_counter()
+                post(image, preset, final, userdata)
+                handovers.append(time.perf_counter() - begin)
+                if final: scheduled.set()
+            start = time.perf_counter()
+            s.interval(0, 1, callback, count, 0.0)
+            scheduled.wait()
+            scheduler_s = time.perf_counter() - start
+            dropped = processor.dropped if processor is not None else 0
+            for n in range(count - dropped): processed.acquire()
+            elapsed = time.perf_counter() - start
+        finally:
+            if processor is not None: processor.close()
+        results[mode + '_scheduler_per_s'] = count / scheduler_s
+        results[mode + '_callback_p50_ms'] = percentile(handovers, 0.5) * 1000.0
+        results[mode + '_processed_per_s'] = (count - dropped) / elapsed
+        results[mode + '_dropped'] = dropped
+    return results
+
+def main(names, save=None, compare=None):
+    """Run benchmarks and print their results
+    @param names Benchmarks to run, all of them if empty
+    @param save File name to save the results to as JSON
+    @param compare File name of saved results to show alongside these"""
+    for name in names:
+        if name not in BENCHMARKS: raise ValueError('Unknown benchmark "%s", must be one of %s' % (name, ', '.join(BENCHMARKS)))
+    baseline = {}
+    if compare is not None:
+        with open(compare) as f: baseline = json.load(f)['results']
+    results = OrderedDict()
+    for name in names or BENCHMARKS.keys():
+        sys.stdout.write('%s:\n' % name)
+        results[name] = BENCHMARKS[name]()
+        for k, v in results[name].items():
+            line = '    %-28s %s' % (k, '%.3f' % v if isinstance(v, float) else v)
+            before = baseline.get(name, {}).get(k)
+            if isinstance(v, (int, float)) and isinstance(before, (int, float)):
+                line = '%-50s was %.3f' % (line, before)
+                if before: line += ' (%+.1f%%)' % ((v - before) * 100.0 / before)
+            sys.stdout.write(line + '\n')
+    if save is not None:
+        with open(save, 'w') as f:
+            json.dump(OrderedDict([('time', time.time()), ('python', sys.version.split()[0]), ('results', results)]), f, indent=2)
+    return results
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Run the driver and scheduler benchmarks')
+    parser.add_argument('names', nargs='*', help='Benchmarks to run, one or more of: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--json', dest='save', help='Save the results to this JSON file')
+    parser.add_argument('--compare', help='Show the results of an earlier run saved with --json alongside')
+    options = parser.parse_args()
+    main(options.names, options.save, options.compare)
@@ -4,12 +4,169 @@ Camera action scheduler.
 """
 __author__ = "Daniel Casner <www.danielcasner.org>"
 
+import io
+import os
+import sys
+import json
+import math
 import time
 import scheduler
 import control
+import metrics
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 SEEK_TIME = 20.0
 
+SEEK_SECONDS = metrics.REGISTRY.histogram('foscam_seek_seconds', 'Time from commanding a preset until the camera settled there',
+                                          ('camera', 'preset'), buckets=(1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 8.0, 10.0, 15.0, 20.0, 30.0))
+
+class SeekTimes:
+    """Seek durations learned for each pair of presets, optionally persisted to a JSON file so they survive restarts."""
+
+    def __init__(self, path=None, weight=0.3):
+        """Load any previously learned seek times
+        @param path JSON file to persist to, None to keep them in memory only
+        @param weight Weight of each new observation in the running average
+        """
+        self.path = path
+        self.weight = weight
+        self.times = {}
+        if path is not None and os.path.isfile(path):
+            with open(path) as fh:
+                for k, v in json.load(fh).items():
+                    src, dst = k.split('>')
+                    self.times[(int(src), int(dst))] = v
+
+    def estimate(self, src, dst):
+        "The learned seek time from preset src to dst in seconds, None if never observed"
+        return self.times.get((src, dst))
+
+    def record(self, src, dst, seconds):
+        "Add an observed seek time"
+        previous = self.times.get((src, dst))
+        self.times[(src, dst)] = seconds if previous is None else previous + self.weight * (seconds - previous)
+        if self.path is not None: self.save()
+
+    def save(self):
+        "Write the learned times to the JSON file"
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(dict(('%d>%d' % k, v) for k, v in self.times.items()), fh, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+class FixedSettle:
+    "Assumes the camera has settled a fixed SEEK_TIME after each seek"
+
+    def __init__(self, foscam):
+        self.cam = foscam
+        self.seekTimes = None
+
+    def seek(self, preset):
+        """Start moving the camera to a preset.
+        @return When to check whether the camera has settled"""
+        self.cam.goto_preset(preset)
+        return self.cam.presetTime + SEEK_TIME
+
+    def check(self, now):
+        """Check whether the camera has settled after its last seek.
+        @return (settled time, None) once settled, otherwise (None, when to check again)"""
+        settled = self.cam.presetTime + SEEK_TIME
+        if now < settled: return None, settled
+        self.cam.settled = max(getattr(self.cam, 'settled', 0.0), settled)
+        return settled, None
+
+class SettleDetector(FixedSettle):
+    """
+    Detects when the camera has stopped moving after a seek by polling cheap QQVGA snapshots. Consecutive snapshots are
+    decoded and compared pixel by pixel, once they stop changing the camera has settled. Without numpy and Pillow, or
+    for snapshots which can't be decoded, the JPEG sizes are compared instead, which a camera panning across a uniform
+    scene can pass. The observed seek times are learned per pair of presets and used to delay the first poll, SEEK_TIME
+    is the upper bound.
+    """
+
+    def __init__(self, foscam, seekTimes=None, pollInterval=0.5, threshold=0.02, stablePolls=2, pixelThreshold=24):
+        """Set up settle detection for a camera
+        @param foscam driver object
+        @param seekTimes SeekTimes to learn into, None for a new in memory one
+        @param pollInterval Seconds between snapshots while waiting for the camera to settle
+        @param threshold Largest fraction of pixels which change between snapshots of a still camera, or relative
+               change in JPEG size if they can't be decoded
+        @param stablePolls Number of consecutive unchanged snapshots required
+        @param pixelThreshold Smallest change in gray level of a pixel which counts as a change, above sensor noise
+        """
+        FixedSettle.__init__(self, foscam)
+        self.seekTimes = SeekTimes() if seekTimes is None else seekTimes
+        self.pollInterval = pollInterval
+        self.threshold = threshold
+        self.stablePolls = stablePolls
+        self.pixelThreshold = pixelThreshold
+        self._track(None)
+
+    def _track(self, src):
+        "Start following a seek from preset src to the camera's current preset"
+        self.src = src
+        self.dst = self.cam.preset
+        self.seekStart = self.cam.presetTime
+        self.previous = None
+        self.stable = 0
+        self.settled = None
+
+    def seek(self, preset):
+        src = self.cam.preset
+        self.cam.goto_preset(preset)
+        self._track(src)
+        estimate = self.seekTimes.estimate(src, preset)
+        return self.seekStart + max(self.pollInterval, 0.0 if estimate is None else 0.75 * estimate)
+
+    def check(self, now):
+        if self.dst != self.cam.preset or self.seekStart != self.cam.presetTime: # Someone else moved the camera
+            self._track(None)
+        if self.settled is None:
+            if now >= self.seekStart + SEEK_TIME:
+                self._settle(self.seekStart + SEEK_TIME)
+            else:
+                image = self._decode(self.cam.snapshot('QQVGA', fresh=True))
+                if self.previous is not None and self._still(self.previous, image):
+                    self.stable += 1
+                else:
+                    self.stable = 0
+                self.previous = image
+                if self.stable < self.stablePolls: return None, now + self.pollInterval
+                self._settle(now)
+        return self.settled, None
+
+    @staticmethod
+    def _decode(image):
+        "Decode a snapshot to a grayscale array, or keep the JPEG data if that isn't possible"
+        if np is None or Image is None: return image
+        try:
+            return np.asarray(Image.open(io.BytesIO(image)).convert('L'), np.int16)
+        except (OSError, ValueError): # Not a JPEG Pillow can read, compare sizes
+            return image
+
+    def _still(self, previous, image):
+        "True if two consecutive snapshots show the same view"
+        decoded = np is not None and isinstance(image, np.ndarray), np is not None and isinstance(previous, np.ndarray)
+        if decoded == (True, True) and image.shape == previous.shape:
+            changed = np.count_nonzero(np.abs(image - previous) > self.pixelThreshold)
+            return changed <= self.threshold * image.size
+        if decoded == (False, False):
+            return abs(len(image) - len(previous)) <= self.threshold * max(len(image), len(previous))
+        return False
+
+    def _settle(self, when):
+        self.settled = when
+        self.cam.settled = when # Lets the driver cache snapshots of the view from now on
+        self.previous = None
+        if self.src is not None and self.dst is not None: self.seekTimes.record(self.src, self.dst, when - self.seekStart)
+
 class CameraAction:
     """A general class for camera actions to queue"""
     
@@ -20,6 +177,8 @@ class CameraAction:
         """
         self.cam = foscam
         self.expire = expire
+        self.start = None
+        self.hold = False
         
     def run(self):
         raise ValueError("CameraAction subclasses must implement run method")
@@ -28,68 +187,178 @@ class SnapshotAction:
     """An class to store the necessary information to execute 1 or more snapshots
     immediately or at a time in the future."""
     
-    def __init__(self, foscam, preset, callback, number=1, interval=0.0, expire=None, userdata=None):
+    def __init__(self, foscam, preset, callback, number=1, interval=0.0, expire=None, userdata=None, settle=None):
         """Setup the action closure.
         @param foscam driver object
         @param preset Preset to take snapshots at
         @param callback Function to call with image data
-               arguments will be (image data, final image, userdata)
+               arguments will be (image data, preset, final image, userdata)
         @param number Count of snapshots to take
         @param interval If number > 1, interval between snapshots
         @param expire If time passes expire, delete the task
+        @param settle FixedSettle or SettleDetector deciding when the camera has stopped moving
         """
         self.cam      = foscam
+        self.settle   = FixedSettle(foscam) if settle is None else settle
         self.preset   = preset
-        self.callback = callbakc
+        self.subscribers = [(callback, userdata, expire)]
         self.number   = number
         self.interval = interval
         self.expire   = expire
-        self.userdata = userdata
-        self.nextTime = 0.0
+        self.queued   = None  # (priority, handle) while waiting in the scheduler queue
+        self.nextTime = 0.0   # When the next snapshot is due, 0.0 for as soon as possible
+        self.taken    = None  # When the last snapshot was requested from the camera
+        self.start    = None  # Earliest time the scheduler should run this action again
+        self.hold     = False # Keep the camera at the preset between runs
+        self.seeking  = False # Moved the camera and waiting for it to settle
+
+    def merge(self, callback, userdata=None, expire=None):
+        """Add another requester to a single snapshot, they will all be called back with the same image.
+        Must only be called while the action is waiting in the scheduler queue.
+        @return False if this action can't take more requests"""
+        if self.number != 1: return False
+        self.subscribers.append((callback, userdata, expire))
+        if self.expire is not None: self.expire = None if expire is None else max(self.expire, expire)
+        return True
         
     def run(self):
-        """Run the snapshot action.
-        @return True if this action is done and can be removed from the queue.
-        False if the action has more to do."""
-        if self.expire is not None and time.time() > self.expire:
-            return False
-        elif time.time() < self.nextTime - SEEK_TIME: # Not ready to run yet, snooze to the scheduler
+        """Run the next step of the snapshot action.
+        Seeking is not done with a blocking sleep, the action asks the scheduler to run it again once the camera has
+        settled and holds the camera so lower priority actions don't move it away meanwhile.
+        @return True if the action has more to do and should be reposted to the scheduler queue.
+        False if the action is done and can be removed from the queue."""
+        now = time.time()
+        if self.cam.preset != self.preset: # Camera is elsewhere, seek and come back when it has settled
+            self.start = max(self.settle.seek(self.preset), self.nextTime)
+            self.hold = True
+            self.seeking = True
             return True
-        else:
-            self.cam.goto_preset(self.preset)
-            time.sleep(SEEK_TIME)
-            while self.number > 0:
-                self.callback(self.cam.snapshot(), self.preset, self.number==1, self.userdata)
-                self.number -= 1
-                if self.interval <= SEEK_TIME:
-                    time.sleep(self.interval)
-                else:
-                    self.nextTime = time.time() + self.interval - SEEK_TIME
-                    return True
+        settled, again = self.settle.check(now)
+        if settled is None: # Still moving
+            self.start = again
+            return True
+        if self.seeking:
+            SEEK_SECONDS.labels(getattr(self.cam, 'name', 'camera'), self.preset).observe(settled - self.cam.presetTime)
+            self.seeking = False
+        if now < self.nextTime: # Not due yet, wait here for it
+            self.start = self.nextTime
+            self.hold = True
+            return True
+        self.taken = time.time()
+        image = self.cam.snapshot()
+        final = self.number == 1
+        for callback, userdata, expire in self.subscribers:
+            if expire is None or now <= expire:
+                try:
+                    callback(image, self.preset, final, userdata)
+                except Exception as e: # The snapshot was taken, don't let one requester's failure take it again
+                    sys.stderr.write('Snapshot callback at preset %s failed: %s%s' % (self.preset, e, os.linesep))
+        self.number -= 1
+        if self.number <= 0:
+            self.hold = False
             return False
+        # Each snapshot is due an interval after the previous one was due, not after it was taken, so the series
+        # doesn't drift by the time each snapshot and its callbacks took. Snapshots missed by falling behind are skipped.
+        self.nextTime = (self.nextTime or now) + self.interval
+        if self.interval > 0.0 and self.nextTime <= now: self.nextTime += math.ceil((now - self.nextTime) / self.interval) * self.interval
+        if self.interval <= SEEK_TIME: # Stay here for the next one
+            self.start = self.nextTime
+            self.hold = True
+        else: # Let the camera go in the mean time and seek back in time for the next one
+            self.start = self.nextTime - SEEK_TIME
+            self.hold = False
+        return True
 
 
 
 class FoscamScheduler(scheduler.Scheduler):
     "A scheduler specific for a given foscam"
     
-    def __init__(self, foscam):
-        scheduler.Scheduler.__init__(self)
+    def __init__(self, foscam, coalesce=True, minimizeTravel=True, settle=None, engine=None, postprocessor=None, retries=3):
+        """Set up the scheduler
+        @param foscam driver object
+        @param coalesce Serve queued snapshot requests for the same preset with a single visit and image
+        @param minimizeTravel Among requests of equal priority prefer those which need the least camera movement
+        @param settle A SettleDetector to detect when seeks are done, None to always wait SEEK_TIME
+        @param engine scheduler.Engine shared with other cameras' schedulers, None for a thread of its own
+        @param postprocessor postprocess.PostProcessor for requests with outputs, may be shared between schedulers
+        @param retries Most times an action whose request failed to reach a camera with a circuit breaker is retried
+        """
+        scheduler.Scheduler.__init__(self, self.seekCost if minimizeTravel else None, getattr(foscam, 'name', 'camera'), engine)
         self.cam = foscam
+        self.settle = FixedSettle(foscam) if settle is None else settle
+        self.coalesce = coalesce
+        self.postprocessor = postprocessor
+        self.retries = retries
+        self.pending = {} # preset: single snapshot action which may take more requests
+
+    @property
+    def preset(self):
+        "The preset the camera is at, None if unknown"
+        return self.cam.preset
+
+    def seekCost(self, action):
+        "Relative cost of moving the camera to service an action, learned seek times are used when available"
+        return self.seekTime(self.cam.preset, getattr(action, 'preset', None))
+
+    def seekTime(self, src, dst):
+        "Expected seconds from commanding preset dst at preset src until the camera has settled, SEEK_TIME if unknown"
+        if src == dst: return 0.0
+        estimate = self.settle.seekTimes.estimate(src, dst) if self.settle.seekTimes else None
+        return SEEK_TIME if estimate is None else estimate
+
+    def posted(self, priority, task, handle):
+        if isinstance(task, SnapshotAction): task.queued = (priority, handle)
     
-    def snapshot(self, priority, preset, callback, expire=None, userdata=None):
+    def _callback(self, callback, outputs):
+        "The snapshot callback for a request, post processing the snapshots if it asked for outputs"
+        if outputs is None: return callback
+        if self.postprocessor is None: raise ValueError('Post processed outputs need a scheduler with a postprocessor')
+        return self.postprocessor.wrap(callback, outputs)
+
+    def snapshot(self, priority, preset, callback, expire=None, userdata=None, outputs=None):
         """Request a snapshot at a given preset.
         snapshots will go into the priority queue and execute when it is their
         turn. A snapshot will not be cancelled if another request with higher 
-        priority arrives while it is being executed.
+        priority arrives while it is being executed. A request for a preset which
+        already has a snapshot queued shares that snapshot, at the higher of the
+        two priorities.
         @param priority honor system priority number for this request, larger numbers = higher priority.
         @param preset The preset to take the picture at.
         @param callback Function to call with the photo data
         @param expire Latest time that the caller wants the photo. None for no expiration.
+        @param outputs Dictionary of output name: list of postprocess transforms to make of the photo in the
+               postprocessor, the callback is then called with a dictionary of output name: JPEG data instead of the
+               photo, once they are ready. None to call back with the photo.
+        @return The SnapshotAction which will take the photo, shared with other requests it was coalesced with
         """
-        self.append(priority, SnapshotAction(self.cam, preset, callback, expire=expire, userdata=userdata))
+        callback = self._callback(callback, outputs)
+        with self.cond:
+            action = self.pending.get(preset) if self.coalesce else None
+            if action is not None and action.queued is not None and action.queued[1][2] is action and action.merge(callback, userdata, expire):
+                if priority > action.queued[0]: self.reprioritize(action.queued[1], priority)
+                return action
+            action = SnapshotAction(self.cam, preset, callback, expire=expire, userdata=userdata, settle=self.settle)
+            self.pending[preset] = action
+            self.append(priority, action)
+            return action
     
-    def interval(self, priority, preset, callback, number, period, expire=None, userdata=None):
+    def snapshot_at(self, priority, preset, callback, when, expire=None, userdata=None, source=None):
+        """Request a snapshot at a given preset at a given time.
+        The camera is sent to the preset ahead of time, by the learned seek time from the source preset or SEEK_TIME if
+        there is none, and held there until the snapshot is taken. Timed requests are not coalesced with others.
+        @param when time.time() to take the snapshot at
+        @param source Preset the camera will be coming from, None for the one it is at now
+        @return The SnapshotAction, whose taken attribute is set to when the snapshot was requested from the camera
+                before the callback is called
+        """
+        action = SnapshotAction(self.cam, preset, callback, expire=expire, userdata=userdata, settle=self.settle)
+        action.nextTime = when
+        action.start = when - self.seekTime(self.cam.preset if source is None else source, preset)
+        self.append(priority, action)
+        return action
+
+    def interval(self, priority, preset, callback, number, period, expire=None, userdata=None, outputs=None):
         """Requests a series of snapshots at a given present.
         @param priority honor system priority number for this request, larger numbers = higher priority.
         @param preset The preset to take the picture at.
@@ -97,10 +366,27 @@ class FoscamScheduler(scheduler.Scheduler):
         @param number How many pictures to take.
         @param period How many seconds between pictures.
         @param expire Latest time that the caller wants the photo. None for no expiration.
+        @param outputs Post processed outputs to call back with instead of each photo, see snapshot
+        @return The SnapshotAction which will take the photos
         """
-        self.append(priority, SnapshotAction(self.cam, preset, callback, number, period, expire, userdata))
+        action = SnapshotAction(self.cam, preset, self._callback(callback, outputs), number, period, expire, userdata, self.settle)
+        self.append(priority, action)
+        return action
         
+    def failed(self, task, error):
+        """Retry an action whose request didn't reach a camera with a circuit breaker, after the breaker's back off, by
+        when a health.HealthMonitor will have paused the scheduler if the camera is down. Only transport failures are
+        retried, at most retries times and not past the action's expiry."""
+        if self.paused: return 0.0
+        breaker = getattr(self.cam, 'breaker', None)
+        if breaker is None or not isinstance(error, (IOError, OSError)) or getattr(error, 'code', None) is not None:
+            return None # Unmonitored, the camera answered or not a request failure
+        task.failures = getattr(task, 'failures', 0) + 1
+        expire = getattr(task, 'expire', None)
+        if task.failures > self.retries or (expire is not None and time.time() + breaker.reset_timeout > expire): return None
+        return breaker.reset_timeout
+
     def queueDone(self):
         "Action when there are no more requests on the camera"
-        self.cam.goto_preset(self.cam.defaultPreset)
+        if self.cam.preset != self.cam.defaultPreset: self.cam.goto_preset(self.cam.defaultPreset)
     
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Persistent HTTP/1.1 transport for talking to the camera CGI interface.
+The ConnectionPool class keeps a small number of keep-alive connections open to one camera host so that successive
+CGI requests do not each pay for a new TCP handshake.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import sys
+import time
+import socket
+import threading
+if sys.version_info.major > 2:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.error import HTTPError
+    from urllib.parse import urlsplit
+else:
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib2 import HTTPError
+    from urlparse import urlsplit
+
+# Errors which on a reused connection most likely mean the camera closed it while it sat idle in the pool
+STALE_ERRORS = (HTTPException, socket.error)
+
+class ConnectionPool(object):
+    """
+    A pool of persistent HTTP connections to a single host.
+    Idle connections are kept in LIFO order so the most recently used (and least likely to have been dropped by the
+    camera) is handed out first. Connections idle for longer than idle_timeout are closed rather than reused.
+    The pool is thread safe, if more threads make requests at once than there are pooled connections, extra connections
+    are opened and closed again when no space is left in the pool.
+    """
+
+    def __init__(self, url, maxsize=4, idle_timeout=30.0, timeout=10.0, retries=1):
+        """Set up an empty pool
+        @param url Base URL of the camera, e.g. http://192.168.1.10:8080
+        @param maxsize Maximum number of idle connections to keep open
+        @param idle_timeout Seconds after which an idle connection is discarded instead of reused
+        @param timeout Default socket timeout in seconds for each request
+        @param retries How many times to retry a request which failed on a stale reused connection
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'): raise ValueError('Unsupported URL scheme "%s"' % parts.scheme)
+        self.url = url
+        self.host = parts.hostname
+        self.port = parts.port
+        self.prefix = parts.path.rstrip('/')
+        self.connectionClass = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def __del__(self):
+        "Clean up safely."
+        self.close()
+
+    def __len__(self):
+        "Number of idle connections, thread safe but not garunteed consistant"
+        return len(self.idle)
+
+    def close(self):
+        "Close all idle connections."
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, lastUsed in idle:
+            conn.close()
+
+    def _new(self, timeout):
+        "Open a new connection"
+        return self.connectionClass(self.host, self.port, timeout=timeout)
+
+    def _get(self, timeout):
+        """Fetch an idle connection from the pool or make a new one.
+        @return (connection, reused)"""
+        expired = []
+        conn = None
+        now = time.time()
+        with self.lock:
+            while self.idle:
+                c, lastUsed = self.idle.pop()
+                if now - lastUsed > self.idle_timeout:
+                    expired.append(c)
+                else:
+                    conn = c
+                    break
+        for c in expired: c.close()
+        if conn is None:
+            return self._new(timeout), False
+        conn.timeout = timeout
+        if conn.sock is not None: conn.sock.settimeout(timeout)
+        return conn, True
+
+    def _put(self, conn):
+        "Return a connection to the pool or close it if the pool is full"
+        with self.lock:
+            if len(self.idle) < self.maxsize:
+                self.idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def _send(self, path, timeout):
+        """Send a GET request on a pooled connection, retrying on a fresh connection if a reused one turns out to be
+        stale.
+        @return (connection, response)"""
+        if timeout is None: timeout = self.timeout
+        attempt = 0
+        while True:
+            conn, reused = self._get(timeout)
+            try:
+                conn.request('GET', self.prefix + path)
+                return conn, conn.getresponse()
+            except STALE_ERRORS as e:
+                conn.close()
+                if isinstance(e, socket.timeout) or not reused or attempt >= self.retries: raise
+                attempt += 1
+
+    @staticmethod
+    def _check(path, response):
+        "Raise an HTTPError for non success responses"
+        if response.status != 200:
+            raise HTTPError(path, response.status, response.reason, response.msg, response)
+
+    def request(self, path, timeout=None):
+        """Make a GET request and return the response body.
+        @param path Path and query string relative to the pool's URL
+        @param timeout Socket timeout for this request, None for the pool default
+        """
+        conn, response = self._send(path, timeout)
+        try:
+            self._check(path, response)
+            body = response.read()
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._put(conn)
+        return body
+
+    def open(self, path, timeout=None):
+        """Make a GET request and return the response as a file handle for streaming.
+        The connection is not returned to the pool, it is closed when the caller closes the handle."""
+        conn, response = self._send(path, timeout)
+        # Hand the socket over to the response, it stays open until the response is closed
+        sock, conn.sock = conn.sock, None
+        if sock is not None: sock.close()
+        self._check(path, response)
+        return response
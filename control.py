@@ -2,13 +2,19 @@
 """A basic python interface for the FOSCAM IP cameras to control motion and
 parameters."""
 __author__="Daniel Casner <www.danielcasner.org>"
+import re
 import sys
+import time
+import socket
 from getpass import getpass
 if sys.version_info.major > 2:
-    from urllib.request import urlopen
     from urllib.parse   import urlencode
 else:
-    from urllib import urlopen, urlencode
+    from urllib import urlencode
+from connection import ConnectionPool
+import mjpeg
+import metrics
+from limiter import for_host, CONTROL, NORMAL, BULK
 
 VIDEO_RESOLUTIONS = {
     'VGA':  '32', 
@@ -62,145 +68,424 @@ PATROL_MODES = {
     'vertical+horizontal': '3',
 }
 
+REQUEST_SECONDS = metrics.REGISTRY.histogram('foscam_request_seconds', 'Time taken by camera CGI requests', ('camera', 'endpoint'))
+RESPONSE_BYTES = metrics.REGISTRY.counter('foscam_response_bytes_total', 'Bytes received in camera CGI responses', ('camera', 'endpoint'))
+REQUEST_ERRORS = metrics.REGISTRY.counter('foscam_request_errors_total', 'Failed camera CGI requests', ('camera', 'endpoint', 'reason'))
+
+def error_reason(error):
+    "Classify a request error for the errors metric as 'timeout', 'http' or 'connection'"
+    if isinstance(error, socket.timeout): return 'timeout'
+    if getattr(error, 'code', None) is not None: return 'http'
+    return 'connection'
+
+def request_metrics(cache, name, cgi):
+    """The latency and response size metric children of a camera's CGI call. They are kept in cache, a dictionary of
+    cgi: (name, latency, size), so requests skip the label lookups. They are looked up again if the name changes."""
+    children = cache.get(cgi)
+    if children is None or children[0] != name:
+        children = cache[cgi] = (name, REQUEST_SECONDS.labels(name, cgi), RESPONSE_BYTES.labels(name, cgi))
+    return children
+
+SETTLE_TIME = 20.0 # Seconds after commanding a preset by which the camera has surely stopped moving
+
+# Limiter lane of each CGI call, anything not listed goes in the NORMAL lane
+LANES = {
+    'decoder_control.cgi': CONTROL,
+    'get_params.cgi': BULK,
+    'get_misc.cgi': BULK,
+    'get_camera_params.cgi': BULK,
+    'get_log.cgi': BULK,
+}
+
+# One "var name=value;" assignment, the value either a quoted string or anything up to the semicolon
+VAR = re.compile(r"var\s+(\w+)\s*=\s*(?:'([^']*)';|([^;\r\n]*))")
+
+class Record(object):
+    """
+    Base class for the typed results of the camera's CGI calls.
+    Each subclass lists the variables it expects and their types in FIELDS, these are stored in slots and are None if
+    the camera didn't send them. Any other variables are kept in the extra dictionary. Records can also be used as read
+    only mappings of variable name to value. Records handed out by FoscamControl's result cache are copies, so changing
+    one doesn't change what later callers get.
+    """
+    __slots__ = ('extra',)
+    FIELDS = {}
+
+    def __init__(self):
+        self.extra = {}
+        for name in self.FIELDS: setattr(self, name, None)
+
+    def __getitem__(self, key):
+        if isinstance(key, bytes): key = key.decode('ascii')
+        if key in self.FIELDS: return getattr(self, key)
+        return self.extra[key]
+
+    def __contains__(self, key):
+        if isinstance(key, bytes): key = key.decode('ascii')
+        return (key in self.FIELDS and getattr(self, key) is not None) or key in self.extra
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return [name for name in self.FIELDS if getattr(self, name) is not None] + list(self.extra)
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        return isinstance(other, Record) and self.items() == other.items()
+
+    def _asdict(self):
+        return dict(self.items())
+
+    def copy(self):
+        "A copy of the record which can be changed without affecting this one"
+        other = type(self).__new__(type(self))
+        for name in self.FIELDS: setattr(other, name, getattr(self, name))
+        other.extra = dict(self.extra)
+        return other
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % item for item in self.items()))
+
+def record_type(name, fields, doc=None):
+    "Make a Record subclass with a slot for each of the fields, a dictionary of variable name: type"
+    return type(name, (Record,), {'__slots__': tuple(fields), 'FIELDS': fields, '__doc__': doc})
+
+StatusRecord = record_type('StatusRecord', {'id': str, 'sys_ver': str, 'app_ver': str, 'alias': str, 'now': int,
+    'tz': int, 'alarm_status': int, 'ddns_status': int, 'ddns_host': str, 'oray_type': int, 'upnp_status': int,
+    'p2p_status': int, 'p2p_local_port': int, 'msn_status': int, 'wifi_status': int}, "Result of get_status.cgi")
+CameraParamsRecord = record_type('CameraParamsRecord', {'resolution': int, 'brightness': int, 'contrast': int,
+    'mode': int, 'flip': int, 'fps': int}, "Result of get_camera_params.cgi")
+MiscRecord = record_type('MiscRecord', {'led_mode': int, 'ptz_center_onstart': int, 'ptz_auto_patrol_interval': int,
+    'ptz_auto_patrol_type': int, 'ptz_patrol_h_rounds': int, 'ptz_patrol_v_rounds': int, 'ptz_patrol_rate': int,
+    'ptz_patrol_up_rate': int, 'ptz_patrol_down_rate': int, 'ptz_patrol_left_rate': int, 'ptz_patrol_right_rate': int,
+    'ptz_disable_preset': int, 'ptz_preset_onstart': int}, "Result of get_misc.cgi")
+ParamsRecord = record_type('ParamsRecord', {'id': str, 'sys_ver': str, 'app_ver': str, 'alias': str, 'now': int,
+    'tz': int, 'ntp_enable': int, 'ntp_svr': str, 'ip': str, 'mask': str, 'gateway': str, 'dns': str, 'port': int,
+    'wifi_enable': int, 'wifi_ssid': str, 'ftp_svr': str, 'ftp_port': int, 'ftp_user': str, 'ftp_dir': str,
+    'ftp_mode': int, 'ftp_upload_interval': int, 'alarm_motion_armed': int, 'alarm_motion_sensitivity': int},
+    "Result of get_params.cgi, the many user, device, mail and alarm schedule settings are kept in extra")
+
+RECORDS = {
+    'get_status.cgi': StatusRecord,
+    'get_camera_params.cgi': CameraParamsRecord,
+    'get_misc.cgi': MiscRecord,
+    'get_params.cgi': ParamsRecord,
+}
+
+def parse_vars(raw, record=Record):
+    """Parse the javascript style \"var k=v;\" lines the camera CGI calls respond with in a single pass.
+    @param raw Response body
+    @param record Record class to decode into, values of its FIELDS are converted to the listed type
+    @return A record instance"""
+    values = {}
+    for k, quoted, v in VAR.findall(raw.decode('utf-8', 'replace')):
+        if v:
+            v = v.strip()
+            if v.isdigit() or (v[:1] == '-' and v[1:].isdigit()): v = int(v)
+            values[k] = v
+        else:
+            values[k] = quoted
+    ret = record.__new__(record)
+    for name, kind in record.FIELDS.items(): # Fill the slots once, what is left over is extra
+        v = values.pop(name, None)
+        if v is not None and type(v) is not kind:
+            try:
+                v = kind(v)
+            except ValueError: # Firmware sent something unexpected, keep it as is
+                pass
+        setattr(ret, name, v)
+    ret.extra = values
+    return ret
+
+def snapshot_args(resolution):
+    "Validate and build the snapshot.cgi arguments"
+    if not resolution in VIDEO_RESOLUTIONS.keys(): raise ValueError('resolution must be one of %s' % repr(VIDEO_RESOLUTIONS.keys()))
+    return {'resolution': VIDEO_RESOLUTIONS[resolution]}
+
+def videostream_args(resolution, rate, format):
+    "Validate and build the video stream CGI name and arguments"
+    if format == 'mjpeg':
+        cgi = 'videostream.cgi'
+    elif format == 'asf':
+        cgi = 'videostream.asf'
+    else:
+        raise ValueError('Unsupported format code, must be "mjpeg" or "asf".')
+    if not rate in VIDEO_RATES.keys():
+        raise ValueError('Unsupported frame rate, must be one of %s' % repr(VIDEO_RATES.keys()))
+    if not resolution in VIDEO_RESOLUTIONS.keys():
+        raise ValueError('Unsupported resolution, must be one of %s' % repr(VIDEO_RESOLUTIONS.keys()))
+    return cgi, {'resolution': VIDEO_RESOLUTIONS[resolution], 'rate': VIDEO_RATES[rate]}
+
+def control_args(command, onestep=None, degree=None):
+    "Build the decoder_control.cgi arguments for a motion command, a CONTROL_COMMANDS name or the camera's code"
+    args = {'command': CONTROL_COMMANDS.get(command, str(command))}
+    if onestep: args['onestep'] = '1'
+    if degree is not None: args['degree'] = str(degree)
+    return args
+
+def preset_args(preset, save=False):
+    "Build the decoder_control.cgi arguments to go to or save a numbered preset"
+    return {'command': str((30 if save else 31) + ((preset-1)*2))}
+
+def camera_control_args(resolution=None, brightness=None, contrast=None, mode=None, patrol=None):
+    "Validate and build the camera_control.cgi arguments, exactly one argument may be not None"
+    if resolution is not None:
+        if not resolution in VIDEO_RESOLUTIONS.keys(): raise ValueError("resolution must be None or one of %s" % repr(VIDEO_RESOLUTIONS.keys()))
+        args = {'param': '0', 'value': VIDEO_RESOLUTIONS[resolution]}
+    elif brightness is not None:
+        if brightness < 0 or brightness > 255: raise ValueError('brightness must be None or an int between 0 and 255')
+        args = {'param': '1', 'value': str(int(brightness))}
+    elif contrast is not None:
+        if contrast < 0 or contrast > 6: raise ValueError('contrast must be None or an int between 0 and 6')
+        args = {'param': '2', 'value': str(int(contrast))}
+    elif mode is not None:
+        if not mode in VIDEO_MODES.keys(): raise ValueError('mode must be None or one of %s' % repr(VIDEO_MODES.keys()))
+        args = {'param': '3', 'value': VIDEO_MODES[mode]}
+    elif patrol is not None:
+        if not patrol in PATROL_MODES.keys(): raise ValueError('patrol must be None or one of %s' % repr(PATROL_MODES.keys()))
+        args = {'param': '5', 'value': PATROL_MODES[patrol]}
+    else:
+        raise ValueError('Exactly one argument to this function must be not None')
+    return args
+
+def ftp_args(auth, server, user, password, directory, port=21, retain=False, interval=0):
+    "Build the set_ftp.cgi arguments, which take the camera credentials as cam_user and cam_pwd"
+    return {'svr': server, 'user': user, 'pwd': password, 'dir': directory, 'port': str(port), 'retain': str(int(retain)), 'upload_interval': str(interval), 'cam_user': auth['user'], 'cam_pwd': auth['pwd']}
+
 class FoscamControl(object):
 
-    def __init__(self, url, user, password, defaultPreset=1):
+    # Suggested cache_ttl for a camera only configured through this driver: these settings then only change through
+    # their setters. Status and get_params, which holds the camera's clock, change all the time so aren't cached.
+    CACHE_TTL = {
+        'get_camera_params.cgi': 300.0,
+        'get_misc.cgi': 300.0,
+    }
+
+    def __init__(self, url, user, password, defaultPreset=1, pool_size=4, idle_timeout=30.0, timeout=10.0, retries=1, snapshot_cache=None, cache_ttl=None, name=None, limiter=None, breaker=None, settle_time=SETTLE_TIME):
+        """Set up the camera driver
+        @param url Base URL of the camera, e.g. http://192.168.1.10:8080
+        @param user Camera user name
+        @param password Camera password, None to prompt for it
+        @param defaultPreset Preset the camera returns to when idle
+        @param pool_size Number of keep-alive connections to hold open to the camera
+        @param idle_timeout Seconds an unused connection is kept before it is discarded
+        @param timeout Socket timeout in seconds for each request
+        @param retries Number of times to retry a request which failed on a stale kept-alive connection
+        @param snapshot_cache Optional snapcache.SnapshotCache to serve recent snapshots from, may be shared by cameras
+        @param cache_ttl Dictionary of getter CGI name: seconds to cache its result for, e.g. CACHE_TTL, None to cache
+               nothing. Cached settings are dropped whenever the matching setter is called, but changes made by
+               anything else go unseen until they expire.
+        @param name Name of the camera in metrics, None for its URL
+        @param limiter limiter.HostLimiter to pace CGI requests with, None for the one shared by all users of the
+               camera's host or False for no limit. Video and log streams are not limited.
+        @param breaker health.CircuitBreaker to fail requests fast with while the camera is unreachable, None for none.
+               health.HealthMonitor gives the cameras it monitors one.
+        @param settle_time Seconds after goto_preset the camera is taken to be moving, and its snapshots not cached,
+               unless a settle detector marks it settled sooner
+        """
         self.url  = url
+        self.name = url if name is None else name
         if password is None: password = getpass('Password for %s@%s>' % (user, url))
         self.auth = {'user': user, 'pwd': password}
         self.defaultPreset = defaultPreset
+        self.preset = None     # Last preset commanded, None if unknown or moved since
+        self.presetTime = 0.0  # When the last preset was commanded
+        self.moves = 0         # Number of commands sent which moved the camera
+        self.settled = 0.0     # When the camera was last seen to have stopped moving, set by settle detection
+        self.settle_time = settle_time
+        self.pool = ConnectionPool(url, pool_size, idle_timeout, timeout, retries)
+        self.limiter = for_host(url) if limiter is None else (None if limiter is False else limiter)
+        self.breaker = breaker
+        self.snapshot_cache = snapshot_cache
+        self.cache_ttl = {} if cache_ttl is None else cache_ttl
+        self.results = {} # cgi: (time, record) cache of getter results
+        self.metric_children = {} # See request_metrics
 
-    @staticmethod
-    def _read_raw(url):
-        fh = urlopen(url)
-        retval = fh.read()
-        fh.close()
-        return retval
+    def _query(self, cgi, args=None):
+        "Build the request path for a CGI call with authentication"
+        query = dict(args) if args else {}
+        query.update(self.auth)
+        return '/%s?%s' % (cgi, urlencode(query))
+
+    def _read_raw(self, cgi, args=None, timeout=None):
+        return self._request(cgi, self._query(cgi, args), timeout)
+
+    def _request(self, cgi, path, timeout=None):
+        """Make a request once the limiter lets it start, recording its latency and response size or why it failed in
+        the metrics and the circuit breaker"""
+        breaker = self.breaker
+        if breaker is not None: breaker.before()
+        if self.limiter is not None: self.limiter.acquire(LANES.get(cgi, NORMAL))
+        start = time.time()
+        try:
+            body = self.pool.request(path, timeout)
+        except Exception as e:
+            reason = error_reason(e)
+            REQUEST_ERRORS.labels(self.name, cgi, reason).inc()
+            if breaker is not None:
+                if reason == 'http': # The camera answered
+                    breaker.success()
+                else:
+                    breaker.failure(time.time() - start)
+            raise
+        except BaseException: # Interrupted, whether the camera would have answered isn't known
+            if breaker is not None: breaker.abandon()
+            raise
+        finally:
+            if self.limiter is not None: self.limiter.release()
+        if breaker is not None: breaker.success()
+        name, seconds, size = request_metrics(self.metric_children, self.name, cgi)
+        seconds.observe(time.time() - start)
+        size.inc(len(body))
+        return body
     
-    @classmethod
-    def _read_and_parse(cls, url):
-        raw = cls._read_raw(url)
-        ret = {}
-        for l in raw.split(b'\n'):
-            if not (l.startswith(b'var ') and l.endswith(b';')): continue
-            k, v = l[4:-1].split(b'=')
-            if v.isdigit(): # and int
-                ret[k] = int(v)
-            elif v.startswith(b"'") and v.endswith(b"'"): # a string
-                ret[k] = v[1:-1]
-            else: # A ???
-                ret[k] = v
-        return ret
+    def _read_and_parse(self, cgi, args=None, timeout=None):
+        return parse_vars(self._read_raw(cgi, args, timeout), RECORDS.get(cgi, Record))
+
+    def _cached(self, cgi, refresh=False, timeout=None):
+        "Get the parsed result of a getter CGI call, from the result cache if it is fresh. Cached results are copied."
+        ttl = self.cache_ttl.get(cgi, 0.0)
+        entry = self.results.get(cgi)
+        if not refresh and entry is not None and time.time() - entry[0] <= ttl:
+            return entry[1].copy()
+        result = self._read_and_parse(cgi, timeout=timeout)
+        if ttl > 0.0: self.results[cgi] = (time.time(), result.copy())
+        return result
+
+    def invalidate(self, *cgis):
+        "Drop cached results of the named getter CGI calls, or of all of them if none are named"
+        for cgi in (cgis or list(self.results)): self.results.pop(cgi, None)
     
-    def snapshot(self, resolution='VGA'):
-        "Gets a still image (jpeg)"
-        if not resolution in VIDEO_RESOLUTIONS.keys(): raise ValueError('resolution must be one of %s' % repr(VIDEO_RESOLUTIONS.keys()))
-        else: return self._read_raw('%s/snapshot.cgi?user=%s&pwd=%s&resolution=%s' % (self.url, self.auth['user'], self.auth['pwd'], VIDEO_RESOLUTIONS[resolution]))
+    def snapshot(self, resolution='VGA', fresh=False):
+        """Gets a still image (jpeg)
+        @param resolution One of VIDEO_RESOLUTIONS
+        @param fresh Always fetch a new image, even if there is a snapshot cache"""
+        args = snapshot_args(resolution)
+        if self.snapshot_cache is None or fresh or not self.steady:
+            return self._read_raw('snapshot.cgi', args)
+        return self.snapshot_cache.get((self.url, resolution, self.preset, self.presetTime), lambda: self._read_raw('snapshot.cgi', args))
+
+    @property
+    def steady(self):
+        "True if the camera is known to be at a preset and to have stopped moving, so its snapshots may be cached"
+        return self.preset is not None and (self.settled >= self.presetTime or time.time() >= self.presetTime + self.settle_time)
+
+    def _moved(self):
+        "Forget the camera's position and its cached snapshots, it is moving somewhere"
+        self.moves += 1
+        self.preset = None
+        if self.snapshot_cache is not None: self.snapshot_cache.invalidate(lambda key: key[0] == self.url)
     
     def videostream(self, resolution='VGA', rate='full', format='mjpeg'):
         "Start a video stream and return the file handle"
-        if format == 'mjepg':
-            url = self.url + '/videostream.cgi?'
-        elif format == 'asf':
-            url = self.url + '/videostream.asf?'
-        else:
-            raise ValueError('Unsupported format code, must be "mjpeg" or "asf".')
-        if not rate in VIDEO_RATES.keys():
-            raise ValueError('Unsupported frame rate, must be one of %s' % repr(VIDEO_RATES.keys()))
-        if not resolution in VIDEO_RESOLUTIONS.keys():
-            raise ValueError('Unsupported resolution, must be one of %s' % repr(VIDEO_RESOLUTIONS.keys()))
-        args = {'resolution': resolution, 'rate': VIDEO_RATES[rate]}
-        args.update(self.auth)
-        return urlopen(url + urlencode(args))
+        cgi, args = videostream_args(resolution, rate, format)
+        return self.pool.open(self._query(cgi, args))
+
+    def frames(self, resolution='VGA', rate='full'):
+        """Generate mjpeg.Frames from an MJPEG video stream.
+        Each frame's data is a memoryview only valid until the next frame is requested, wrap the stream in a
+        mjpeg.FrameReader instead to keep frames or to drop frames when the consumer can't keep up."""
+        stream = self.videostream(resolution, rate, 'mjpeg')
+        try:
+            for frame in mjpeg.frames(stream):
+                yield frame
+        finally:
+            stream.close()
         
-    def get_status(self):
-        "Obtain device status"
-        return self._read_and_parse(self.url + '/get_status.cgi?' + urlencode(self.auth))
+    def get_status(self, refresh=False, timeout=None):
+        """Obtain device status
+        @param timeout Socket timeout for the request, None for the driver's"""
+        return self._cached('get_status.cgi', refresh, timeout)
         
-    def get_camera_params(self):
+    def get_camera_params(self, refresh=False):
         "Obtain current camera parameters"
-        return self._read_and_parse(self.url + '/get_camera_params.cgi?' + urlencode(self.auth))
+        return self._cached('get_camera_params.cgi', refresh)
         
     def control(self, command, onestep=None, degree=None):
         "Control's FOSCAM's motion hardware"
-        args = {'command': str(command)}
-        if onestep: args['onestep'] = '1'
-        if degree is not None: args['degree'] = str(degree)
-        args.update(self.auth) # Add authentication to call
-        return self._read_and_parse('%s/decoder_control.cgi?%s' % (self.url, urlencode(args)))
+        self._moved()
+        return self._read_and_parse('decoder_control.cgi', control_args(command, onestep, degree))
     
     def pan(self, degrees):
         "Command a horizontal movement, positive is right, negative is left"
         if degrees > 0.0:
-            return self.control(self.CONTROL_COMMANDS.RIGHT, degree=degrees)
-        elif:
-            return self.control(self.CONTROL_COMMANDS.LEFT, degree=-degrees)
+            return self.control('RIGHT', degree=degrees)
+        else:
+            return self.control('LEFT', degree=-degrees)
             
     def tilt(self, degrees):
         "Command vertical movement, positive is down, negative is up"
         if degrees > 0.0:
-            return self.control(self.CONTROL_COMMANDS.DOWN, degrees=degrees)
+            return self.control('DOWN', degree=degrees)
         else:
-            return self.control(self.CONTROL_COMMANDS.UP, degrees=-degrees)
+            return self.control('UP', degree=-degrees)
     
     def goto_preset(self, preset):
         "Go to numbered preset pan and tilt position"
-        args = {'command': str(31 + ((preset-1)*2))}
-        args.update(self.auth)
-        self._read_raw('%s/decoder_control.cgi?%s' % (self.url, urlencode(args)))
+        self._moved()
+        self._read_raw('decoder_control.cgi', preset_args(preset))
+        self.preset = preset
+        self.presetTime = time.time()
     
     def set_preset(self, preset):
         "Save the current pan and tilt position of the camera as a numbered preset"
-        args = {'command': str(30 + ((preset-1)*2))}
-        args.update(self.auth)
-        self._read_raw('%s/decoder_control.cgi?%s' % (self.url, urlencode(args)))
+        self._read_raw('decoder_control.cgi', preset_args(preset, save=True))
     
-    def camera_control(self, resolution=None, brightness=None, contrast=None, mode=None, partol=None):
+    def camera_control(self, resolution=None, brightness=None, contrast=None, mode=None, patrol=None):
         "Set a parameter for the camera sensor. Only one of: resolution, brightness, contrast, mode or patrol may be not None."
-        if resolution is not None:
-            if not resolution in VIDEO_RESOLUTIONS.keys(): raise ValueError("resolution must be None or one of %s" % repr(VIDEO_RESOLITIONS.keys()))
-            args = {'param': '0', 'value': VIDEO_RESOLUTIONS[resolution]}
-        elif brightness is not None:
-            if brightness < 0 or brightness > 255: raise ValueError('brightness must be None or an int between 0 and 255')
-            args = {'param': '1', 'value': str(int(brightness))}
-        elif contrast is not None:
-            if contrast < 0 or contrast > 6: raise ValueError('contrast must be None or an int between 0 and 6')
-            args = {'param': '2', 'value': str(int(contrast))}
-        elif mode is not None:
-            if not mode in VIDEO_MODES.keys(): raise ValueError('mode must be None or one of %s' % repr(VIDEO_MODES.keys()))
-            args = {'param': '3', 'value': VIDEO_MODES[mode]}
-        elif patrol is not None:
-            if not patrol in PATROL_MODES.keys(): raise ValueError('patrol must be None or one of %s' % repr(PATROL_MODES.keys()))
-            args = {'param': '5', 'value': PATROL_MODES[patrol]}
-        else:
-            raise ValueError('Exactly one argument to this function must be not None')
-        args.update(self.auth) # Add authentication to call
-        return self.read_and_parse('%s/camera_control.cgi?%s' % (self.url, urlencode(args)))
+        args = camera_control_args(resolution, brightness, contrast, mode, patrol)
+        self.invalidate('get_camera_params.cgi')
+        try:
+            return self._read_and_parse('camera_control.cgi', args)
+        finally: # Also drop anything a getter cached while the setting was being changed
+            self.invalidate('get_camera_params.cgi')
         
     def reboot(self):
         "Reboot the remote camera"
-        self._read_raw('%s/reboot.cgi?%s' % (self.url, urlencode(self.auth)))
+        self._moved()
+        self.invalidate()
+        self._read_raw('reboot.cgi')
+        self.pool.close() # The camera is going to drop all its connections anyway
         
-    def get_params(self):
+    def get_params(self, refresh=False):
         "Obtain device settings"
-        return self._read_and_parse('%s/get_params.cgi?%s' % (self.url, urlencode(self.auth)))
+        return self._cached('get_params.cgi', refresh)
         
     def set_ftp(self, server, user, password, directory, port=21, retain=False, interval=0):
         "Configure FTP upload settings"
-        args = {'svr': server, 'user': user, 'pwd': password, 'dir': directory, 'port': str(port), 'retain': str(int(retain)), 'upload_interval': str(interval), 'cam_user': self.auth['user'], 'cam_pwd': self.auth['pwd']}
-        self._read_daw('%s/set_ftp.cgi?%s' % (self.url, urlencode(args)))
+        self.invalidate('get_params.cgi')
+        try:
+            self._request('set_ftp.cgi', '/set_ftp.cgi?' + urlencode(ftp_args(self.auth, server, user, password, directory, port, retain, interval)))
+        finally:
+            self.invalidate('get_params.cgi')
         
-    def get_misc(self):
+    def get_misc(self, refresh=False):
         "Get camera misc parameter settings"
-        return self._read_and_parse('%s/get_misc.cgi?%s' % (self.url, urlencode(self.auth)))
+        return self._cached('get_misc.cgi', refresh)
         
     def set_misc(self, **args):
         "Set camera misc parameters"
-        args.update(self.auth)
-        self._read_raw('%s/set_misc.cgi?%s' % (self.url, urlencode(args)))
+        self.invalidate('get_misc.cgi')
+        try:
+            self._read_raw('set_misc.cgi', args)
+        finally:
+            self.invalidate('get_misc.cgi')
         
     def open_log(self):
         "Open a file pointer to the camera log, caller must read and close"
-        return urlopen('%s/get_log.cgi?%s' % (self.url, urlencode(self.auth)))
+        return self.pool.open(self._query('get_log.cgi'))
+
+    def get_log(self, timeout=None):
+        "Download the camera log, the raw get_log.cgi response. logtail.LogTail parses it and picks out new entries"
+        return self._read_raw('get_log.cgi', timeout=timeout)
 
         
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+A local stand in for a FOSCAM camera's CGI interface.
+The FoscamEmulator serves the same endpoints the FoscamControl driver uses with canned responses so the driver and
+everything built on it can be exercised without real hardware. Latency, preset seek time, video frame rate and failures
+can be dialled in to make it behave like a real camera on a real network.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import sys
+import time
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+BOUNDARY = b'ipcamera'
+
+def fake_jpeg(n, size=2048):
+    "Make a fake JPEG image numbered n: a SOI marker, size bytes of filler that never contains 0xFF and an EOI marker"
+    filler = bytes((n + i) % 0xFF for i in range(256))
+    body = (filler * (size // len(filler) + 1))[:size]
+    return b'\xff\xd8' + body + b'\xff\xd9'
+
+def mjpeg_part(frame):
+    "Frame a JPEG as one part of a multipart/x-mixed-replace video stream"
+    return b'--' + BOUNDARY + b'\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(frame) + frame + b'\r\n'
+
+def format_vars(values):
+    "Format a dictionary the way the camera CGI calls respond"
+    lines = []
+    for k, v in values.items():
+        if isinstance(v, int):
+            lines.append('var %s=%d;' % (k, v))
+        else:
+            lines.append("var %s='%s';" % (k, v))
+    return ('\n'.join(lines) + '\n').encode()
+
+class CameraHandler(BaseHTTPRequestHandler):
+    "Request handler for the emulated CGI calls, talks HTTP/1.1 with keep-alive"
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True # Headers and body are separate writes, don't let them wait on delayed ACKs
+
+    def setup(self):
+        self.timeout = self.server.idle_timeout # Drop idle keep-alive connections like the camera does
+        BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+        self.processing = False
+
+    def log_message(self, format, *args):
+        "Stay quiet unless the server is verbose"
+        if self.server.verbose: BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def done(self):
+        "Stop counting this request as being processed, once it starts sending its reply"
+        if self.processing:
+            self.processing = False
+            self.server.leave()
+
+    def reply(self, body, contentType='text/plain', status=200):
+        self.done()
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.count('requests')
+        if self.server.down: # Unreachable, the request hangs until the client gives up
+            self.server.count('hangs')
+            self.server.up.wait()
+            self.close_connection = True
+            return
+        parts = urlsplit(self.path)
+        args = {k: v[-1] for k, v in parse_qs(parts.query, keep_blank_values=True).items()}
+        cgi = parts.path.rsplit('/', 1)[-1]
+        if cgi == 'set_ftp.cgi':
+            user, pwd = args.get('cam_user'), args.get('cam_pwd')
+        else:
+            user, pwd = args.get('user'), args.get('pwd')
+        if user != self.server.user or pwd != self.server.password:
+            return self.reply(b'401 Unauthorized', status=401)
+        handler = getattr(self, 'cgi_' + cgi.replace('.', '_'), None)
+        if handler is None:
+            return self.reply(b'404 Not Found', status=404)
+        if not self.server.enter(): # Too many requests at once, the firmware gives up on this one
+            self.close_connection = True
+            return
+        self.processing = True
+        try:
+            failure = self.server.failure()
+            if failure == 'drop': # Hang up without answering, like a camera rebooting or a flaky link
+                self.close_connection = True
+                return
+            if self.server.latency: time.sleep(self.server.latency)
+            if failure == 'error':
+                return self.reply(b'500 Internal Server Error', status=500)
+            handler(args)
+        finally:
+            self.done()
+
+    def cgi_snapshot_cgi(self, args):
+        self.reply(self.server.snapshot(), 'image/jpeg')
+
+    def cgi_videostream_cgi(self, args):
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace;boundary=' + BOUNDARY.decode())
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        period = 1.0 / self.server.frame_rate if self.server.frame_rate else 0.0
+        next_frame = time.time()
+        try:
+            for n in range(self.server.stream_frames):
+                if period:
+                    next_frame += period
+                    delay = next_frame - time.time()
+                    if delay > 0.0: time.sleep(delay)
+                self.wfile.write(mjpeg_part(self.server.snapshot()))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def cgi_get_status_cgi(self, args):
+        self.reply(format_vars(self.server.status()))
+
+    def cgi_get_camera_params_cgi(self, args):
+        self.reply(format_vars(self.server.camera_params))
+
+    def cgi_decoder_control_cgi(self, args):
+        command = int(args.get('command', -1))
+        if command >= 30 and command % 2 == 0:
+            self.server.presets.add((command - 30) // 2 + 1)
+        elif command >= 31:
+            self.server.seek((command - 31) // 2 + 1)
+        else:
+            self.server.seek(None)
+        self.reply(b'ok.\n')
+
+    def cgi_camera_control_cgi(self, args):
+        self.server.camera_params[{'0': 'resolution', '1': 'brightness', '2': 'contrast', '3': 'mode', '5': 'patrol'}.get(args.get('param'), 'unknown')] = int(args.get('value', 0))
+        self.reply(b'ok.\n')
+
+    def cgi_get_params_cgi(self, args):
+        self.reply(format_vars(self.server.params))
+
+    def cgi_set_ftp_cgi(self, args):
+        self.server.params.update({'ftp_svr': args.get('svr', ''), 'ftp_port': int(args.get('port', 21)), 'ftp_user': args.get('user', ''), 'ftp_dir': args.get('dir', '')})
+        self.reply(b'ok.\n')
+
+    def cgi_get_misc_cgi(self, args):
+        self.reply(format_vars(self.server.misc))
+
+    def cgi_set_misc_cgi(self, args):
+        for k, v in args.items():
+            if k not in ('user', 'pwd'): self.server.misc[k] = int(v) if v.isdigit() else v
+        self.reply(b'ok.\n')
+
+    def cgi_get_log_cgi(self, args):
+        self.reply(("var log_text='%s';\n" % '\\n'.join(self.server.log)).encode())
+
+    def cgi_reboot_cgi(self, args):
+        self.close_connection = True
+        self.reply(b'ok.\n')
+
+
+class FoscamEmulator(ThreadingHTTPServer):
+    """An in process HTTP server which mimics a FOSCAM camera.
+    Use start() to serve from a background thread and url for the base URL to hand to FoscamControl."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, user='admin', password='', host='127.0.0.1', port=0, stream_frames=100, idle_timeout=None, latency=0.0,
+                 seek_time=0.0, frame_rate=None, error_rate=0.0, drop_rate=0.0, seed=None, max_concurrent=None, verbose=False):
+        """Set up the emulated camera
+        @param user User name the camera accepts
+        @param password Password the camera accepts
+        @param host Interface to listen on
+        @param port TCP port to listen on, 0 to pick a free one
+        @param stream_frames Number of frames served per videostream request
+        @param idle_timeout Seconds before an idle keep-alive connection is dropped, None to keep them forever
+        @param latency Seconds the camera takes to process each CGI request
+        @param seek_time Seconds the camera moves for after being sent to a preset, snapshots taken while it moves all
+               differ in size the way a real moving image does
+        @param frame_rate Video stream frames per second, None to send them as fast as possible
+        @param error_rate Fraction of CGI requests answered with a 500 error
+        @param drop_rate Fraction of CGI requests the camera hangs up on without answering
+        @param seed Seed for the failure injection random numbers, for repeatable runs
+        @param max_concurrent Most CGI requests handled at once, the camera hangs up on any more, None for no limit
+        @param verbose Log each request to stderr
+        """
+        ThreadingHTTPServer.__init__(self, (host, port), CameraHandler)
+        self.user = user
+        self.password = password
+        self.stream_frames = stream_frames
+        self.idle_timeout = idle_timeout
+        self.latency = latency
+        self.seek_time = seek_time
+        self.frame_rate = frame_rate
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        self.verbose = verbose
+        self.thread = None
+        self.lock = threading.Lock()
+        self.counters = {'connections': 0, 'requests': 0, 'errors': 0, 'drops': 0, 'overloads': 0, 'seeks': 0, 'hangs': 0}
+        self.up = threading.Event() # Cleared while the camera is off the network
+        self.up.set()
+        self.frame = 0
+        self.preset = 1
+        self.moving_until = 0.0
+        self.presets = {1}
+        self.camera_params = {'resolution': 32, 'brightness': 128, 'contrast': 4, 'mode': 1, 'flip': 0, 'fps': 0}
+        self.params = {'id': '000DC5D0ABCD', 'alias': 'emulator', 'ftp_svr': '', 'ftp_port': 21, 'ftp_user': '', 'ftp_dir': ''}
+        self.misc = {'led_mode': 0, 'ptz_center_onstart': 1, 'ptz_auto_patrol_interval': 0, 'ptz_auto_patrol_type': 0, 'ptz_patrol_h_rounds': 0, 'ptz_patrol_v_rounds': 0, 'ptz_disable_preset': 0, 'ptz_preset_onstart': 1}
+        self.log = ['Mon, 2013-01-07 12:00:00 admin 127.0.0.1 access']
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def handle_error(self, request, client_address):
+        "Clients hanging up are routine, only report them if verbose"
+        if self.verbose: ThreadingHTTPServer.handle_error(self, request, client_address)
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def enter(self):
+        "Start handling a request, returns False if the camera is overloaded"
+        with self.lock:
+            if self.max_concurrent is not None and self.active >= self.max_concurrent:
+                self.counters['overloads'] += 1
+                return False
+            self.active += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+
+    def failure(self):
+        "Decide whether to inject a failure into a request, returns 'drop', 'error' or None"
+        if not (self.error_rate or self.drop_rate): return None
+        with self.lock:
+            r = self.random.random()
+            if r < self.drop_rate:
+                self.counters['drops'] += 1
+                return 'drop'
+            if r < self.drop_rate + self.error_rate:
+                self.counters['errors'] += 1
+                return 'error'
+        return None
+
+    def seek(self, preset):
+        "Start moving to a preset, or stop at an unknown position if it is None"
+        with self.lock:
+            self.preset = preset
+            self.counters['seeks'] += 1
+            self.moving_until = time.time() + self.seek_time if preset is not None else 0.0
+
+    @property
+    def down(self):
+        "True while the camera is off the network, set it to start or end an outage"
+        return not self.up.is_set()
+
+    @down.setter
+    def down(self, down):
+        if down:
+            self.up.clear()
+        else:
+            self.up.set()
+
+    @property
+    def moving(self):
+        return time.time() < self.moving_until
+
+    def snapshot(self):
+        with self.lock:
+            self.frame += 1
+            n = self.frame
+        if self.moving: return fake_jpeg(n, 1024 + n * 997 % 4096)
+        return fake_jpeg(n, 2048 + 64 * (self.preset or 0))
+
+    def status(self):
+        return {'id': self.params['id'], 'sys_ver': '11.37.2.49', 'app_ver': '2.0.10.7', 'alias': self.params['alias'], 'now': int(time.time()), 'tz': 0, 'alarm_status': 0, 'ddns_status': 0, 'upnp_status': 0}
+
+    def start(self):
+        "Serve requests from a background thread"
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        "Stop serving and close the listening socket"
+        self.up.set() # Let hung requests finish
+        self.shutdown()
+        self.server_close()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Emulate a FOSCAM camera')
+    parser.add_argument('port', type=int, nargs='?', default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to process each request')
+    parser.add_argument('--seek-time', type=float, default=0.0, help='Seconds to move to a preset')
+    parser.add_argument('--frame-rate', type=float, default=None, help='Video stream frames per second')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests to fail with a 500')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Fraction of requests to hang up on')
+    options = parser.parse_args()
+    emulator = FoscamEmulator(port=options.port, latency=options.latency, seek_time=options.seek_time, frame_rate=options.frame_rate,
+                              error_rate=options.error_rate, drop_rate=options.drop_rate, verbose=True)
+    sys.stdout.write('Emulating a FOSCAM at %s (user "admin", empty password)\n' % emulator.url)
+    emulator.serve_forever()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Bulk operations across many cameras.
+The FoscamFleet holds a set of named FoscamControl instances and fans operations out to all of them concurrently on a
+bounded pool of worker threads, reporting each camera's result as soon as it finishes.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import time
+from functools import partial
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait, FIRST_COMPLETED
+
+FleetResult = namedtuple('FleetResult', ['name', 'value', 'error', 'elapsed'])
+FleetResult.__doc__ = "The outcome of an operation on one camera, error is None if it succeeded"
+
+class FoscamFleet(object):
+    "A collection of named cameras which bulk operations run against concurrently"
+
+    def __init__(self, cameras=None, workers=32, timeout=10.0):
+        """Set up the fleet
+        @param cameras Dictionary of name: FoscamControl instances
+        @param workers Maximum number of cameras to talk to at once
+        @param timeout Seconds each camera is given to complete an operation once it has started
+        """
+        self.cameras = dict(cameras) if cameras else {}
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(workers)
+
+    def __len__(self):
+        return len(self.cameras)
+
+    def __getitem__(self, name):
+        return self.cameras[name]
+
+    def __iter__(self):
+        return iter(self.cameras)
+
+    def add(self, name, camera):
+        "Add a camera to the fleet"
+        self.cameras[name] = camera
+
+    def remove(self, name):
+        "Remove a camera from the fleet"
+        del self.cameras[name]
+
+    def close(self):
+        "Shut down the worker threads, waiting for running operations to finish"
+        self.executor.shutdown()
+
+    @staticmethod
+    def _call(started, name, call):
+        started[name] = time.time()
+        return call()
+
+    def run(self, fn, names=None, timeout=None):
+        """Run fn(camera) for every camera concurrently.
+        A camera which doesn't finish within timeout of starting is reported with a TimeoutError, its worker is freed
+        once the underlying request times out.
+        @param fn Function to call with each FoscamControl
+        @param names Names of the cameras to run on, None for all of them
+        @param timeout Seconds each camera is allowed, None for the fleet default
+        @return Generator of FleetResults in the order the cameras finish
+        """
+        return self.run_calls(dict((name, partial(fn, self.cameras[name])) for name in (self.cameras.keys() if names is None else names)), timeout)
+
+    def run_calls(self, calls, timeout=None):
+        """Run calls concurrently, like run but for calls which aren't a function of the camera alone
+        @param calls Dictionary of name: function to call with no arguments, the names needn't be cameras of the fleet
+        @param timeout Seconds each call is allowed, None for the fleet default
+        @return Generator of FleetResults in the order the calls finish"""
+        if timeout is None: timeout = self.timeout
+        started = {}
+        pending = {}
+        for name, call in calls.items():
+            pending[self.executor.submit(self._call, started, name, call)] = name
+        return self._results(pending, started, timeout)
+
+    @staticmethod
+    def _results(pending, started, timeout):
+        "Yield FleetResults for a dictionary of future: name as they finish or time out"
+        while pending:
+            starts = [started[name] for name in pending.values() if name in started]
+            wait_time = max(0.0, min(starts) + timeout - time.time()) if starts else timeout
+            done, not_done = wait(pending, wait_time, FIRST_COMPLETED)
+            now = time.time()
+            for future in done:
+                name = pending.pop(future)
+                elapsed = now - started[name]
+                error = future.exception()
+                yield FleetResult(name, None if error else future.result(), error, elapsed)
+            for future in not_done:
+                name = pending[future]
+                if name in started and now - started[name] >= timeout:
+                    del pending[future]
+                    yield FleetResult(name, None, TimeoutError('Camera "%s" timed out after %.1f seconds' % (name, timeout)), now - started[name])
+
+    def snapshot_all(self, resolution='VGA', names=None, timeout=None):
+        "Take a snapshot on every camera at once, yields FleetResults with the JPEG data as each camera finishes"
+        return self.run(lambda camera: camera.snapshot(resolution), names, timeout)
+
+    def get_status_all(self, names=None, timeout=None):
+        "Get the status of every camera, yields FleetResults as each camera finishes"
+        return self.run(lambda camera: camera.get_status(), names, timeout)
+
+    def goto_preset_all(self, preset, names=None, timeout=None):
+        """Send every camera to a preset, yields FleetResults as each camera finishes
+        @param preset A preset number for all cameras or a dictionary of name: preset"""
+        if isinstance(preset, dict):
+            return self.run_calls(dict((name, partial(self.cameras[name].goto_preset, preset[name])) for name in (preset.keys() if names is None else names)), timeout)
+        return self.run(lambda camera: camera.goto_preset(preset), names, timeout)
+
+    def set_misc_all(self, names=None, timeout=None, **args):
+        "Set misc parameters on every camera, yields FleetResults as each camera finishes"
+        return self.run(lambda camera: camera.set_misc(**args), names, timeout)
+
@@ -2,61 +2,327 @@
 """
 An MQTT node that runs a camera scheduler for one or more foscams.
 The camera scheduler takes care of managing the use of the cameras
+Requests are taken off the MQTT network thread into an intake queue, where identical requests still pending are
+ignored, and snapshots are handed from the scheduler threads to a bounded delivery queue so neither a slow broker nor a
+burst of requests holds up the cameras.
+Snapshots are published as a JSON header, a NUL and the JPEG, which copies the JPEG into the framed payload. With MQTT v5
+the header goes in user properties instead and the JPEG is published as it is, saving that copy.
 """
 __author__ = "Daniel Casner <www.danielcasner.org>"
 
-import sys, os, json
+import sys, os, json, time
+import threading
+from collections import deque
 import camscheduler
+import metrics
 import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+
+PUBLISH_SECONDS = metrics.REGISTRY.histogram('camqtt_publish_seconds', 'Time taken to publish a snapshot to the broker', ('camera',))
+DELIVERY_SECONDS = metrics.REGISTRY.histogram('camqtt_delivery_seconds', 'Time from a snapshot being taken to it being published', ('camera',))
+DELIVERY_DROPPED = metrics.REGISTRY.counter('camqtt_delivery_dropped_total', 'Snapshots dropped because the delivery queue was full', ('camera',))
+DUPLICATE_REQUESTS = metrics.REGISTRY.counter('camqtt_duplicate_requests_total', 'Requests ignored as identical to one still pending', ('camera',))
+
+_headers = {} # (preset, final): encoded header, there are only a few of them
+
+def snapshot_header(preset, final):
+    "The JSON header of a snapshot payload"
+    header = _headers.get((preset, final))
+    if header is None:
+        header = _headers[(preset, final)] = json.dumps({'preset': preset, 'final': final}).encode()
+    return header
+
+def parse_snapshot(msg):
+    """Split a snapshot message into its header and image
+    @return (header dictionary, JPEG as a memoryview of the payload)"""
+    properties = getattr(msg, 'properties', None)
+    user = dict(getattr(properties, 'UserProperty', None) or ()) if properties is not None else {}
+    if 'preset' in user:
+        return {'preset': json.loads(user['preset']), 'final': json.loads(user['final'])}, memoryview(msg.payload)
+    split = msg.payload.index(b'\0')
+    return json.loads(msg.payload[:split].decode()), memoryview(msg.payload)[split + 1:]
+
+class Delivery(object):
+    """
+    A bounded queue of snapshots between the camera schedulers and the MQTT client, published by a worker thread.
+    When the broker can't keep up the policy decides what happens: 'drop' discards the oldest queued snapshot, 'block'
+    makes the scheduler handing over a snapshot wait for room, holding that camera up until the broker catches up.
+    """
+
+    POLICIES = ('drop', 'block')
+
+    def __init__(self, publish, maxsize=64, policy='drop'):
+        """Start the worker
+        @param publish Function of (camera, preset, final, snapshot) which publishes a snapshot and waits until it is sent
+        @param maxsize Most snapshots to queue
+        @param policy 'drop' or 'block'
+        """
+        if policy not in self.POLICIES: raise ValueError('policy must be one of %s' % repr(self.POLICIES))
+        self.publish = publish
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.running = True
+        self.sending = False
+        self.delivered = 0
+        self.dropped = 0
+        self.errors = 0
+        self.thread = threading.Thread(target=self._work, name='camqtt delivery')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def put(self, camera, preset, final, snapshot):
+        """Queue a snapshot for publishing
+        @return False if the delivery queue is closed"""
+        with self.cond:
+            while self.policy == 'block' and self.running and len(self.queue) >= self.maxsize:
+                self.cond.wait()
+            if not self.running: return False
+            if len(self.queue) >= self.maxsize:
+                DELIVERY_DROPPED.labels(self.queue.popleft()[0]).inc()
+                self.dropped += 1
+            self.queue.append((camera, preset, final, snapshot, time.time()))
+            self.cond.notify_all()
+        return True
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while self.running and not self.queue: self.cond.wait()
+                if not self.queue: return
+                camera, preset, final, snapshot, taken = self.queue.popleft()
+                self.sending = True
+                self.cond.notify_all()
+            try:
+                self.publish(camera, preset, final, snapshot)
+                self.delivered += 1
+                DELIVERY_SECONDS.labels(camera).observe(time.time() - taken)
+            except Exception as e:
+                self.errors += 1
+                sys.stderr.write('Publishing a snapshot of "%s" failed: %s%s' % (camera, e, os.linesep))
+            with self.cond:
+                self.sending = False
+                self.cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until everything queued has been published.
+        @return False if timeout passed first"""
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.queue and not self.sending, timeout)
+
+    def close(self):
+        "Publish what is queued and stop the worker"
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+
+class _Scheduler(camscheduler.FoscamScheduler):
+    "A camera's scheduler, telling the server about requests whose actions failed"
+
+    def __init__(self, server, foscam, engine):
+        camscheduler.FoscamScheduler.__init__(self, foscam, engine=engine)
+        self.server = server
+
+    def dropped(self, task, error):
+        for callback, userdata, expire in getattr(task, 'subscribers', ()):
+            if callback == self.server.on_snapshot: self.server.finished(userdata[1])
 
 class CamqttServer(mqtt.Client):
     "ISA MQTT client, HAS several cam schedulers"
 
     REQUEST_SUFFIX = "_request"
+    SNAPSHOT_SUFFIX = "_snapshot"
 
     def on_snapshot(self, snapshot, preset, final, userdata):
-        self.publish(userdata, json.dumps({'preset': preset, 'final': final}).encode() + b'\0' + snapshot)
+        "Scheduler callback, hands the snapshot to the delivery queue"
+        camera, key = userdata
+        if final:
+            action = self.finished(key)
+            if action is not None:
+                if self.last.get(camera) == (action, action.taken): return # Requests merged into one action share its image and topic
+                self.last[camera] = (action, action.taken)
+        self.delivery.put(camera, preset, final, snapshot)
+
+    def finished(self, key):
+        """Forget a request which is done or failed, so identical ones are taken again
+        @return The request's SnapshotAction, None if unknown"""
+        with self.intakeCond:
+            self.pending.pop(key, None)
+            return self.actions.pop(key, None)
 
-    def on_connect(self, userdata, flags, rc):
+    def publish_snapshot(self, camera, preset, final, snapshot):
+        """Publish a snapshot and wait for it to be handed to the network, runs on the delivery thread. With MQTT v3.1.1
+        the header and JPEG are joined into one payload, a copy of the JPEG, as paho needs the payload in one piece."""
+        start = time.time()
+        if self._protocol == mqtt.MQTTv5:
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.UserProperty = [('preset', json.dumps(preset)), ('final', json.dumps(final))]
+            info = self.publish(camera + self.SNAPSHOT_SUFFIX, snapshot, self.qos, properties=properties)
+        else:
+            info = self.publish(camera + self.SNAPSHOT_SUFFIX, b''.join((snapshot_header(preset, final), b'\0', snapshot)), self.qos)
+        if info is not None: info.wait_for_publish(self.publish_timeout)
+        PUBLISH_SECONDS.labels(camera).observe(time.time() - start)
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         "Subscribe to topics on connect in case of disconnection"
         for camName in self.schedulers.keys():
-            self.subscribe(name + self.REQUEST_SUFFIX, qos=2)
-            
-    def on_message(self, userdata, msg):
-        if not msg.topic.endswith(self.REQUEST_SUFFIX):
-            sys.stderr.write("Received unexpected topic: \"{}\"{}".format(msg.topic, os.linesep))
-        else:
-            camera = msg.topic[:-len(self.REQUEST_SUFFIX)]
-            if not camera in self.schedulers:
-                sys.stderr.write("Received request for camera \"{}\" but we only have{linesep}\t{}{linesep}".format(camera, repr(self.schedulers.keys(), linesep=os.linesep)))
+            self.subscribe(camName + self.REQUEST_SUFFIX, qos=2)
+
+    def on_message(self, client, userdata, msg):
+        "Queue a request for the intake thread unless an identical one is still pending, runs on the network thread"
+        key = (msg.topic, bytes(msg.payload))
+        now = time.time()
+        with self.intakeCond:
+            if now - self.purged > self.dedupe_timeout: # Forget requests whose snapshots never arrived
+                self.pending = dict((k, t) for k, t in self.pending.items() if now < t)
+                self.actions = dict((k, a) for k, a in self.actions.items() if k in self.pending)
+                self.purged = now
+            deadline = self.pending.get(key)
+            if deadline is not None and now < deadline:
+                DUPLICATE_REQUESTS.labels(msg.topic[:-len(self.REQUEST_SUFFIX)]).inc()
+                self.duplicates += 1
+                return
+            self.pending[key] = now + self.dedupe_timeout # Until the request is parsed and its expiry known
+            self.intake.append(key)
+            self.intakeCond.notify()
+
+    def _intake(self):
+        while True:
+            with self.intakeCond:
+                while self.running and not self.intake: self.intakeCond.wait()
+                if not self.intake: return
+                key = self.intake.popleft()
+            if not self.request(key): self.finished(key)
+
+    def request(self, key):
+        """Parse a request and hand it to its camera's scheduler, runs on the intake thread
+        @param key (topic, payload) of the request message
+        @return False if the request was invalid"""
+        topic, payload = key
+        if not topic.endswith(self.REQUEST_SUFFIX):
+            sys.stderr.write("Received unexpected topic: \"{}\"{}".format(topic, os.linesep))
+            return False
+        camera = topic[:-len(self.REQUEST_SUFFIX)]
+        if not camera in self.schedulers:
+            sys.stderr.write("Received request for camera \"{}\" but we only have{linesep}\t{}{linesep}".format(camera, repr(list(self.schedulers.keys())), linesep=os.linesep))
+            return False
+        try:
+            command, args = json.loads(payload)
+            args.update({'callback': self.on_snapshot, 'userdata': (camera, key)})
+            if command not in ('snapshot', 'interval', 'internal'): # 'internal' was accepted for interval by older versions
+                raise ValueError("Invalid scheduler command: " + command)
+            with self.intakeCond: # A request which expires stops blocking identical ones when it does
+                if args.get('expire') is not None and key in self.pending: self.pending[key] = min(self.pending[key], args['expire'])
+            if command == 'snapshot':
+                action = self.schedulers[camera].snapshot(**args)
             else:
-                try:
-                    command, args = json.loads(msg.payload)
-                    args.update({'callback': self.on_snapshot, 'userdata': cammera})
-                    if command == 'snapshot':
-                        self.schedulers[camera].snapshot(**args)
-                    elif command == 'internal':
-                        self.schedulers[camera].interval(**args)
-                    else:
-                        raise ValueError("Invalid scheduler command: " + command)
-                except Exception as e:
-                    sys.stderr.write(str(e))
-    
-    
-    def __init__(self, clientID, broker, cameras):
+                action = self.schedulers[camera].interval(**args)
+        except Exception as e:
+            sys.stderr.write(str(e) + os.linesep)
+            return False
+        with self.intakeCond:
+            if key in self.pending: self.actions[key] = action # Not if it finished already
+        return True
+
+
+    def __init__(self, clientID, broker, cameras, engine=None, queue_size=64, policy='drop', qos=0, publish_timeout=10.0, dedupe_timeout=300.0, protocol=mqtt.MQTTv311):
         """Initalize camera server
         @param clientID The MQTT client ID for the server
-        @param The host name / IP address of the broker
+        @param broker The host name / IP address of the broker, None to connect later
         @param cameras A dictionary of named foscam instances. The names of the cameras be used as base names for MQTT
         topics for requesting and receiving images. The server will subscribe to a topic <NAME>_request for each camera
         to receive snapshot requests. Snapshots will be published as <NAME>_snapshot
+        @param engine scheduler.Engine to run every camera's scheduler on, None for a thread per busy camera
+        @param queue_size Most snapshots waiting to be published
+        @param policy What to do when the delivery queue is full, see Delivery
+        @param qos QoS to publish snapshots with
+        @param publish_timeout Most seconds to wait for each snapshot to be sent before publishing the next
+        @param dedupe_timeout Seconds after which a request without an expiry whose snapshot never arrived no longer
+               blocks identical ones. Requests with an expiry stop blocking when they expire, and failed ones at once.
+        @param protocol MQTT protocol version, mqtt.MQTTv5 publishes snapshots without framing them
         """
-        mqtt.Client.__init__(self, clientID, True)
-        self.schedulers = {name: camscheduler.FoscamScheduler(camera) for name, camera in cameras.items()}
-        self.connect(broker)
+        mqtt.Client.__init__(self, clientID, None if protocol == mqtt.MQTTv5 else True, protocol=protocol)
+        for name, camera in cameras.items(): camera.name = name # Label the camera's metrics with its topic name
+        self.schedulers = {name: _Scheduler(self, camera, engine) for name, camera in cameras.items()}
+        self.qos = qos
+        self.publish_timeout = publish_timeout
+        self.dedupe_timeout = dedupe_timeout
+        self.delivery = Delivery(self.publish_snapshot, queue_size, policy)
+        self.last = {} # camera: (SnapshotAction, time taken) of the last final snapshot delivered
+        self.pending = {} # (topic, payload): time until which identical requests are ignored, of requests not finished yet
+        self.actions = {} # (topic, payload): SnapshotAction of requests not finished yet
+        self.purged = time.time()
+        self.duplicates = 0
+        self.intake = deque()
+        self.intakeCond = threading.Condition()
+        self.running = True
+        self.intakeThread = threading.Thread(target=self._intake, name='camqtt intake')
+        self.intakeThread.daemon = True
+        self.intakeThread.start()
+        if broker is not None: self.connect(broker)
+
+    def close(self):
+        "Stop taking requests and publish the snapshots already queued"
+        with self.intakeCond:
+            self.running = False
+            self.intakeCond.notify_all()
+        self.intakeThread.join()
+        self.delivery.close()
 
 class CamqttClient(mqtt.Client):
     "ISA MQTT client for requesting scheduled snapshots"
-    
-    def on_connect(self, userdata, flags, rc):
-        
+
+    def __init__(self, clientID, broker=None, protocol=mqtt.MQTTv311):
+        """Initalize camera client
+        @param clientID The MQTT client ID for the client
+        @param broker The host name / IP address of the broker, None to connect later
+        @param protocol MQTT protocol version
+        """
+        mqtt.Client.__init__(self, clientID, None if protocol == mqtt.MQTTv5 else True, protocol=protocol)
+        self.callbacks = {} # camera: callback
+        if broker is not None: self.connect(broker)
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        "Subscribe to the snapshots of the cameras being watched, again in case of disconnection"
+        for camName in self.callbacks.keys():
+            self.subscribe(camName + CamqttServer.SNAPSHOT_SUFFIX)
+
+    def on_message(self, client, userdata, msg):
+        if not msg.topic.endswith(CamqttServer.SNAPSHOT_SUFFIX): return
+        camera = msg.topic[:-len(CamqttServer.SNAPSHOT_SUFFIX)]
+        callback = self.callbacks.get(camera)
+        if callback is None: return
+        try:
+            header, image = parse_snapshot(msg)
+        except ValueError as e:
+            sys.stderr.write("Bad snapshot from \"{}\": {}{}".format(camera, e, os.linesep))
+            return
+        callback(camera, image, header['preset'], header['final'])
+
+    def watch(self, camera, callback):
+        """Receive a camera's snapshots
+        @param callback Function to call with (camera, JPEG, preset, final image) for every snapshot of the camera,
+               including those other clients asked for. The JPEG is a memoryview of the message."""
+        self.callbacks[camera] = callback
+        self.subscribe(camera + CamqttServer.SNAPSHOT_SUFFIX)
+
+    def _request(self, camera, command, args):
+        return self.publish(camera + CamqttServer.REQUEST_SUFFIX, json.dumps([command, args]), qos=2)
+
+    def snapshot(self, camera, priority, preset, expire=None):
+        """Request a snapshot, see FoscamScheduler.snapshot. Use watch to receive it."""
+        args = {'priority': priority, 'preset': preset}
+        if expire is not None: args['expire'] = expire
+        return self._request(camera, 'snapshot', args)
+
+    def interval(self, camera, priority, preset, number, period, expire=None):
+        """Request a series of snapshots, see FoscamScheduler.interval. Use watch to receive them."""
+        args = {'priority': priority, 'preset': preset, 'number': number, 'period': period}
+        if expire is not None: args['expire'] = expire
+        return self._request(camera, 'interval', args)
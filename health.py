@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Camera health monitoring and circuit breaking.
+A camera which drops off the network makes every request to it hang until the socket times out, stalling whoever made
+it. A CircuitBreaker per camera counts consecutive failed requests and once there are enough opens, failing every
+request straight away with CameraUnavailable. After a back off it lets a single probe request through, half open, and
+closes again if that succeeds. The HealthMonitor polls each camera's get_status in the background, often while a
+camera is failing and less often while it is steady, pauses the camera's scheduler while its breaker is open and sends
+the camera back to its default preset when it recovers.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import os
+import sys
+import time
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+CLOSED = 'closed'       # Requests go through
+OPEN = 'open'           # Requests fail straight away
+HALF_OPEN = 'half-open' # One probe request is going through to see if the camera is back
+
+BREAKER_STATE = metrics.REGISTRY.gauge('foscam_breaker_open', '1 while the circuit breaker of a camera is open or half open', ('camera',))
+OUTAGE_SECONDS = metrics.REGISTRY.histogram('foscam_outage_seconds', 'Time camera circuit breakers stayed open', ('camera',),
+                                            buckets=(1.0, 5.0, 15.0, 30.0, 60.0, 300.0, 900.0, 3600.0))
+REJECTED = metrics.REGISTRY.counter('foscam_breaker_rejected_total', 'Requests failed straight away by an open circuit breaker', ('camera',))
+
+class CameraUnavailable(IOError):
+    "Raised instead of making a request to a camera whose circuit breaker is open"
+    pass
+
+class CircuitBreaker(object):
+    """
+    Closed / open / half open circuit breaker for the requests to one camera.
+    Call before ahead of each request and success, failure or abandon after it, FoscamControl does this when given a
+    breaker.
+    Only failures to reach the camera should be reported as failures, an HTTP error status means the camera is up. The
+    back off before each probe doubles while probes keep failing. Listeners are called with (breaker, old state, new
+    state) on the thread whose request changed the state.
+    """
+
+    def __init__(self, failures=2, reset_timeout=2.0, max_reset_timeout=60.0, name='camera'):
+        """Set up a closed breaker
+        @param failures Consecutive failed requests which open the breaker
+        @param reset_timeout Seconds open before the first probe
+        @param max_reset_timeout Longest back off between probes
+        @param name Name of the camera in metrics
+        """
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.name = name
+        self.state = CLOSED
+        self.failed = 0          # Consecutive failures
+        self.backoff = reset_timeout
+        self.opened = 0.0        # When the breaker last opened, or a probe last failed
+        self.tripped = 0.0       # When the breaker opened from closed, the start of the outage
+        self.closed = 0.0        # When the breaker last closed
+        self.firstFailure = None # When the current run of failures started
+        self.lastSuccess = 0.0   # When a request last succeeded
+        self.probing = False
+        self.wasted = 0.0        # Seconds spent in requests which failed
+        self.outages = 0
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.gauge = BREAKER_STATE.labels(name)
+        self.rejected = REJECTED.labels(name)
+
+    def _set(self, state, now):
+        "Change state, called with the lock held. @return (old, new) for _notify"
+        old = self.state
+        self.state = state
+        if state == OPEN and old == CLOSED:
+            self.opened = self.tripped = now
+            self.outages += 1
+        elif state == CLOSED:
+            self.closed = now
+            OUTAGE_SECONDS.labels(self.name).observe(now - self.tripped)
+        self.gauge.set(0 if state == CLOSED else 1)
+        return old, state
+
+    def _notify(self, change):
+        if change is None or change[0] == change[1]: return
+        for listener in list(self.listeners): listener(self, change[0], change[1])
+
+    def allow(self):
+        "True if a request may go to the camera now, the first one after the back off while open is the probe"
+        with self.lock:
+            if self.state == CLOSED: return True
+            if self.state == OPEN and time.time() >= self.opened + self.backoff and not self.probing:
+                self.probing = True
+                self._set(HALF_OPEN, time.time())
+                change = (OPEN, HALF_OPEN)
+            else:
+                self.rejected.inc()
+                return False
+        self._notify(change)
+        return True
+
+    def before(self):
+        "Check a request may be made, raises CameraUnavailable if not"
+        if not self.allow(): raise CameraUnavailable('%s is unavailable, circuit breaker %s' % (self.name, self.state))
+
+    def success(self):
+        "Record a request which reached the camera"
+        change = None
+        with self.lock:
+            now = time.time()
+            self.failed = 0
+            self.firstFailure = None
+            self.lastSuccess = now
+            self.probing = False
+            self.backoff = self.reset_timeout
+            if self.state != CLOSED: change = self._set(CLOSED, now)
+        self._notify(change)
+
+    def failure(self, elapsed=0.0):
+        """Record a request which failed to reach the camera
+        @param elapsed Seconds the request took to fail"""
+        change = None
+        with self.lock:
+            now = time.time()
+            self.failed += 1
+            self.wasted += elapsed
+            if self.firstFailure is None: self.firstFailure = now - elapsed
+            if self.state == HALF_OPEN: # Probe failed, back off further
+                self.probing = False
+                self.backoff = min(self.max_reset_timeout, self.backoff * 2.0)
+                self.opened = now
+                change = self._set(OPEN, now)
+            elif self.state == CLOSED and self.failed >= self.failures:
+                change = self._set(OPEN, now)
+        self._notify(change)
+
+    def abandon(self):
+        """Record a request given up on before it was known whether it reached the camera, e.g. a cancelled one. A probe
+        which is abandoned leaves the breaker open for another probe after the same back off."""
+        change = None
+        with self.lock:
+            if self.state == HALF_OPEN:
+                now = time.time()
+                self.probing = False
+                self.opened = now
+                change = self._set(OPEN, now)
+        self._notify(change)
+
+    @property
+    def available(self):
+        return self.state == CLOSED
+
+class CameraHealth(object):
+    "The health monitor's view of one camera"
+
+    def __init__(self, name, foscam, scheduler, breaker, interval):
+        self.name = name
+        self.cam = foscam
+        self.scheduler = scheduler
+        self.breaker = breaker
+        self.interval = interval # Current seconds between polls
+        self.due = 0.0
+        self.polling = False
+        self.recovering = False
+        self.polls = 0
+        self.recoveries = 0
+        self.error = None
+
+    @property
+    def state(self):
+        return self.breaker.state
+
+class HealthMonitor(object):
+    """
+    Polls the health of many cameras in the background and reacts to their circuit breakers.
+    Each camera is polled with a short timeout get_status call. The interval between polls starts at min_interval and
+    grows by half each time the camera answers, up to max_interval, and drops back to min_interval on any failure.
+    Requests from other users which succeeded count as polls, so busy cameras are hardly polled at all. While a
+    camera's breaker is open it is polled at the breaker's back off so polls are its probes.
+    When the breaker opens the camera's scheduler, if any, is paused. Tasks stay queued, and one which was running
+    when its request failed is queued again. Once the breaker closes the camera is sent to its default preset and the
+    scheduler resumed.
+    """
+
+    def __init__(self, min_interval=1.0, max_interval=30.0, timeout=2.0, failures=2, reset_timeout=2.0, max_reset_timeout=60.0, workers=4):
+        """Start the monitor thread
+        @param min_interval Seconds between polls of a camera which is failing or has just been added
+        @param max_interval Most seconds between polls of a healthy camera
+        @param timeout Socket timeout of each poll
+        @param failures, reset_timeout, max_reset_timeout Settings of the CircuitBreakers created for cameras without one
+        @param workers Most polls running at once
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.breakerArgs = (failures, reset_timeout, max_reset_timeout)
+        self.cameras = {} # name: CameraHealth
+        self.due = [] # Heap of (time, sequence, name), stale unless time is the camera's due time
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
+        self.executor = ThreadPoolExecutor(workers)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='health monitor')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, name, foscam, scheduler=None):
+        """Start monitoring a camera, giving it a circuit breaker if it doesn't have one
+        @param foscam driver object
+        @param scheduler The camera's scheduler.Scheduler to pause while it is down
+        @return The camera's CameraHealth"""
+        if getattr(foscam, 'breaker', None) is None:
+            foscam.breaker = CircuitBreaker(*self.breakerArgs, name=getattr(foscam, 'name', name))
+        health = CameraHealth(name, foscam, scheduler, foscam.breaker, self.min_interval)
+        foscam.breaker.listeners.append(self._changed)
+        with self.cond:
+            if name in self.cameras: raise ValueError('Already monitoring "%s"' % name)
+            self.cameras[name] = health
+            self._schedule(health, time.time())
+        return health
+
+    def remove(self, name):
+        "Stop monitoring a camera, its breaker stays in place"
+        with self.cond:
+            health = self.cameras.pop(name)
+        health.breaker.listeners.remove(self._changed)
+
+    def __getitem__(self, name):
+        return self.cameras[name]
+
+    def close(self):
+        "Stop monitoring, waiting for polls in progress"
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+        self.executor.shutdown()
+
+    def _schedule(self, health, when):
+        "Poll a camera at a time, called with cond held"
+        health.due = when
+        heapq.heappush(self.due, (when, next(self.sequence), health.name))
+        self.cond.notify()
+
+    def _changed(self, breaker, old, new):
+        "Breaker listener, runs on the thread whose request changed the state"
+        with self.cond:
+            health = next((h for h in self.cameras.values() if h.breaker is breaker), None)
+            if health is None: return
+            if new == OPEN:
+                if health.scheduler is not None: health.scheduler.pause()
+                self._schedule(health, breaker.opened + breaker.backoff)
+            elif new == CLOSED:
+                health.recovering = True
+                health.interval = self.min_interval
+                self._schedule(health, time.time())
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.running:
+                    now = time.time()
+                    if self.due and self.due[0][0] <= now: break
+                    self.cond.wait(self.due[0][0] - now if self.due else None)
+                if not self.running: return
+                when, sequence, name = heapq.heappop(self.due)
+                health = self.cameras.get(name)
+                if health is None or health.due != when or health.polling: continue
+                health.polling = True
+            self.executor.submit(self._poll, health)
+
+    def _poll(self, health):
+        "Poll a camera, or finish its recovery, and schedule the next poll"
+        breaker = health.breaker
+        now = time.time()
+        try:
+            if health.recovering:
+                self._recover(health)
+                next_poll = now + health.interval
+            elif breaker.state == CLOSED and now - breaker.lastSuccess < health.interval:
+                next_poll = breaker.lastSuccess + health.interval # Someone else's request showed it is up
+            else:
+                health.polls += 1
+                try:
+                    health.cam.get_status(refresh=True, timeout=self.timeout)
+                    health.interval = min(self.max_interval, health.interval * 1.5)
+                except CameraUnavailable: # Open and not due a probe, or another request is probing
+                    pass
+                except Exception as e:
+                    health.error = e
+                    health.interval = self.min_interval
+                if breaker.state == CLOSED:
+                    next_poll = time.time() + health.interval
+                elif breaker.state == OPEN:
+                    next_poll = breaker.opened + breaker.backoff
+                else:
+                    next_poll = time.time() + self.min_interval
+        except Exception as e:
+            sys.stderr.write('Health check of "%s" failed: %s%s' % (health.name, e, os.linesep))
+            next_poll = time.time() + self.min_interval
+        with self.cond:
+            health.polling = False
+            if health.name in self.cameras:
+                self._schedule(health, min(next_poll, health.due) if health.due > now else next_poll) # Keep any sooner poll asked for meanwhile
+
+    def _recover(self, health):
+        "Put a camera which has come back to its default preset and let its scheduler run again"
+        cam = health.cam
+        health.recovering = False
+        cam.preset = None # Unknown after the outage, the camera may have rebooted
+        try:
+            cam.goto_preset(cam.defaultPreset)
+        except Exception as e:
+            health.error = e
+            if health.breaker.state == CLOSED: health.recovering = True # Retry unless the breaker reopened
+            return
+        health.recoveries += 1
+        if health.scheduler is not None: health.scheduler.resume()
+
+    @property
+    def stats(self):
+        "Dictionary of camera name: dictionary of its breaker state, outages, polls, recoveries and wasted seconds"
+        with self.cond:
+            cameras = list(self.cameras.values())
+        return dict((h.name, {'state': h.state, 'outages': h.breaker.outages, 'polls': h.polls, 'recoveries': h.recoveries,
+                              'wasted_s': h.breaker.wasted, 'interval_s': h.interval}) for h in cameras)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Request rate limiting and concurrency governing for the cameras.
+FOSCAM firmware falls over when it gets too many CGI requests at once. A HostLimiter combines a token bucket, which
+bounds the request rate, with a limit on requests in flight. Requests wait in priority lanes so PTZ commands go ahead of
+bulk polls. One limiter is shared by every thread and asyncio task talking to a camera host, see for_host.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+from contextlib import contextmanager
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+# Priority lanes, requests in a higher lane are always let through first
+CONTROL = 2 # Interactive PTZ commands
+NORMAL  = 1 # Snapshots, status and settings
+BULK    = 0 # Background polls of parameters and logs
+
+class HostLimiter(object):
+    """
+    Token bucket rate limiter plus in flight limit for the requests to one camera host.
+    A request may start once a token is available and fewer than max_inflight requests are running. Waiting requests
+    are served highest lane first, then in arrival order. Threads use acquire / release or the slot context manager,
+    asyncio tasks use aacquire / release or aslot, both may wait on the same limiter at once.
+    """
+
+    def __init__(self, rate=None, burst=1, max_inflight=4, clock=time.time):
+        """Set up the limiter
+        @param rate Requests per second allowed on average, None for no rate limit
+        @param burst Most requests allowed back to back after an idle period
+        @param max_inflight Most requests running at once, None for no limit
+        @param clock Function returning the time in seconds, tokens are refilled and timeouts measured by it
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_inflight = max_inflight
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.inflight = 0
+        self.waiting = [] # Heap of [-lane, sequence, wake, granted] waiters, wake is None once given up on
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        "Number of requests waiting, thread safe but not garunteed consistant"
+        return len(self.waiting)
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _take(self):
+        "Start a request straight away if nobody is waiting and there is room, called with the lock held"
+        if self.waiting: return False
+        self._refill(self.clock())
+        if (self.max_inflight is not None and self.inflight >= self.max_inflight) or (self.rate is not None and self.tokens < 1.0):
+            return False
+        if self.rate is not None: self.tokens -= 1.0
+        self.inflight += 1
+        return True
+
+    def _dispatch(self, caller=None):
+        """Let waiting requests start while there is room, called with the lock held.
+        @return Seconds until a token is available for the first waiter if that is what it waits for, otherwise None"""
+        self._refill(self.clock())
+        while self.waiting:
+            head = self.waiting[0]
+            if head[2] is None: # Gave up waiting
+                heapq.heappop(self.waiting)
+                continue
+            if self.max_inflight is not None and self.inflight >= self.max_inflight:
+                return None # Woken again by release
+            if self.rate is not None and self.tokens < 1.0:
+                if head is not caller: head[2]() # Have it wait for the token itself
+                return (1.0 - self.tokens) / self.rate
+            heapq.heappop(self.waiting)
+            if self.rate is not None: self.tokens -= 1.0
+            self.inflight += 1
+            head[3] = True
+            head[2]()
+        return None
+
+    def _enqueue(self, lane, wake):
+        "Add a waiter, called with the lock held"
+        waiter = [-lane, next(self.sequence), wake, False]
+        heapq.heappush(self.waiting, waiter)
+        return waiter
+
+    def acquire(self, lane=NORMAL, timeout=None):
+        """Wait until a request may start, from a thread.
+        @param lane CONTROL, NORMAL or BULK
+        @param timeout Most seconds to wait, None to wait as long as it takes
+        @raise TimeoutError if timeout passes first"""
+        with self.lock:
+            if self._take(): return
+        event = threading.Event()
+        deadline = None if timeout is None else self.clock() + timeout
+        with self.lock:
+            waiter = self._enqueue(lane, event.set)
+            delay = self._dispatch(waiter)
+        while True:
+            if deadline is not None:
+                delay = max(0.0, deadline - self.clock()) if delay is None else max(0.0, min(delay, deadline - self.clock()))
+            event.wait(delay)
+            with self.lock:
+                event.clear()
+                delay = None if waiter[3] else self._dispatch(waiter)
+                if waiter[3]: return
+                if deadline is not None and self.clock() >= deadline:
+                    waiter[2] = None
+                    raise TimeoutError('Timed out waiting for a request slot')
+
+    async def aacquire(self, lane=NORMAL, timeout=None):
+        "Wait until a request may start, from an asyncio task, see acquire"
+        with self.lock:
+            if self._take(): return
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        wake = lambda: loop.call_soon_threadsafe(event.set)
+        deadline = None if timeout is None else self.clock() + timeout
+        with self.lock:
+            waiter = self._enqueue(lane, wake)
+            delay = self._dispatch(waiter)
+        try:
+            while True:
+                if deadline is not None:
+                    delay = max(0.0, deadline - self.clock()) if delay is None else max(0.0, min(delay, deadline - self.clock()))
+                try:
+                    await asyncio.wait_for(event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                with self.lock:
+                    event.clear()
+                    delay = None if waiter[3] else self._dispatch(waiter)
+                    if waiter[3]: return
+                    if deadline is not None and self.clock() >= deadline:
+                        waiter[2] = None
+                        raise TimeoutError('Timed out waiting for a request slot')
+        except asyncio.CancelledError:
+            with self.lock:
+                if waiter[3]: # Granted as the task was cancelled, hand the slot on
+                    self.inflight -= 1
+                    self._dispatch()
+                waiter[2] = None
+            raise
+
+    def release(self):
+        "Finish a request started with acquire or aacquire"
+        with self.lock:
+            self.inflight -= 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, lane=NORMAL, timeout=None):
+        "Context manager running its body as one request"
+        self.acquire(lane, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def aslot(self, lane=NORMAL, timeout=None):
+        "Asynchronous context manager running its body as one request"
+        return _AsyncSlot(self, lane, timeout)
+
+class _AsyncSlot(object):
+
+    def __init__(self, limiter, lane, timeout):
+        self.limiter = limiter
+        self.lane = lane
+        self.timeout = timeout
+
+    async def __aenter__(self):
+        await self.limiter.aacquire(self.lane, self.timeout)
+
+    async def __aexit__(self, *exc):
+        self.limiter.release()
+
+_hosts = {}
+_hostsLock = threading.Lock()
+
+def for_host(url, rate=None, burst=1, max_inflight=4):
+    """Get the limiter shared by everything talking to the host of a camera URL, creating it with the given limits if
+    this is the first use of the host. Later calls return the existing limiter unchanged, set its rate, burst and
+    max_inflight attributes to retune it."""
+    parts = urlsplit(url)
+    key = (parts.hostname, parts.port)
+    with _hostsLock:
+        limiter = _hosts.get(key)
+        if limiter is None:
+            limiter = _hosts[key] = HostLimiter(rate, burst, max_inflight)
+        return limiter
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Following camera logs.
+get_log.cgi only ever returns the whole log, as a javascript string of one entry per line, oldest first. A LogTail
+remembers the last few entries it has seen of a camera and finds them again in each new download with a single search
+of the raw response, only the entries after them are decoded and parsed, so the work done per poll is in proportion to
+what was added rather than the size of the log. A FleetLogTail follows the logs of every camera of a fleet.FoscamFleet
+concurrently.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import re
+import os
+import sys
+import time
+import threading
+from functools import partial
+from collections import namedtuple
+import metrics
+
+LOG_TEXT = re.compile(br"var\s+log_text\s*=\s*'")
+LOG_END = b"';"
+ENTRY = re.compile(r'^(?:\w+,\s*)?(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\s+(\S+)\s+(\S+)\s*(.*)$')
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+LOG_ENTRIES = metrics.REGISTRY.counter('foscam_log_entries_total', 'New camera log entries read', ('camera',))
+
+LogEntry = namedtuple('LogEntry', ['time', 'user', 'address', 'event', 'raw'])
+LogEntry.__doc__ = """An entry of a camera log. time is in seconds since the epoch, taking the camera's clock to be in
+local time. Lines which aren't in the usual "day, date time user address event" form have only raw and event set."""
+
+def parse_entry(line):
+    "Parse one line of the camera log into a LogEntry"
+    match = ENTRY.match(line)
+    if match is None: return LogEntry(None, None, None, line, line)
+    stamp, user, address, event = match.groups()
+    try:
+        when = time.mktime(time.strptime(stamp, TIME_FORMAT))
+    except ValueError:
+        when = None
+    return LogEntry(when, user, address, event, line)
+
+def log_span(raw):
+    """Find the log text in a get_log.cgi response
+    @return (start, end, separator) of the text in raw and the bytes between its lines, either a javascript escaped
+            or a literal newline"""
+    match = LOG_TEXT.search(raw)
+    if match is None: return 0, len(raw), b'\n' # Not javascript, take it as plain text
+    start = match.end()
+    end = raw.rfind(LOG_END, start)
+    if end < 0: end = len(raw)
+    return start, end, b'\\n' if raw.find(b'\\n', start, end) >= 0 else b'\n'
+
+def split_lines(raw, start, end, separator):
+    "Non empty lines of raw[start:end], as bytes"
+    if start >= end: return []
+    return [line for line in raw[start:end].split(separator) if line.strip()]
+
+class LogTail(object):
+    """
+    Follows the log of one camera, returning only the entries added since the last poll.
+    The last anchor entries seen are searched for in each download, the entries after their last occurrence are new.
+    If they aren't found, because the log was cleared or wrapped around past them, entries newer than the newest seen
+    are new. state is a JSON serializable dictionary which can be given to a new LogTail to carry on where this one
+    left off, e.g. after a restart.
+    """
+
+    def __init__(self, foscam, history=True, anchor=3, state=None, name=None):
+        """Set up the tail
+        @param foscam driver object, or anything with a get_log method
+        @param history Return the entries already in the log on the first poll, otherwise only later ones
+        @param anchor Number of entries to search for, more make it less likely that repeats of the same entries are
+               mistaken for the last ones seen
+        @param state A state saved from a LogTail of the same camera to carry on from
+        @param name Name of the camera in metrics, None for the driver's name
+        """
+        self.cam = foscam
+        self.anchor = anchor
+        self.name = getattr(foscam, 'name', 'camera') if name is None else name
+        self.lines = [] # The last anchor raw lines seen, newest last
+        self.time = None # Time of the newest entry seen
+        self.history = history
+        self.started = False # Whether the log has been seen before
+        self.lock = threading.Lock()
+        self.entries = LOG_ENTRIES.labels(self.name)
+        if state is not None:
+            self.lines = [line.encode('latin-1') for line in state['lines']] # Raw bytes, which latin-1 maps one to one
+            self.time = state['time']
+            self.started = True
+
+    @property
+    def state(self):
+        "Dictionary to save and give to a new LogTail to carry on from"
+        return {'lines': [line.decode('latin-1') for line in self.lines], 'time': self.time}
+
+    def poll(self, timeout=None):
+        """Download the camera's log
+        @return List of the LogEntries added since the last poll, oldest first"""
+        return self.feed(self.cam.get_log(timeout=timeout))
+
+    def _find(self, raw, start, end, separator):
+        "Where the new entries start in raw, None if the last entries seen aren't in it"
+        anchor = separator.join(self.lines)
+        search = end
+        while True:
+            at = raw.rfind(anchor, start, search)
+            if at < 0: return None
+            after = at + len(anchor)
+            if (at == start or raw[at - len(separator):at] == separator) and (after == end or raw[after:after + len(separator)] == separator):
+                return min(end, after + len(separator))
+            search = after - 1
+
+    def feed(self, raw):
+        """Pick out the new entries of a get_log.cgi response
+        @return List of the LogEntries added since the response last fed, oldest first"""
+        with self.lock:
+            start, end, separator = log_span(raw)
+            at = self._find(raw, start, end, separator) if self.lines else None
+            if at is not None:
+                lines = split_lines(raw, at, end, separator)
+                entries = [parse_entry(line.decode('utf-8', 'replace')) for line in lines]
+                self.lines = (self.lines + lines)[-self.anchor:]
+            else:
+                lines = split_lines(raw, start, end, separator)
+                if not self.started and not self.history:
+                    entries = []
+                else:
+                    entries = [parse_entry(line.decode('utf-8', 'replace')) for line in lines]
+                    if self.started and self.time is not None: # The log was cleared or wrapped, take anything newer as new
+                        seen = set(self.lines) # Entries from the newest second seen are new unless they were seen
+                        entries = [entry for line, entry in zip(lines, entries) if entry.time is not None and
+                                   (entry.time > self.time or (entry.time == self.time and line not in seen))]
+                if lines: self.lines = lines[-self.anchor:]
+            self.started = True
+            for line in reversed(lines[-self.anchor:]):
+                when = parse_entry(line.decode('utf-8', 'replace')).time
+                if when is not None:
+                    self.time = when if self.time is None else max(self.time, when)
+                    break
+            self.entries.inc(len(entries))
+            return entries
+
+    def follow(self, interval=60.0, stop=None, timeout=None):
+        """Poll the camera's log every interval seconds, yielding each new LogEntry as it is found. Polls which fail
+        are reported on stderr and tried again at the next interval.
+        @param stop threading.Event which ends the generator when set, None to follow forever"""
+        if stop is None: stop = threading.Event()
+        due = time.time()
+        while not stop.is_set():
+            try:
+                for entry in self.poll(timeout):
+                    yield entry
+            except Exception as e:
+                sys.stderr.write('Reading the log of "%s" failed: %s%s' % (self.name, e, os.linesep))
+            due += interval
+            stop.wait(max(0.0, due - time.time()))
+
+class FleetLogTail(object):
+    """
+    Follows the logs of all the cameras of a fleet.FoscamFleet, polling them concurrently on the fleet's workers.
+    Cameras added to the fleet are picked up on the next poll.
+    """
+
+    def __init__(self, fleet, history=True, anchor=3, states=None):
+        """Set up the tails
+        @param fleet fleet.FoscamFleet of the cameras
+        @param history, anchor See LogTail
+        @param states Dictionary of camera name: LogTail state saved from state to carry on from
+        """
+        self.fleet = fleet
+        self.history = history
+        self.anchor = anchor
+        self.states = dict(states) if states else {}
+        self.tails = {} # name: LogTail
+
+    def tail(self, name):
+        "The LogTail of a camera of the fleet"
+        tail = self.tails.get(name)
+        if tail is None:
+            tail = self.tails[name] = LogTail(self.fleet[name], self.history, self.anchor, self.states.pop(name, None), name)
+        return tail
+
+    @property
+    def state(self):
+        "Dictionary of camera name: LogTail state, to give to a new FleetLogTail to carry on from"
+        states = dict(self.states)
+        states.update((name, tail.state) for name, tail in self.tails.items())
+        return states
+
+    def poll(self, names=None, timeout=None):
+        """Download the logs of the cameras concurrently. Each download is fed to its camera's LogTail as its result is
+        delivered, a download which times out is dropped without moving the tail on, so the next poll picks its entries
+        up again.
+        @param names Names of the cameras to poll, None for all of them
+        @param timeout Seconds each camera is given, None for the fleet default
+        @return Generator of fleet.FleetResults whose values are lists of new LogEntries, as each camera finishes"""
+        tails = dict((name, self.tail(name)) for name in (list(self.fleet) if names is None else names))
+        if timeout is None: timeout = self.fleet.timeout
+        for result in self.fleet.run_calls(dict((name, partial(tail.cam.get_log, timeout=timeout)) for name, tail in tails.items()), timeout):
+            if result.error is None:
+                try:
+                    result = result._replace(value=tails[result.name].feed(result.value))
+                except Exception as e:
+                    result = result._replace(value=None, error=e)
+            yield result
+
+    def follow(self, interval=60.0, stop=None, timeout=None):
+        """Poll the logs of every camera each interval seconds, yielding (camera name, LogEntry) for each new entry as
+        soon as its camera has answered. Failed polls are reported on stderr.
+        @param stop threading.Event which ends the generator when set, None to follow forever"""
+        if stop is None: stop = threading.Event()
+        due = time.time()
+        while not stop.is_set():
+            for result in self.poll(timeout=timeout):
+                if result.error is not None:
+                    sys.stderr.write('Reading the log of "%s" failed: %s%s' % (result.name, result.error, os.linesep))
+                    continue
+                for entry in result.value:
+                    yield result.name, entry
+            due += interval
+            stop.wait(max(0.0, due - time.time()))
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+In process metrics for the cameras, schedulers and MQTT server.
+Counters, gauges and histograms are registered by name in a Registry and may carry labels, such as which camera and
+endpoint a request went to. The registry renders everything in the Prometheus text exposition format for scraping, and
+hook functions can be added to see each update as it happens, e.g. to forward them to another monitoring system.
+Updates are a dictionary lookup of the labels and a short locked section, around a microsecond, cheap enough to leave
+on all the time next to millisecond camera requests. Hot paths keep the child of their labels to skip the lookup.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+    if extra: pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+def _format_value(value):
+    if value == float('inf'): return '+Inf'
+    if isinstance(value, float) and value.is_integer(): return repr(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value)
+
+class _Child(object):
+    "The value of a metric for one set of label values"
+
+    __slots__ = ('metric', 'labels', 'hooks', 'lock')
+
+    def __init__(self, metric, labels):
+        self.metric = metric
+        self.labels = labels
+        self.hooks = metric.registry.hooks if metric.registry is not None else []
+        self.lock = threading.Lock()
+
+    def _notify(self, value):
+        for hook in self.hooks: hook(self.metric, self.labels, value)
+
+class CounterChild(_Child):
+    __slots__ = ('value',)
+
+    def __init__(self, metric, labels):
+        _Child.__init__(self, metric, labels)
+        self.value = 0
+
+    def inc(self, amount=1):
+        "Add a non negative amount to the counter"
+        with self.lock:
+            self.value += amount
+        if self.hooks: self._notify(amount)
+
+class GaugeChild(_Child):
+    __slots__ = ('value',)
+
+    def __init__(self, metric, labels):
+        _Child.__init__(self, metric, labels)
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+        if self.hooks: self._notify(value)
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+        if self.hooks: self._notify(self.value)
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+class HistogramChild(_Child):
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, metric, labels):
+        _Child.__init__(self, metric, labels)
+        self.counts = [0] * (len(metric.buckets) + 1) # The last is for values above every bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        "Record an observation, such as a latency in seconds"
+        i = bisect.bisect_left(self.metric.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+        if self.hooks: self._notify(value)
+
+    def percentile(self, fraction):
+        "Estimate a percentile of the observations as the upper bound of the bucket it falls in, None if no observations"
+        with self.lock:
+            target = fraction * self.count
+            seen = 0
+            for bound, n in zip(self.metric.buckets + (float('inf'),), self.counts):
+                seen += n
+                if n and seen >= target: return bound
+        return None
+
+class Metric(object):
+    """
+    A named metric with zero or more label names. Get the value for a set of labels with labels(), which is cached so
+    hot paths may keep the returned child. A metric without labels can be updated directly.
+    """
+
+    TYPE = None
+    CHILD = _Child
+
+    def __init__(self, name, help, labelnames=(), registry=None):
+        """Set up a metric, use the Registry methods to create registered ones
+        @param name Metric name, e.g. foscam_request_seconds
+        @param help One line description
+        @param labelnames Names of the labels each value is identified by
+        @param registry Registry whose hooks are called on updates
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.registry = registry
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.labelnames: self._default = self.labels()
+
+    def labels(self, *values):
+        "Get the child holding the value for a set of label values, given in the order of labelnames"
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('%s expects labels %s, got %s' % (self.name, self.labelnames, values))
+            with self.lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = self.children[values] = self.CHILD(self, tuple(str(v) for v in values))
+        return child
+
+    def remove(self, *values):
+        "Forget the value for a set of label values, e.g. when a camera is removed"
+        with self.lock:
+            self.children.pop(values, None)
+
+    def render(self):
+        "Lines of Prometheus text format for this metric"
+        lines = ['# HELP %s %s' % (self.name, self.help.replace('\\', '\\\\').replace('\n', '\\n')),
+                 '# TYPE %s %s' % (self.name, self.TYPE)]
+        for child in list(self.children.values()):
+            lines.extend(self._render(child))
+        return lines
+
+    def _render(self, child):
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, child.labels), _format_value(child.value))]
+
+class Counter(Metric):
+    "A count which only goes up, such as requests or bytes transferred"
+    TYPE = 'counter'
+    CHILD = CounterChild
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+class Gauge(Metric):
+    "A value which goes up and down, such as a queue depth"
+    TYPE = 'gauge'
+    CHILD = GaugeChild
+
+    def set(self, value):
+        self._default.set(value)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+class Histogram(Metric):
+    "A distribution of observations counted into buckets, such as latencies"
+    TYPE = 'histogram'
+    CHILD = HistogramChild
+
+    def __init__(self, name, help, labelnames=(), registry=None, buckets=DEFAULT_BUCKETS):
+        "@param buckets Increasing upper bounds of the buckets, an infinite one is added"
+        self.buckets = tuple(sorted(buckets))
+        Metric.__init__(self, name, help, labelnames, registry)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def _render(self, child):
+        with child.lock:
+            counts, total, count = list(child.counts), child.sum, child.count
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            lines.append('%s_bucket%s %d' % (self.name, _format_labels(self.labelnames, child.labels, 'le="%s"' % _format_value(float(bound))), cumulative))
+        labels = _format_labels(self.labelnames, child.labels)
+        lines.append('%s_sum%s %s' % (self.name, labels, _format_value(total)))
+        lines.append('%s_count%s %d' % (self.name, labels, count))
+        return lines
+
+class Registry(object):
+    "A collection of named metrics which can be rendered together"
+
+    def __init__(self):
+        self.metrics = {}
+        self.hooks = [] # Shared with every metric child, so adding a hook takes effect everywhere at once
+        self.lock = threading.Lock()
+
+    def _get(self, kind, name, help, labelnames, **args):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = kind(name, help, labelnames, self, **args)
+            elif type(metric) is not kind or metric.labelnames != tuple(labelnames):
+                raise ValueError('Metric %s is already registered as a %s with labels %s' % (name, metric.TYPE, metric.labelnames))
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        "Get or register a Counter"
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        "Get or register a Gauge"
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        "Get or register a Histogram"
+        return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+    def __getitem__(self, name):
+        return self.metrics[name]
+
+    def __contains__(self, name):
+        return name in self.metrics
+
+    def add_hook(self, hook):
+        """Call hook(metric, labels, value) on every update from now on. It runs on the updating thread so must be quick.
+        value is the amount added for counters, the new value for gauges and the observation for histograms."""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def render(self):
+        "All metrics in the Prometheus text exposition format"
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics: lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry() # The default registry the driver, schedulers and MQTT server report to
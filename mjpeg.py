@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Frame extraction for the multipart/x-mixed-replace MJPEG streams served by videostream.cgi.
+The MJPEGParser keeps the stream in a single reusable buffer and hands out memoryviews of each JPEG frame, no bytes are
+copied between reading the socket and the consumer. FrameReader decouples a slow consumer from the camera with a
+bounded frame queue and a choice of dropping the oldest frame or blocking the stream.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import re
+import time
+import threading
+from collections import deque, namedtuple
+
+SOI = b'\xff\xd8' # JPEG start of image marker
+EOI = b'\xff\xd9' # JPEG end of image marker
+CONTENT_LENGTH = re.compile(br'Content-Length:\s*(\d+)', re.IGNORECASE)
+MAX_HEADER = 1024 # Bytes of part header kept while waiting for the start of a frame
+
+Frame = namedtuple('Frame', ['timestamp', 'data'])
+
+class MJPEGParser(object):
+    """
+    Incremental MJPEG stream parser.
+    Stream data is written straight into the parser's buffer (see writable and commit) and complete frames are returned
+    by next_frame as memoryviews into that buffer. A returned view is only valid until the next call to writable, after
+    which the buffer space may be reused.
+    Frames are delimited by the Content-Length header of each multipart part when there is one and by the JPEG SOI / EOI
+    markers otherwise, so raw concatenated JPEGs are handled too. A Content-Length which doesn't end on an EOI marker is
+    ignored in favour of the markers.
+    """
+
+    def __init__(self, bufsize=1<<20):
+        "@param bufsize Initial buffer size in bytes, it grows if a single frame doesn't fit"
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.start = 0   # First byte not yet consumed
+        self.end = 0     # One past the last byte written
+        self.soi = -1    # Start of the frame being assembled
+        self.length = 0  # Length of that frame from its part header, 0 if unknown
+        self.scanned = 0 # Where to resume looking for EOI
+
+    def __len__(self):
+        "Number of buffered bytes not yet returned as frames"
+        return self.end - self.start
+
+    def writable(self, n):
+        """Get a memoryview to write up to n bytes of stream data into.
+        Invalidates all frames previously returned by next_frame."""
+        if len(self.buf) - self.end < n:
+            pending = self.end - self.start
+            if pending + n > len(self.buf): # Grow, into a new buffer in case the old one still has views exported
+                buf = bytearray(max(2 * len(self.buf), pending + n))
+                buf[:pending] = self.view[self.start:self.end]
+                self.buf, self.view = buf, memoryview(buf)
+            else: # Move the partial frame to the front of the buffer
+                self.view[:pending] = self.view[self.start:self.end]
+            shift = self.start
+            if self.soi >= 0: self.soi -= shift
+            self.scanned = max(0, self.scanned - shift)
+            self.start, self.end = 0, pending
+        return self.view[self.end:self.end + n]
+
+    def commit(self, n):
+        "Record that n bytes were written to the view returned by writable"
+        self.end += n
+
+    def feed(self, data):
+        "Copy data into the parser, for sources which can't read into a buffer"
+        self.writable(len(data))[:len(data)] = data
+        self.commit(len(data))
+
+    def next_frame(self):
+        "Return a memoryview of the next complete frame or None if more data is needed"
+        if self.soi < 0:
+            soi = self.buf.find(SOI, self.start, self.end)
+            if soi < 0:
+                self.start = max(self.start, self.end - MAX_HEADER) # Keep what may be the part header
+                return None
+            header = CONTENT_LENGTH.search(self.buf, self.start, soi)
+            self.soi = soi
+            self.length = int(header.group(1)) if header else 0
+            self.scanned = soi + 2
+        if self.length:
+            stop = self.soi + self.length
+            if stop > self.end: return None
+            if self.buf[stop - 2:stop] != EOI: self.length = 0 # Wrong Content-Length, find the frame's end instead
+        if not self.length:
+            eoi = self.buf.find(EOI, self.scanned, self.end)
+            if eoi < 0:
+                self.scanned = max(self.scanned, self.end - 1)
+                return None
+            stop = eoi + 2
+        frame = self.view[self.soi:stop]
+        self.start = stop
+        self.soi = -1
+        return frame
+
+def frames(stream, chunk=65536, bufsize=1<<20):
+    """Generate Frames from a file like MJPEG stream such as the handle returned by FoscamControl.videostream.
+    Each frame's data is a memoryview into the parser buffer which is only valid until the next frame is requested,
+    copy it with bytes() to keep it.
+    @param stream File like object, readinto is used if it has one
+    @param chunk Maximum number of bytes to read at a time
+    @param bufsize Initial parser buffer size
+    """
+    parser = MJPEGParser(bufsize)
+    readinto = getattr(stream, 'readinto', None)
+    while True:
+        frame = parser.next_frame()
+        if frame is not None:
+            yield Frame(time.time(), frame)
+            continue
+        if readinto is not None:
+            n = readinto(parser.writable(chunk))
+            if not n: return
+            parser.commit(n)
+        else:
+            data = stream.read(chunk)
+            if not data: return
+            parser.feed(data)
+
+
+class FrameReader(object):
+    """
+    Reads frames from an MJPEG stream on a background thread into a bounded queue.
+    When the consumer falls behind the policy decides what happens: 'drop' discards the oldest queued frame so the
+    consumer always sees the latest images, 'block' stops reading the stream until the consumer catches up.
+    Iterate over the reader to get Frames, their data is a bytes copy owned by the consumer.
+    """
+
+    POLICIES = ('drop', 'block')
+
+    def __init__(self, stream, maxframes=4, policy='drop', chunk=65536):
+        """Start reading
+        @param stream File like MJPEG stream, it is closed when the reader stops
+        @param maxframes Most frames to queue for the consumer
+        @param policy 'drop' or 'block'
+        @param chunk Maximum number of bytes to read from the stream at a time
+        """
+        if policy not in self.POLICIES: raise ValueError('policy must be one of %s' % repr(self.POLICIES))
+        self.stream = stream
+        self.maxframes = maxframes
+        self.policy = policy
+        self.chunk = chunk
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.running = True
+        self.dropped = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read(self):
+        try:
+            for timestamp, data in frames(self.stream, self.chunk):
+                frame = Frame(timestamp, bytes(data))
+                with self.cond:
+                    while self.policy == 'block' and self.running and len(self.queue) >= self.maxframes:
+                        self.cond.wait()
+                    if not self.running: break
+                    if len(self.queue) >= self.maxframes:
+                        self.queue.popleft()
+                        self.dropped += 1
+                    self.queue.append(frame)
+                    self.cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.cond:
+                self.running = False
+                self.cond.notify_all()
+            self.stream.close()
+
+    def get(self, timeout=None):
+        """Get the next frame, waiting up to timeout seconds.
+        @return A Frame or None if the stream ended or timeout passed"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.queue or not self.running, timeout)
+            if not self.queue: return None
+            frame = self.queue.popleft()
+            self.cond.notify_all()
+            return frame
+
+    def __iter__(self):
+        while True:
+            frame = self.get()
+            if frame is None:
+                if self.error is not None: raise self.error
+                return
+            yield frame
+
+    def close(self):
+        "Stop reading the stream"
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
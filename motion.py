@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Motion detection on low resolution camera frames, triggering full resolution scheduler snapshots.
+A MotionDetector keeps a running average background of a camera's view and marks pixels which differ from both the
+background and the previous frame, all with whole array NumPy operations into preallocated buffers. Motion is reported
+per region of the view. A MotionStage feeds a camera's QQVGA / QVGA video stream or snapshots to a detector and asks a
+FoscamScheduler for a high priority snapshot when something moves.
+NumPy is required, Pillow too for decoding JPEG frames.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import io
+import os
+import sys
+import time
+import threading
+import metrics
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+MOTION_EVENTS = metrics.REGISTRY.counter('foscam_motion_events_total', 'Motion detections which requested a snapshot', ('camera',))
+
+class MotionDetector(object):
+    """
+    Background subtraction motion detector for a stream of grayscale frames of one camera view.
+    A pixel is in the foreground when it differs by more than threshold from the background. A region has motion when
+    more than min_fraction of its pixels are in the foreground and at least a quarter as many changed by more than
+    threshold since the previous frame, so a lighting change the background hasn't caught up with yet stops counting
+    once the light is steady.
+    """
+
+    def __init__(self, threshold=25, alpha=0.05, min_fraction=0.01, regions=None, mask=None, warmup=5, size=(160, 120)):
+        """Set up the detector
+        @param threshold Change in pixel value, out of 255, counted as motion
+        @param alpha Weight of each frame in the running average background
+        @param min_fraction Fraction of a region's pixels which must move for it to have motion
+        @param regions Dictionary of region name: (left, top, right, bottom) as fractions of the frame, or a boolean
+               array of the frame's shape. None for one region named 'all' covering the frame.
+        @param mask Boolean array of the pixels to watch, or None to watch them all
+        @param warmup Number of frames used to build the background before motion is reported
+        @param size (width, height) to decode JPEG frames to, they are decoded at the nearest size the JPEG decoder can
+               scale to cheaply
+        """
+        if np is None: raise ImportError('Motion detection needs numpy')
+        self.threshold = threshold
+        self.alpha = alpha
+        self.min_fraction = min_fraction
+        self.regions = {'all': (0.0, 0.0, 1.0, 1.0)} if regions is None else dict(regions)
+        self.mask = mask
+        self.warmup = warmup
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        "Forget the background, e.g. after the camera has moved"
+        self.shape = None
+        self.frames = 0
+
+    def _allocate(self, shape):
+        "Allocate the buffers and region selections for a frame shape"
+        self.shape = shape
+        self.background = np.zeros(shape, np.float32)
+        self.previous = np.zeros(shape, np.float32)
+        self.current = np.zeros(shape, np.float32)
+        self.delta = np.zeros(shape, np.float32)
+        self.scratch = np.zeros(shape, np.float32)
+        self.moving = np.zeros(shape, bool)
+        self.changed = np.zeros(shape, bool)
+        self.scratch_mask = np.zeros(shape, bool)
+        height, width = shape
+        self.selections = {} # name: (slice or boolean mask, pixel count)
+        for name, region in self.regions.items():
+            if isinstance(region, tuple):
+                left, top, right, bottom = region
+                selection = (slice(int(top * height), max(int(top * height) + 1, int(bottom * height))),
+                             slice(int(left * width), max(int(left * width) + 1, int(right * width))))
+                count = (selection[0].stop - selection[0].start) * (selection[1].stop - selection[1].start)
+                if self.mask is not None: count = int(np.count_nonzero(self.mask[selection]))
+            else:
+                selection = np.asarray(region, bool)
+                if self.mask is not None: selection = selection & self.mask
+                count = int(np.count_nonzero(selection))
+            self.selections[name] = (selection, max(1, count))
+
+    def decode(self, jpeg):
+        "Decode a JPEG to a grayscale array close to size"
+        if Image is None: raise ImportError('Decoding JPEG frames needs Pillow')
+        image = Image.open(io.BytesIO(jpeg))
+        image.draft('L', self.size) # Let the decoder scale down, far cheaper than resizing afterwards
+        return np.asarray(image.convert('L'))
+
+    def feed(self, frame):
+        """Add a frame and detect motion in it.
+        @param frame 2D uint8 grayscale array, or JPEG data
+        @return Dictionary of region name: fraction of its pixels in the foreground for the regions with motion"""
+        if not isinstance(frame, np.ndarray): frame = self.decode(frame)
+        if frame.shape != self.shape: self._allocate(frame.shape)
+        np.copyto(self.current, frame, casting='unsafe')
+        if self.frames == 0:
+            np.copyto(self.background, self.current)
+            np.copyto(self.previous, self.current)
+        self.frames += 1
+        np.subtract(self.current, self.background, out=self.delta)
+        np.multiply(self.delta, self.alpha, out=self.scratch)
+        np.add(self.background, self.scratch, out=self.background)
+        np.abs(self.delta, out=self.delta)
+        np.greater(self.delta, self.threshold, out=self.moving)
+        np.subtract(self.current, self.previous, out=self.delta)
+        np.abs(self.delta, out=self.delta)
+        np.greater(self.delta, self.threshold, out=self.changed)
+        self.previous, self.current = self.current, self.previous
+        if self.mask is not None:
+            np.logical_and(self.moving, self.mask, out=self.moving)
+            np.logical_and(self.changed, self.mask, out=self.changed)
+        if self.frames <= self.warmup: return {}
+        motion = {}
+        for name, (selection, count) in self.selections.items():
+            if isinstance(selection, tuple):
+                fraction = int(np.count_nonzero(self.moving[selection])) / float(count)
+                if fraction > self.min_fraction: changed = np.count_nonzero(self.changed[selection]) / float(count)
+            else:
+                fraction = int(np.count_nonzero(np.logical_and(self.moving, selection, out=self.scratch_mask))) / float(count)
+                if fraction > self.min_fraction: changed = np.count_nonzero(np.logical_and(self.changed, selection, out=self.scratch_mask)) / float(count)
+            if fraction > self.min_fraction and changed * 4.0 >= self.min_fraction: motion[name] = fraction
+        return motion
+
+class MotionStage(object):
+    """
+    Watches a camera for motion and asks its FoscamScheduler for a full resolution snapshot when there is some.
+    Feed it frames yourself with feed, or have it read the camera's video stream or poll low resolution snapshots on a
+    background thread with watch_stream or watch_snapshots. The detector is reset whenever the camera moves so the
+    move itself isn't reported.
+    """
+
+    def __init__(self, scheduler, callback, detector=None, priority=10, preset=None, cooldown=5.0, expire=30.0, userdata=None, retry=1.0):
+        """Set up the stage
+        @param scheduler camscheduler.FoscamScheduler of the camera
+        @param callback Snapshot callback, see FoscamScheduler.snapshot. Its userdata is a dictionary with the time
+               motion was detected, the regions with motion and the userdata given here.
+        @param detector MotionDetector to use, None for one with default settings
+        @param priority Priority of the snapshot requests
+        @param preset Preset to take the snapshots at, None for wherever the camera is when motion is seen
+        @param cooldown Seconds after a snapshot request before motion may request another
+        @param expire Seconds a snapshot request may wait before it is no longer wanted
+        @param retry Seconds to wait before reopening a stream which ended or failed
+        """
+        self.scheduler = scheduler
+        self.cam = scheduler.cam
+        self.callback = callback
+        self.detector = MotionDetector() if detector is None else detector
+        self.priority = priority
+        self.preset = preset
+        self.cooldown = cooldown
+        self.expire = expire
+        self.userdata = userdata
+        self.retry = retry
+        self.position = None # (preset, presetTime) of the camera the background is for
+        self.triggered = 0.0
+        self.events = MOTION_EVENTS.labels(getattr(self.cam, 'name', 'camera'))
+        self.running = False
+        self.thread = None
+        self.wake = threading.Event()
+
+    def feed(self, timestamp, frame):
+        """Detect motion in a frame and request a snapshot if there is some
+        @param timestamp When the frame was captured
+        @param frame 2D grayscale array or JPEG data
+        @return Dictionary of region name: fraction in the foreground for the regions with motion"""
+        position = (self.cam.preset, self.cam.presetTime)
+        if position != self.position: # The camera moved, start a new background
+            self.detector.reset()
+            self.position = position
+        motion = self.detector.feed(frame)
+        if motion and timestamp - self.triggered >= self.cooldown:
+            self.triggered = timestamp
+            self.events.inc()
+            preset = self.preset
+            if preset is None: preset = self.cam.preset if self.cam.preset is not None else self.cam.defaultPreset
+            self.scheduler.snapshot(self.priority, preset, self.callback, timestamp + self.expire,
+                                    {'time': timestamp, 'regions': motion, 'userdata': self.userdata})
+        return motion
+
+    def watch_stream(self, resolution='QQVGA', rate='full'):
+        "Start reading the camera's video stream on a background thread"
+        def frames():
+            for timestamp, data in self.cam.frames(resolution, rate):
+                yield timestamp, data
+        self._start(frames)
+
+    def watch_snapshots(self, interval=1.0, resolution='QQVGA'):
+        "Start polling low resolution snapshots on a background thread"
+        def frames():
+            while True:
+                yield time.time(), self.cam.snapshot(resolution, fresh=True)
+                time.sleep(interval)
+        self._start(frames)
+
+    def _start(self, frames):
+        if self.thread is not None: raise ValueError('Already watching')
+        self.running = True
+        self.wake.clear()
+        self.thread = threading.Thread(target=self._watch, args=(frames,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _watch(self, frames):
+        while self.running:
+            try:
+                for timestamp, data in frames():
+                    if not self.running: break
+                    self.feed(timestamp, data)
+            except Exception as e:
+                sys.stderr.write('Motion detection failed: %s%s' % (e, os.linesep))
+            if self.running: self.wake.wait(self.retry) # Whether the stream ended or failed, don't reconnect in a tight loop
+
+    def stop(self):
+        "Stop watching, waits for the frame being processed"
+        self.running = False
+        self.wake.set()
+        if self.thread is not None: self.thread.join()
+        self.thread = None
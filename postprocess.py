@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Snapshot post processing in a pool of worker processes.
+Making thumbnails, recompressing and cropping snapshots is JPEG decoding and encoding which holds the GIL, done in a
+snapshot callback it holds up the camera's scheduler and every other thread too. A PostProcessor runs declarative
+transforms on snapshots in worker processes instead and calls back with the results when they are done. Each snapshot
+is handed to the workers through a block of shared memory rather than pickled down a pipe. Outputs are described as a
+dictionary of output name: list of transforms, e.g.
+    {'thumb': [Resize(160, 120), Recompress(60)], 'door': [Crop((0.5, 0.2, 0.8, 0.9))], 'small': [Recompress(40)]}
+and the results come back as a dictionary of output name: JPEG data. Pillow is required.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import io
+import os
+import sys
+import time
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+import metrics
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+
+PROCESS_SECONDS = metrics.REGISTRY.histogram('foscam_postprocess_seconds', 'Time from submitting a snapshot for post processing until its results were ready',
+                                             buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+PROCESS_ERRORS = metrics.REGISTRY.counter('foscam_postprocess_errors_total', 'Snapshots whose post processing failed')
+PROCESS_DROPPED = metrics.REGISTRY.counter('foscam_postprocess_dropped_total', 'Snapshots not post processed because too many were pending')
+
+BLOCK_SIZE = 1 << 16 # Shared memory blocks are whole multiples of this, so blocks can be reused for similar images
+
+class Dropped(Exception):
+    "The snapshot wasn't post processed because the pool was full"
+
+class Resize(object):
+    "Scale the image to fit within a size, keeping its aspect ratio"
+
+    def __init__(self, width, height):
+        self.size = (width, height)
+
+    def apply(self, image):
+        if image.size[0] <= self.size[0] and image.size[1] <= self.size[1]: return image
+        image = image.copy()
+        image.thumbnail(self.size)
+        return image
+
+class Crop(object):
+    "Cut out a region of the image"
+
+    def __init__(self, box):
+        "@param box (left, top, right, bottom) as fractions of the image"
+        self.box = box
+
+    def apply(self, image):
+        width, height = image.size
+        left, top, right, bottom = self.box
+        return image.crop((int(left * width), int(top * height), int(right * width), int(bottom * height)))
+
+class Timestamp(object):
+    "Draw the time the snapshot was taken in a corner of the image"
+
+    def __init__(self, format='%Y-%m-%d %H:%M:%S', position=(4, 4), fill=(255, 255, 255)):
+        self.format = format
+        self.position = position
+        self.fill = fill
+
+    def apply(self, image, timestamp=None):
+        image = image.convert('RGB')
+        ImageDraw.Draw(image).text(self.position, time.strftime(self.format, time.localtime(timestamp)), fill=self.fill)
+        return image
+
+class Recompress(object):
+    "Set the JPEG quality the output is encoded at, outputs without one are encoded at 85"
+
+    def __init__(self, quality, optimize=False):
+        self.quality = quality
+        self.optimize = optimize
+
+    def apply(self, image):
+        return image
+
+DEFAULT_QUALITY = Recompress(85)
+
+_attached = {} # Shared memory blocks a worker process has attached to, by name
+
+def _attach(name):
+    "Attach to a shared memory block in a worker, blocks are reused so they stay attached"
+    block = _attached.get(name)
+    if block is None: block = _attached[name] = shared_memory.SharedMemory(name)
+    return block
+
+def process(image, outputs, timestamp=None):
+    """Apply the outputs' transforms to a snapshot in this process
+    @param image JPEG data
+    @param outputs Dictionary of output name: list of transforms
+    @param timestamp Time the snapshot was taken, for Timestamp transforms
+    @return Dictionary of output name: JPEG data"""
+    source = Image.open(io.BytesIO(image))
+    source.load() # Done with the JPEG data once decoded
+    results = {}
+    for output, transforms in outputs.items():
+        image = source
+        encoding = DEFAULT_QUALITY
+        for transform in transforms:
+            if isinstance(transform, Recompress):
+                encoding = transform
+            elif isinstance(transform, Timestamp):
+                image = transform.apply(image, timestamp)
+            else:
+                image = transform.apply(image)
+        if image.mode not in ('RGB', 'L'): image = image.convert('RGB')
+        data = io.BytesIO()
+        image.save(data, 'JPEG', quality=encoding.quality, optimize=encoding.optimize)
+        results[output] = data.getvalue()
+    return results
+
+def _process(name, length, outputs, timestamp):
+    "Run in a worker process, process the JPEG in a shared memory block"
+    return process(_attach(name).buf[:length], outputs, timestamp)
+
+class PostProcessor(object):
+    """
+    Runs snapshot post processing in a process pool.
+    submit hands a snapshot to the pool and returns a concurrent.futures.Future of its results. wrap makes a snapshot
+    callback for FoscamScheduler which submits each snapshot and returns straight away, the wrapped callback is called
+    with the results from a pool thread once they are ready. Results of a series of snapshots may arrive out of order.
+    At most max_pending snapshots are processed or waiting at once so a camera can't get unboundedly ahead of its
+    processing. When that many are pending the policy decides what happens to another: 'drop' doesn't process it, its
+    future fails with Dropped straight away and wrapped callbacks aren't called, 'block' makes the caller wait for room,
+    holding that camera's scheduler up until the processing catches up.
+    """
+
+    POLICIES = ('drop', 'block')
+
+    def __init__(self, workers=None, max_pending=None, policy='drop'):
+        """Start the worker processes
+        @param workers Number of worker processes, None for one per CPU
+        @param max_pending Most snapshots being processed or waiting, None for twice the number of workers
+        @param policy 'drop' or 'block'
+        """
+        if Image is None: raise ImportError('Post processing needs Pillow')
+        if policy not in self.POLICIES: raise ValueError('policy must be one of %s' % repr(self.POLICIES))
+        self.policy = policy
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(self.workers)
+        self.max_pending = max_pending or 2 * self.workers
+        self.pending = threading.BoundedSemaphore(self.max_pending)
+        self.lock = threading.Lock()
+        self.free = [] # Shared memory blocks not in use
+        self.blocks = [] # All the shared memory blocks
+        self.processed = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def _block(self, size):
+        "A free shared memory block of at least size bytes"
+        with self.lock:
+            for i, block in enumerate(self.free):
+                if block.size >= size: return self.free.pop(i)
+            block = shared_memory.SharedMemory(create=True, size=max(BLOCK_SIZE, -(-size // BLOCK_SIZE) * BLOCK_SIZE))
+            self.blocks.append(block)
+            return block
+
+    def _release(self, block):
+        with self.lock:
+            self.free.append(block)
+        self.pending.release()
+
+    def submit(self, image, outputs, timestamp=None):
+        """Post process a snapshot
+        @param image JPEG data, e.g. the result of FoscamControl.snapshot
+        @param outputs Dictionary of output name: list of transforms
+        @param timestamp Time the snapshot was taken, for Timestamp transforms, None for now
+        @return Future of the dictionary of output name: JPEG data, which fails with Dropped if too many were pending"""
+        if timestamp is None: timestamp = time.time()
+        if not self.pending.acquire(self.policy == 'block'):
+            self.dropped += 1
+            PROCESS_DROPPED.inc()
+            future = Future()
+            future.set_exception(Dropped('%d snapshots are already pending' % self.max_pending))
+            return future
+        try:
+            block = self._block(len(image))
+        except Exception:
+            self.pending.release()
+            raise
+        block.buf[:len(image)] = image
+        start = time.time()
+        try:
+            future = self.executor.submit(_process, block.name, len(image), outputs, timestamp)
+        except Exception:
+            self._release(block)
+            raise
+        def done(future):
+            self._release(block)
+            PROCESS_SECONDS.observe(time.time() - start)
+            if future.exception() is None:
+                self.processed += 1
+            else:
+                self.errors += 1
+                PROCESS_ERRORS.inc()
+        future.add_done_callback(done)
+        return future
+
+    def snapshot(self, foscam, outputs, resolution='VGA', fresh=False):
+        """Take a snapshot with FoscamControl.snapshot and post process it
+        @return Future of the dictionary of output name: JPEG data"""
+        timestamp = time.time()
+        return self.submit(foscam.snapshot(resolution, fresh), outputs, timestamp)
+
+    def wrap(self, callback, outputs):
+        """Make a snapshot callback which post processes each snapshot
+        @param callback Called as (dictionary of output name: JPEG data, preset, final image, userdata) when the results
+               are ready, from a pool thread
+        @param outputs Dictionary of output name: list of transforms
+        @return Callback of (image data, preset, final image, userdata) for FoscamScheduler.snapshot and interval. With
+                the 'drop' policy, snapshots dropped for lack of room are never called back."""
+        def post(image, preset, final, userdata):
+            timestamp = time.time()
+            def deliver(future):
+                try:
+                    results = future.result()
+                except Dropped:
+                    return
+                except Exception as e:
+                    sys.stderr.write('Post processing a snapshot at preset %s failed: %s%s' % (preset, e, os.linesep))
+                    return
+                try:
+                    callback(results, preset, final, userdata)
+                except Exception as e:
+                    sys.stderr.write('Post processed snapshot callback failed: %s%s' % (e, os.linesep))
+            self.submit(image, outputs, timestamp).add_done_callback(deliver)
+        return post
+
+    def close(self, wait=True):
+        "Shut the workers down and free the shared memory, waiting for snapshots being processed unless wait is False"
+        self.executor.shutdown(wait)
+        with self.lock:
+            for block in self.blocks:
+                block.close()
+                block.unlink()
+            self.blocks = []
+            self.free = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+A latest wins pan / tilt command channel for interactive control.
+Joysticks and UIs produce motion commands far faster than the camera answers them. Sending each one in turn builds a
+backlog and the camera keeps moving long after the user lets go. The PTZChannel instead keeps only the latest intent and
+sends it from a background worker as soon as the previous command has been answered, so the delay between input and
+camera is bounded by about two round trips however fast the input arrives.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import time
+import threading
+from collections import deque
+import metrics
+
+COMMAND_SECONDS = metrics.REGISTRY.histogram('foscam_ptz_command_seconds', 'Time from a PTZ intent being given to the camera acknowledging it', ('camera',))
+
+# Commands which end each continuous movement, diagonals are stopped on both axes
+STOPS = {
+    'UP': ('STOP_UP',),
+    'DOWN': ('STOP_DOWN',),
+    'LEFT': ('STOP_LEFT',),
+    'RIGHT': ('STOP_RIGHT',),
+    'UPPER_LEFT': ('STOP_UP', 'STOP_LEFT'),
+    'UPPER_RIGHT': ('STOP_UP', 'STOP_RIGHT'),
+    'DOWN_LEFT': ('STOP_DOWN', 'STOP_LEFT'),
+    'DOWN_RIGHT': ('STOP_DOWN', 'STOP_RIGHT'),
+    'UP_DOWN_PATROL': ('STOP_UP_DOWN_PATROL',),
+    'LEFT_RIGHT_PATROL': ('STOP_LEFT_RIGHT_PATROL',),
+}
+# Stops every movement, for when what the camera is doing isn't known
+STOP_ALL = ('STOP_UP', 'STOP_DOWN', 'STOP_LEFT', 'STOP_RIGHT', 'STOP_UP_DOWN_PATROL', 'STOP_LEFT_RIGHT_PATROL')
+STOP_COMMANDS = frozenset(STOP_ALL)
+
+class PTZChannel(object):
+    """
+    Sends pan / tilt commands for a camera from a background worker, latest intent wins.
+    Commands given while another is being sent replace each other, only the newest is sent next. A continuous movement
+    or stop which repeats the last command sent is not sent again, unless the camera was moved by other means since,
+    which drivers count in their moves attribute. Calls return immediately, use flush to wait for the camera to have
+    been sent the latest intent.
+    The worker uses the camera's keep-alive connection pool and the CONTROL lane of its limiter, so PTZ commands skip
+    ahead of other requests to the camera.
+    """
+
+    def __init__(self, foscam, window=1000):
+        """Start the worker
+        @param foscam driver object
+        @param window Number of recent command latencies kept for the stats
+        """
+        self.cam = foscam
+        self.cond = threading.Condition()
+        self.pending = None  # (kind, args, given time) of the latest intent not yet sent
+        self.sending = False
+        self.last = None     # (kind, args) of the last command sent
+        self.moves = None    # The camera's moves count once the last command was sent
+        self.moving = None   # Name of the continuous movement last started, for stop, None if unknown
+        self.running = True
+        self.latencies = deque(maxlen=window)
+        self.latency = COMMAND_SECONDS.labels(getattr(foscam, 'name', 'camera'))
+        self.sent = 0
+        self.superseded = 0
+        self.repeated = 0
+        self.errors = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _give(self, kind, args):
+        with self.cond:
+            if not self.running: raise ValueError('PTZ channel is closed')
+            if self.pending is not None: self.superseded += 1
+            self.pending = (kind, args, time.time())
+            self.cond.notify_all()
+
+    def control(self, command, onestep=None, degree=None):
+        "Move the camera, see FoscamControl.control. Returns straight away."
+        self._give('control', (command, onestep, degree))
+
+    def pan(self, degrees):
+        "Command a horizontal movement, positive is right, negative is left"
+        if degrees > 0.0:
+            self.control('RIGHT', degree=degrees)
+        else:
+            self.control('LEFT', degree=-degrees)
+
+    def tilt(self, degrees):
+        "Command vertical movement, positive is down, negative is up"
+        if degrees > 0.0:
+            self.control('DOWN', degree=degrees)
+        else:
+            self.control('UP', degree=-degrees)
+
+    def stop(self):
+        "Stop the current continuous movement, or every movement if which one isn't known"
+        with self.cond:
+            moving = self.moving
+            if self.pending is not None and self.pending[0] == 'control': moving = self.pending[1][0]
+        self._give('stop', STOPS.get(moving, STOP_ALL))
+
+    def goto_preset(self, preset):
+        "Go to numbered preset pan and tilt position"
+        self._give('preset', preset)
+
+    def _repeat(self, kind, args):
+        "True if a command would only repeat the last one sent and needn't be sent"
+        if self.last is None or getattr(self.cam, 'moves', None) != self.moves: return False # Moved by someone else since
+        if kind == 'stop': return self.last[0] == 'stop'
+        if (kind, args) != self.last: return False
+        return kind == 'control' and args[1] is None and args[2] is None # Step moves add up, continuous ones don't
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while self.running and self.pending is None: self.cond.wait()
+                if self.pending is None: return
+                kind, args, given = self.pending
+                self.pending = None
+                if self._repeat(kind, args):
+                    self.repeated += 1
+                    self.cond.notify_all()
+                    continue
+                self.sending = True
+            try:
+                if kind == 'preset':
+                    self.cam.goto_preset(args)
+                elif kind == 'stop':
+                    for command in args: self.cam.control(command)
+                else:
+                    self.cam.control(*args)
+                error = None
+            except Exception as e:
+                error = e
+            latency = time.time() - given
+            with self.cond:
+                self.sending = False
+                if error is None:
+                    self.sent += 1
+                    self.last = (kind, args)
+                    self.moves = getattr(self.cam, 'moves', None)
+                    self.latencies.append(latency)
+                    self.latency.observe(latency)
+                    if kind == 'control' and args[1] is None and args[2] is None:
+                        self.moving = None if args[0] in STOP_COMMANDS else args[0]
+                    elif kind in ('preset', 'stop'):
+                        self.moving = None
+                else: # Send the next intent anyway, a repeat of this one must not be suppressed
+                    self.errors += 1
+                    self.error = error
+                    self.last = None
+                self.cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until the latest intent has been sent.
+        @return False if timeout passed first"""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.pending is None and not self.sending, timeout)
+
+    def close(self):
+        "Send any pending intent and stop the worker"
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+
+    @property
+    def stats(self):
+        "Dictionary of command counts and the median and 99th percentile latency of recent commands in seconds"
+        with self.cond:
+            latencies = sorted(self.latencies)
+            stats = {'sent': self.sent, 'superseded': self.superseded, 'repeated': self.repeated, 'errors': self.errors}
+        stats['p50'] = latencies[len(latencies) // 2] if latencies else None
+        stats['p99'] = latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))] if latencies else None
+        return stats
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Continuous recording of camera video streams to rotating segment files.
+Each segment is a pair of files named after the time it starts: a .mjpeg file of the JPEG frames back to back, written
+with large buffered writes, and a .idx file with a fixed width (timestamp, offset, length) entry per frame. The index is
+memory mapped when reading so the frame at a given time is found by binary search and handed out as a memoryview of
+the mapped segment, without scanning or copying. Old segments are deleted by age or to keep the total size in bounds.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import os
+import sys
+import mmap
+import time
+import struct
+import bisect
+import threading
+import metrics
+
+INDEX_ENTRY = struct.Struct('<dQI') # Frame timestamp, offset in the segment and length
+DATA_SUFFIX = '.mjpeg'
+INDEX_SUFFIX = '.idx'
+
+RECORDED_BYTES = metrics.REGISTRY.counter('foscam_recorded_bytes_total', 'Bytes of video written to segments', ('camera',))
+RECORDED_FRAMES = metrics.REGISTRY.counter('foscam_recorded_frames_total', 'Video frames written to segments', ('camera',))
+
+def segment_name(start):
+    "Base file name of a segment starting at a time, which sorts in time order"
+    return '%015d' % int(start * 1000)
+
+class SegmentWriter(object):
+    "Writes frames to a new segment"
+
+    def __init__(self, base, start, bufsize=1<<20):
+        """Create the segment files
+        @param base Path of the segment without suffix
+        @param start Time the segment starts
+        @param bufsize Write buffer size of the data file, the index buffer is a tenth of it
+        """
+        self.base = base
+        self.start = start
+        self.data = open(base + DATA_SUFFIX, 'wb', buffering=bufsize)
+        self.index = open(base + INDEX_SUFFIX, 'wb', buffering=max(INDEX_ENTRY.size, bufsize // 10))
+        self.offset = 0
+        self.frames = 0
+
+    def write(self, timestamp, frame):
+        "Append a frame, which may be a memoryview"
+        self.data.write(frame)
+        self.index.write(INDEX_ENTRY.pack(timestamp, self.offset, len(frame)))
+        self.offset += len(frame)
+        self.frames += 1
+
+    def flush(self):
+        "Make what was written so far visible to readers, data first so the index never points past it"
+        self.data.flush()
+        self.index.flush()
+
+    def sync(self):
+        "Flush and have the operating system write what was written so far to disk, so it survives a power cut"
+        self.flush()
+        os.fsync(self.data.fileno())
+        os.fsync(self.index.fileno())
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+    @property
+    def size(self):
+        "Bytes written to the segment files"
+        return self.offset + self.frames * INDEX_ENTRY.size
+
+class Segment(object):
+    """
+    A recorded segment memory mapped for reading.
+    Frames are returned as memoryviews of the mapping, they must be released or dropped before the segment is closed.
+    A segment still being recorded shows the frames flushed when it was opened.
+    """
+
+    def __init__(self, base):
+        "@param base Path of the segment without suffix"
+        self.base = base
+        self.start = int(os.path.basename(base)) / 1000.0
+        self.files = []
+        self.index = self._map(base + INDEX_SUFFIX)
+        self.data = self._map(base + DATA_SUFFIX)
+        self.count = len(self.index) // INDEX_ENTRY.size
+
+    def _map(self, path):
+        f = open(path, 'rb')
+        self.files.append(f)
+        size = os.fstat(f.fileno()).st_size
+        if size == 0: return b'' # Can't map an empty file
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for m in (self.index, self.data):
+            if isinstance(m, mmap.mmap): m.close()
+        for f in self.files: f.close()
+
+    def entry(self, i):
+        "(timestamp, offset, length) of frame i"
+        return INDEX_ENTRY.unpack_from(self.index, i * INDEX_ENTRY.size)
+
+    def timestamp(self, i):
+        return struct.unpack_from('<d', self.index, i * INDEX_ENTRY.size)[0]
+
+    def find(self, t):
+        "Index of the last frame at or before time t, -1 if the segment starts after it"
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) <= t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo - 1
+
+    def frame(self, i):
+        "(timestamp, memoryview of the JPEG) of frame i, the frame must be within the mapped data"
+        timestamp, offset, length = self.entry(i)
+        if offset + length > len(self.data): raise IndexError('Frame %d is not flushed yet' % i)
+        return timestamp, memoryview(self.data)[offset:offset + length]
+
+    def frame_at(self, t):
+        "(timestamp, memoryview of the JPEG) of the frame showing time t, None if the segment starts after it"
+        i = self.find(t)
+        return None if i < 0 else self.frame(i)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.frame(i)
+
+class Recorder(object):
+    """
+    Records the video streams of any number of cameras, each on its own thread, into segments under a root directory
+    with a sub directory per camera. Segments are rotated every segment_seconds, retention is enforced over all the
+    cameras' segments together each time one rotates.
+    """
+
+    def __init__(self, root, segment_seconds=60.0, max_age=None, max_bytes=None, bufsize=1<<20, flush_interval=1.0, retry=5.0):
+        """Set up the recorder
+        @param root Directory to record to
+        @param segment_seconds Length of each segment
+        @param max_age Seconds to keep segments for, None to keep them regardless of age
+        @param max_bytes Most bytes of segments to keep, the oldest are deleted first, None for no limit
+        @param bufsize Write buffer size
+        @param flush_interval Seconds between flushes of the segment being written, so readers can see recent frames
+        @param retry Seconds to wait before reopening a stream which ended or failed
+        """
+        self.root = root
+        self.segment_seconds = segment_seconds
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.bufsize = bufsize
+        self.flush_interval = flush_interval
+        self.retry = retry
+        self.lock = threading.Lock()
+        self.retention = threading.Lock() # Only one thread enforces retention at a time
+        self.recordings = {} # name: _Recording
+        if not os.path.isdir(root): os.makedirs(root)
+
+    def record(self, name, foscam, resolution='VGA', rate='full'):
+        """Start recording a camera's video stream
+        @param name Name of the camera, its segments go in a sub directory of this name
+        @param foscam driver object, or anything with a frames(resolution, rate) method generating mjpeg.Frames
+        """
+        with self.lock:
+            if name in self.recordings: raise ValueError('Already recording "%s"' % name)
+            recording = self.recordings[name] = _Recording(self, name, foscam, resolution, rate)
+        recording.thread.start()
+        return recording
+
+    def stop(self, name):
+        "Stop recording a camera, closing its current segment"
+        with self.lock:
+            recording = self.recordings.pop(name)
+        recording.stop()
+
+    def close(self):
+        "Stop recording every camera"
+        for name in list(self.recordings): self.stop(name)
+
+    def directory(self, name):
+        return os.path.join(self.root, name)
+
+    def segments(self, name):
+        "Sorted base paths of a camera's segments"
+        directory = self.directory(name)
+        if not os.path.isdir(directory): return []
+        return [os.path.join(directory, f[:-len(INDEX_SUFFIX)]) for f in sorted(os.listdir(directory)) if f.endswith(INDEX_SUFFIX)]
+
+    def open_segment(self, name, t, timeout=1.0):
+        """Open the segment of a camera holding time t
+        @param timeout Most seconds to wait for the frames recorded so far to be flushed if the segment is still being
+               written. The recording thread flushes when it gets the next frame, so if the stream has stalled the
+               latest frames may be missing.
+        @return A Segment, which the caller must close, or None if there is no recording from before t"""
+        segments = self.segments(name)
+        starts = [int(os.path.basename(s)) / 1000.0 for s in segments]
+        i = bisect.bisect_right(starts, t) - 1
+        if i < 0: return None
+        recording = self.recordings.get(name)
+        if recording is not None and segments[i] == self._current(name): recording.sync(timeout)
+        return Segment(segments[i])
+
+    def _current(self, name):
+        recording = self.recordings.get(name)
+        writer = recording.writer if recording is not None else None
+        return writer.base if writer is not None else None
+
+    def enforce(self, now=None):
+        """Delete segments older than max_age, then the oldest segments until they fit in max_bytes. Segments being
+        written are never deleted.
+        @return Number of segments deleted"""
+        if now is None: now = time.time()
+        with self.retention:
+            return self._enforce(now)
+
+    def _enforce(self, now):
+        current = set(self._current(name) for name in list(self.recordings))
+        segments = []
+        for name in os.listdir(self.root):
+            for base in self.segments(name):
+                if base in current: continue
+                size = sum(os.path.getsize(base + suffix) for suffix in (DATA_SUFFIX, INDEX_SUFFIX) if os.path.exists(base + suffix))
+                segments.append((int(os.path.basename(base)) / 1000.0, base, size))
+        segments.sort()
+        total = sum(s[2] for s in segments) + sum(r.writer.size for r in list(self.recordings.values()) if r.writer is not None)
+        deleted = 0
+        for start, base, size in segments:
+            if not ((self.max_age is not None and start + self.segment_seconds < now - self.max_age) or
+                    (self.max_bytes is not None and total > self.max_bytes)):
+                break
+            for suffix in (DATA_SUFFIX, INDEX_SUFFIX):
+                try:
+                    os.remove(base + suffix)
+                except OSError:
+                    pass
+            total -= size
+            deleted += 1
+        return deleted
+
+class _Recording(object):
+    "The thread recording one camera"
+
+    def __init__(self, recorder, name, foscam, resolution, rate):
+        self.recorder = recorder
+        self.name = name
+        self.cam = foscam
+        self.resolution = resolution
+        self.rate = rate
+        self.writer = None
+        self.running = True
+        self.flush = False # Set by readers wanting the latest frames
+        self.written = 0 # Frames written
+        self.flushed = 0 # Frames written and flushed for readers to see
+        self.cond = threading.Condition()
+        self.stream = None
+        self.wake = threading.Event()
+        self.bytes = RECORDED_BYTES.labels(name)
+        self.frames = RECORDED_FRAMES.labels(name)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        directory = recorder.directory(name)
+        if not os.path.isdir(directory): os.makedirs(directory)
+
+    def _synced(self):
+        "Record that every frame written so far is visible to readers"
+        with self.cond:
+            self.flushed = self.written
+            self.cond.notify_all()
+
+    def sync(self, timeout=None):
+        """Have the frames written so far flushed and wait up to timeout seconds for it
+        @return True if they were flushed in time"""
+        with self.cond:
+            written = self.written
+            if self.flushed >= written: return True
+            self.flush = True
+            return self.cond.wait_for(lambda: self.flushed >= written, timeout)
+
+    def _rotate(self, timestamp):
+        if self.writer is not None:
+            self.writer.close()
+            self._synced()
+        self.writer = SegmentWriter(os.path.join(self.recorder.directory(self.name), segment_name(timestamp)), timestamp, self.recorder.bufsize)
+        self.recorder.enforce(timestamp)
+
+    def _run(self):
+        while self.running:
+            try:
+                self.stream = self.cam.frames(self.resolution, self.rate)
+                flushed = time.time()
+                for timestamp, frame in self.stream:
+                    if not self.running: break
+                    if self.writer is None or timestamp - self.writer.start >= self.recorder.segment_seconds:
+                        self._rotate(timestamp)
+                    self.writer.write(timestamp, frame)
+                    self.written += 1
+                    self.bytes.inc(len(frame))
+                    self.frames.inc()
+                    if self.flush or timestamp - flushed >= self.recorder.flush_interval:
+                        self.writer.flush()
+                        self.flush = False
+                        self._synced()
+                        flushed = timestamp
+            except Exception as e:
+                sys.stderr.write('Recording "%s" failed: %s%s' % (self.name, e, os.linesep))
+            finally:
+                if self.stream is not None and hasattr(self.stream, 'close'): self.stream.close()
+                self.stream = None
+            if self.writer is not None:
+                self.writer.flush()
+                self._synced()
+            if self.running: self.wake.wait(self.recorder.retry)
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        self.thread.join()
@@ -2,23 +2,47 @@
 """
 A general purpose action scheduling module.
 The Scheduler class includes a priority queue and it's own thread which executes runables from the queue in priority
-order.
+order. Runables may ask to start no earlier than a given time, the thread sleeps until something is runnable.
+Many schedulers can instead share the fixed pool of worker threads of an Engine, which runs one step of a scheduler at a
+time and sets a timer for its next start time rather than keeping a sleeping thread per scheduler.
 """
 __author__  = "Daniel Casner <www.danielcasner.org>"
 
+import os
+import sys
+import time
+import heapq
+import itertools
 import threading
+from collections import deque
+import metrics
+
+REMOVED = object() # Placeholder for cancelled entries left in the heap
+
+QUEUE_DEPTH = metrics.REGISTRY.gauge('scheduler_queue_depth', 'Runnables waiting in the scheduler queue', ('scheduler',))
+WAIT_SECONDS = metrics.REGISTRY.histogram('scheduler_wait_seconds', 'Time runnables waited to run after they could start', ('scheduler',))
 
 class PriorityQueue:
     """
     A priority queue where objects are added with a priority and popped based on their priority.
-    Complexity is pushed on the append method rather than pop.
+    The queue is a binary heap so append and pop are O(log n). Objects of equal priority are popped in the order they
+    were appended. append returns a handle which can be used to cancel or reprioritize the object later, cancelled
+    entries are left in the heap and skipped when they reach the top.
+    Objects may be given an earliest start time, they wait in a second heap ordered by start time until it passes.
+    Objects with an expire attribute are dropped instead of popped once time.time() passes it, or as soon as they are
+    appended with a start time after it.
     This priority queue also includes it's own mutex for thread safety.
     """
 
     def __init__(self):
         "Initialize empty priority queue."
-        self.q = []
+        self.q = [] # Heap of [-priority, sequence, object, start, posted time] entries which may run now
+        self.waiting = [] # Heap of (start, sequence, entry) for entries which may not run yet
         self.s = threading.Lock()
+        self.sequence = itertools.count()
+        self.size = 0
+        self.expired = 0
+        self.waited = 0.0 # Seconds the last popped object waited after it could start
     
     def __del__(self):
         "Clean up safely."
@@ -26,15 +50,12 @@ class PriorityQueue:
     
     def __len__(self):
         "Length of the queue, thread safe but not garunteed consistant"
-        return len(self.q)
+        return self.size
     
     @property
     def empty(self):
         "True if there are no elements in the queue, thread safe but not garunteed consistant"
-        self.aquire()
-        ret = len(self.q) == 0
-        self.release()
-        return ret
+        return self.size == 0
     
     def acquire(self):
         "Acquire the queue semaphore."
@@ -44,61 +65,421 @@ class PriorityQueue:
         "Release the queue semaphore."
         return self.s.release()
     
-    def append(self, priority, obj):
-        "Add an new object to the queue at the specified priority."
-        self.s.acquire()
-        for i, o in enumerate(self.q):
-            if priority <= o[0]:
-                self.q.insert(i, (priority, obj))
-                break
+    def append(self, priority, obj, start=None, first=False):
+        """Add an new object to the queue at the specified priority.
+        @param start Earliest time.time() the object may be popped, None for immediately
+        @param first Put the object ahead of objects already queued with the same priority
+        @return A handle for cancel and reprioritize, None if the object expires before start"""
+        with self.s:
+            if start is not None and self._expired(obj, start):
+                self.expired += 1
+                return None
+            sequence = next(self.sequence)
+            return self._push(priority, -sequence if first else sequence, obj, start, time.time())
+
+    def _push(self, priority, sequence, obj, start, posted):
+        entry = [-priority, sequence, obj, start, posted]
+        if start is None or start <= posted:
+            heapq.heappush(self.q, entry)
         else:
-            self.q.append((priority, obj))
-        self.s.release()
-            
-    def pop(self):
-        "Return the latest next (highest priority) object from the queue."
-        self.s.acquire()
-        retval = self.q.pop()
-        self.s.release()
-        return retval
+            heapq.heappush(self.waiting, (start, sequence, entry))
+        self.size += 1
+        return entry
+
+    def _remove(self, handle):
+        "Mark an entry removed, compacting the heaps if they are mostly removed entries"
+        if handle[2] is REMOVED: return False
+        handle[2] = REMOVED
+        self.size -= 1
+        if len(self.q) + len(self.waiting) > 64 and self.size < (len(self.q) + len(self.waiting)) // 2:
+            self._compact()
+        return True
+
+    def _compact(self):
+        self.q = [e for e in self.q if e[2] is not REMOVED]
+        heapq.heapify(self.q)
+        self.waiting = [w for w in self.waiting if w[2][2] is not REMOVED]
+        heapq.heapify(self.waiting)
+
+    def cancel(self, handle):
+        """Remove an object from the queue.
+        @return True if it was removed, False if it had already been popped or cancelled"""
+        with self.s:
+            return self._remove(handle)
+
+    def reprioritize(self, handle, priority):
+        """Change the priority of a queued object. It keeps its place among objects of the new priority as if it had
+        been appended at its original time.
+        @return The new handle for the object or None if it is no longer queued"""
+        with self.s:
+            obj = handle[2]
+            if not self._remove(handle): return None
+            return self._push(priority, handle[1], obj, handle[3], handle[4])
+
+    @staticmethod
+    def _expired(obj, now):
+        expire = getattr(obj, 'expire', None)
+        return expire is not None and now > expire
+
+    def _promote(self, now):
+        "Move entries whose start time has come from the waiting heap to the run heap"
+        while self.waiting and self.waiting[0][0] <= now:
+            entry = heapq.heappop(self.waiting)[2]
+            if entry[2] is not REMOVED: heapq.heappush(self.q, entry)
+
+    def pop(self, floor=None, exempt=None, cost=None, lookahead=8):
+        """Return the latest next (highest priority) object from the queue which may start now.
+        @param floor Only pop objects with a priority greater than this
+        @param exempt A handle which may be popped regardless of floor
+        @param cost Function of an object, if given the cheapest of the first lookahead objects with the top priority
+               is popped instead of the oldest
+        @return (priority, object)
+        @raise IndexError if nothing in the queue may run now"""
+        now = time.time()
+        with self.s:
+            self._promote(now)
+            band = []
+            while self.q:
+                entry = self.q[0]
+                priority, obj = entry[0], entry[2]
+                if obj is REMOVED:
+                    heapq.heappop(self.q)
+                    continue
+                if floor is not None and -priority <= floor and entry is not exempt:
+                    break
+                if band and (priority != band[0][0] or len(band) >= lookahead):
+                    break
+                heapq.heappop(self.q)
+                if self._expired(obj, now):
+                    entry[2] = REMOVED
+                    self.size -= 1
+                    self.expired += 1
+                    continue
+                band.append(entry)
+                if cost is None or entry is exempt: break
+            if not band: raise IndexError('nothing to pop from PriorityQueue')
+            best = min(band, key=lambda e: (cost(e[2]), e[1])) if len(band) > 1 else band[0]
+            for entry in band:
+                if entry is not best: heapq.heappush(self.q, entry)
+            obj = best[2]
+            best[2] = REMOVED
+            self.size -= 1
+            self.waited = now - max(best[4], best[3] or 0.0)
+            return -best[0], obj
+
+    def next_start(self):
+        "The earliest start time of the objects still waiting, None if none are waiting"
+        with self.s:
+            while self.waiting and self.waiting[0][2][2] is REMOVED:
+                heapq.heappop(self.waiting)
+            return self.waiting[0][0] if self.waiting else None
+
+    def purge(self, now=None):
+        """Remove all expired objects from the queue.
+        @return List of the objects removed"""
+        if now is None: now = time.time()
+        with self.s:
+            purged = []
+            for e in self.q + [w[2] for w in self.waiting]:
+                if e[2] is not REMOVED and self._expired(e[2], now):
+                    purged.append(e[2])
+                    e[2] = REMOVED
+            self._compact()
+            self.size -= len(purged)
+            self.expired += len(purged)
+            return purged
 
 
             
 class Scheduler:
     """A priorized action runner using threads thread action runner"""
         
-    def __init__(self):
-        "Set up the scheduler."
+    def __init__(self, cost=None, name='scheduler', engine=None):
+        """Set up the scheduler.
+        @param cost Optional function of a runnable giving the cost of switching to it. Among runnables of the same
+               priority the cheapest of the first few is run rather than strictly the oldest.
+        @param name Name of the scheduler in metrics
+        @param engine Engine to run the queue on, None for a thread of its own while there is work"""
         self.queue = PriorityQueue()
+        self.cost = cost
+        self.name = name
+        self.engine = engine
+        self.depth = QUEUE_DEPTH.labels(name)
+        self.waits = WAIT_SECONDS.labels(name)
         self.thread = None
+        self.cond = threading.Condition()
+        self.holder = None # (priority, handle) of the runnable holding the scheduler between runs
+        self.paused = False
 
     def append(self, priority, runnable):
         """Schedules a new action to be run.
         Runnable may be any object with a run method. The method should return True if the runnable wants to be re-
-        posted to the queue after being run."""
-        self.queue.append(priority, runnable)
-        self.scheduleThread()
+        posted to the queue after being run. Runnables may also have these attributes:
+            start  Earliest time.time() to run at, read each time the runnable is posted
+            expire The runnable is dropped without being run once time.time() passes this
+            hold   If true when run returns, only higher priority runnables may run until this one runs again
+        @return A handle for cancel and reprioritize, None if the runnable can't start before it expires"""
+        with self.cond:
+            handle = self.queue.append(priority, runnable, getattr(runnable, 'start', None))
+            self.depth.set(len(self.queue))
+            self.posted(priority, runnable, handle)
+            self.cond.notify()
+            self.scheduleThread()
+        return handle
+
+    def cancel(self, handle):
+        """Cancel a scheduled action which hasn't started running yet.
+        @return True if the action was cancelled"""
+        with self.cond:
+            self.cond.notify()
+            if self.engine is not None: self.engine.wake(self)
+            return self.queue.cancel(handle)
+
+    def reprioritize(self, handle, priority):
+        """Change the priority of a scheduled action which hasn't started running yet.
+        @return The action's new handle or None if it is no longer queued"""
+        with self.cond:
+            task = handle[2]
+            newHandle = self.queue.reprioritize(handle, priority)
+            if newHandle is not None:
+                if self.holder is not None and self.holder[1] is handle: self.holder = (priority, newHandle)
+                self.posted(priority, task, newHandle)
+            self.cond.notify()
+            if self.engine is not None: self.engine.wake(self)
+            return newHandle
     
+    def pause(self):
+        """Stop running actions, e.g. while the device they use is unreachable. Queued actions stay queued and may
+        expire. An action which fails while the scheduler is paused is queued again to run once it resumes, see
+        failed."""
+        with self.cond:
+            self.paused = True
+
+    def resume(self):
+        "Start running actions again after pause"
+        with self.cond:
+            self.paused = False
+            self.cond.notify()
+            if not self.queue.empty: self.scheduleThread()
+
     def scheduleThread(self):
-        """Fire off the priority queue processing thread if it isn't."""
-        if self.thread is None or self.thread.isAlive() is False:
-            self.thread = threading.Thread(target=self.processQueue)
+        """Fire off the priority queue processing thread if it isn't, or have the engine run the queue. Must be called
+        with cond held."""
+        if self.engine is not None:
+            self.engine.wake(self)
+        elif self.thread is None:
+            self.thread = threading.Thread(target=self.processQueue, name='scheduler ' + str(self.name))
             self.thread.start()
-    
+
+    def _pop(self):
+        """Pop the next task which may run now, must be called with cond held.
+        @return (priority, task) or None if nothing may run now"""
+        if self.paused: return None
+        if self.holder is not None and self.holder[1][2] is REMOVED:
+            self.holder = None # Cancelled while holding
+        try:
+            if self.holder is None:
+                item = self.queue.pop(cost=self.cost)
+            else:
+                try:
+                    item = self.queue.pop(self.holder[0], self.holder[1], self.cost)
+                except IndexError:
+                    if self.holder[1][2] is not REMOVED: raise # Still holding
+                    self.holder = None # Expired while holding, nothing else may be held back for it
+                    item = self.queue.pop(cost=self.cost)
+        except IndexError:
+            if self.queue.empty: self.depth.set(0)
+            return None
+        self.depth.set(len(self.queue))
+        self.waits.observe(self.queue.waited)
+        return item
+
+    def _ran(self, priority, task, repost):
+        "Repost a task which has run if it asked to be, must be called with cond held"
+        if self.holder is not None and self.holder[1][2] is REMOVED:
+            self.holder = None
+        if repost:
+            handle = self.queue.append(priority, task, getattr(task, 'start', None), first=getattr(task, 'hold', False))
+            self.depth.set(len(self.queue))
+            self.posted(priority, task, handle)
+            if getattr(task, 'hold', False) and handle is not None:
+                self.holder = (priority, handle)
+
+    def nextTask(self):
+        """Wait for the next runnable task.
+        @return (priority, task) or None when the queue is empty"""
+        with self.cond:
+            while True:
+                item = self._pop()
+                if item is not None or self.queue.empty: return item
+                nextStart = None if self.paused else self.queue.next_start()
+                self.cond.wait(None if nextStart is None else max(0.0, nextStart - time.time()))
+
     def processQueue(self):
         """Execute anything from the priorityQueue"""
         while True:
-            if self.queue.empty:
-                break
-            else:
-                priority, task = self.queue.pop()
-                self.queue.release()
-                repost = task.run()
-                if repost:
-                    self.queue.append(priority, task)
-        self.queueDone()
+            item = self.nextTask()
+            if item is None:
+                self._done()
+                with self.cond:
+                    if self.queue.empty: # Nothing arrived during queueDone
+                        self.thread = None
+                        return
+                continue
+            priority, task = item
+            repost = self._run(task)
+            with self.cond:
+                self._ran(priority, task, repost)
+
+    def _run(self, task):
+        """Run a task, if it fails either log and drop it or retry it as failed decides.
+        @return True if the task should be reposted"""
+        try:
+            return task.run()
+        except Exception as e:
+            delay = self.failed(task, e)
+            if delay is None:
+                sys.stderr.write('Scheduler "%s" task failed: %s%s' % (self.name, e, os.linesep))
+                try:
+                    self.dropped(task, e)
+                except Exception as e:
+                    sys.stderr.write('Scheduler "%s" dropped failed: %s%s' % (self.name, e, os.linesep))
+                return False
+            task.start = time.time() + delay
+            return True
+
+    def _done(self):
+        "Call queueDone unless paused, logging any failure"
+        if self.paused: return
+        try:
+            self.queueDone()
+        except Exception as e:
+            sys.stderr.write('Scheduler "%s" queueDone failed: %s%s' % (self.name, e, os.linesep))
+
+    def step(self):
+        """Run at most one task, for an Engine.
+        @return When the scheduler next has something to do, None if only when something is appended"""
+        with self.cond:
+            item = self._pop()
+            if item is None:
+                if self.paused: return None # Woken by resume
+                if not self.queue.empty: return self.queue.next_start()
+        if item is None:
+            self._done()
+            with self.cond:
+                return None if self.queue.empty else time.time() # Something arrived during queueDone
+        priority, task = item
+        repost = self._run(task)
+        with self.cond:
+            self._ran(priority, task, repost)
+        return time.time()
                     
+    def posted(self, priority, task, handle):
+        "Method to be overridden by subclasses to track tasks as they are posted to the queue, called with cond held"
+        pass
+
     def queueDone(self):
         "Method to be overridden by subclasses for taking specific action when the queue is done"
         pass
-
+
+    def failed(self, task, error):
+        """Method which may be overridden by subclasses to decide what happens to a task whose run raised an exception.
+        @return Seconds to wait before running it again, or None to drop it. By default tasks which fail while the
+        scheduler is paused are run again once it resumes and others are dropped."""
+        return 0.0 if self.paused else None
+
+    def dropped(self, task, error):
+        "Method to be overridden by subclasses for taking specific action when a failed task is dropped"
+        pass
+
+READY, RUNNING, RERUN = range(3)
+
+class Engine:
+    """
+    Runs the queues of many Schedulers on a small fixed pool of worker threads.
+    A scheduler is stepped by one worker at a time, running a single task, so each scheduler's tasks still run one after
+    another in its priority order while different schedulers run in parallel. Schedulers waiting for a start time are
+    put on a timer heap rather than holding a sleeping thread, so the thread count stays fixed however many there are.
+    """
+
+    def __init__(self, workers=4, name='engine'):
+        """Start the worker threads
+        @param workers Number of worker threads, the most schedulers stepping at once
+        @param name Name of the worker threads"""
+        self.cond = threading.Condition()
+        self.ready = deque() # Schedulers to step
+        self.states = {} # scheduler: READY, RUNNING or RERUN, absent when idle
+        self.timers = [] # Heap of (time, sequence, scheduler), stale unless the time is in deadlines
+        self.deadlines = {} # scheduler: time of its timer
+        self.sequence = itertools.count()
+        self.running = True
+        self.workers = [threading.Thread(target=self._work, name='%s %d' % (name, n)) for n in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def __len__(self):
+        "Number of schedulers waiting to be stepped, thread safe but not garunteed consistant"
+        return len(self.ready)
+
+    def wake(self, scheduler):
+        "Have a scheduler stepped as soon as a worker is free"
+        with self.cond:
+            self._wake(scheduler)
+
+    def _wake(self, scheduler):
+        state = self.states.get(scheduler)
+        if state is None:
+            self.states[scheduler] = READY
+            self.ready.append(scheduler)
+            self.cond.notify()
+        elif state == RUNNING:
+            self.states[scheduler] = RERUN # Appended to while stepping, step again afterwards
+
+    def _timer(self, scheduler, when):
+        "Step a scheduler at a time, must be called with cond held"
+        deadline = self.deadlines.get(scheduler)
+        if deadline is not None and deadline <= when: return
+        self.deadlines[scheduler] = when
+        heapq.heappush(self.timers, (when, next(self.sequence), scheduler))
+        self.cond.notify()
+
+    def _next(self):
+        "Wait for a scheduler to step, must be called with cond held. @return The scheduler or None when closed"
+        while self.running:
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                when, sequence, scheduler = heapq.heappop(self.timers)
+                if self.deadlines.get(scheduler) == when:
+                    del self.deadlines[scheduler]
+                    self._wake(scheduler)
+            if self.ready:
+                scheduler = self.ready.popleft()
+                self.states[scheduler] = RUNNING
+                return scheduler
+            self.cond.wait(self.timers[0][0] - now if self.timers else None)
+        return None
+
+    def _work(self):
+        while True:
+            with self.cond:
+                scheduler = self._next()
+            if scheduler is None: return
+            try:
+                when = scheduler.step()
+            except Exception as e:
+                sys.stderr.write('Scheduler "%s" task failed: %s%s' % (scheduler.name, e, os.linesep))
+                when = time.time()
+            with self.cond:
+                rerun = self.states.pop(scheduler) == RERUN
+                if rerun or (when is not None and when <= time.time()):
+                    self._wake(scheduler)
+                elif when is not None:
+                    self._timer(scheduler, when)
+
+    def close(self):
+        "Stop the workers once they finish the steps they are running, queued tasks are left unrun"
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        for worker in self.workers: worker.join()
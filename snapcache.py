@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+A shared cache of recent camera snapshots.
+Consumers asking the same camera for the same image within a short time are served one fetched image instead of each
+making a CGI call, and callers arriving while a fetch is in flight wait for it rather than starting their own.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import time
+import threading
+from collections import OrderedDict
+
+class _Fetch(object):
+    "An in flight fetch which other callers for the same key can wait on"
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.data = None
+        self.error = None
+
+class SnapshotCache(object):
+    """
+    A thread safe snapshot cache with a maximum age and least recently used eviction bounded by total bytes.
+    Keys are arbitrary, FoscamControl uses (camera URL, resolution, preset, time the preset was commanded) so moving
+    the camera, even away and back to the same preset, never returns the old view. The hits, misses and coalesced counters count requests served from the cache, fetched
+    from the camera and served by waiting on another caller's fetch.
+    """
+
+    def __init__(self, maxAge=1.0, maxBytes=16 * 1024 * 1024):
+        """Set up an empty cache
+        @param maxAge Seconds a snapshot may be served for after it was fetched
+        @param maxBytes Most image bytes to keep, least recently used images are evicted first
+        """
+        self.maxAge = maxAge
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict() # key: (fetched time, data)
+        self.inflight = {} # key: _Fetch
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def stats(self):
+        "Dictionary of the cache counters"
+        return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced, 'entries': len(self.entries), 'bytes': self.bytes}
+
+    def get(self, key, fetch, maxAge=None):
+        """Get a snapshot from the cache, calling fetch() to get it from the camera if there is no fresh one.
+        @param key Cache key
+        @param fetch Function returning the image data
+        @param maxAge Override the cache's maximum age for this call
+        """
+        if maxAge is None: maxAge = self.maxAge
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] <= maxAge:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            pending = self.inflight.get(key)
+            if pending is None:
+                self.misses += 1
+                pending = self.inflight[key] = _Fetch()
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            pending.done.wait()
+            if pending.error is not None: raise pending.error
+            return pending.data
+        try:
+            pending.data = fetch()
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+                if pending.error is None: self._store(key, pending.data)
+            pending.done.set()
+        return pending.data
+
+    def _store(self, key, data):
+        "Add an entry and evict least recently used ones to stay within maxBytes, called with the lock held"
+        old = self.entries.pop(key, None)
+        if old is not None: self.bytes -= len(old[1])
+        if len(data) > self.maxBytes: return
+        self.entries[key] = (time.time(), data)
+        self.bytes += len(data)
+        while self.bytes > self.maxBytes:
+            k, (t, d) = self.entries.popitem(last=False)
+            self.bytes -= len(d)
+
+    def invalidate(self, match=None):
+        """Drop cached snapshots
+        @param match Function of a key returning True for the entries to drop, None to drop everything"""
+        with self.lock:
+            for key in [k for k in self.entries if match is None or match(k)]:
+                self.bytes -= len(self.entries.pop(key)[1])
@@ -7,7 +7,7 @@ import sys
 import os
 import platform
 import control
-import time
+import limiter
 from getpass import getpass
 
 def instantiateFoscam():
@@ -19,7 +19,7 @@ def instantiateFoscam():
         user = input("Foscam User>>> ")
         pwd  = getpass("Foscam Password>>> ")
         open(CACHE_FN, 'w').write('%s\n%s\n%s' % (url, user, pwd))
-    return control.FoscamControl(url, user, pwd)
+    return control.FoscamControl(url, user, pwd, limiter=limiter.HostLimiter(rate=1.0, burst=1, max_inflight=1))
 
 
 class ControllerTest(unittest.TestCase):
@@ -47,15 +47,12 @@ class ControllerTest(unittest.TestCase):
         
     def test_videostream(self):
         self.skipTest("Don't have a good way to test video streams yet.")
-        time.sleep(1.0)
         
     def test_get_status(self):
-        self.assertIsInstance(self.cam.get_status(), dict)
-        time.sleep(1.0)
+        self.assertIsInstance(self.cam.get_status(), control.Record)
         
     def test_get_camera_params(self):
-        self.assertIsInstance(self.cam.get_camera_params(), dict)
-        time.sleep(1.0)
+        self.assertIsInstance(self.cam.get_camera_params(), control.Record)
         
     def test_control(self):
         for command in control.CONTROL_COMMANDS:
@@ -63,12 +60,10 @@ class ControllerTest(unittest.TestCase):
                 for degree in [None, 0, 10, 20, 30]:
                     rslt = self.cam.control(command, onestep, degree)
                     sys.stdout.write('FoscamControl({}, {}, {}) --> {}\n'.format(*[repr(a) for a in [command, onestep, degree, rslt]]))
-                    self.assertIsInstance(rslt, dict)
-                    time.sleep(1.0) # Rate limit
+                    self.assertIsInstance(rslt, control.Record)
     
     def test_preset(self):
         assertIsInstance(self.cam.goto_preset(1), dict)
-        time.sleep(1.0)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,25 @@
+import gc
+import asyncio
+import warnings
+import pytest
+import asynccontrol
+from emulator import FoscamEmulator
+
+@pytest.fixture
+def emulator():
+    e = FoscamEmulator().start()
+    yield e
+    e.stop()
+
+def test_timed_out_request_closes_its_connection(emulator):
+    emulator.down = True
+    async def main():
+        pool = asynccontrol.AsyncConnectionPool(emulator.url, timeout=0.2)
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.request('/get_status.cgi')
+        assert len(pool) == 0
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always', ResourceWarning)
+        asyncio.run(main())
+        gc.collect()
+    assert not [w for w in caught if issubclass(w.category, ResourceWarning)]
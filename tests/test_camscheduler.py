@@ -0,0 +1,97 @@
+import time
+import threading
+import camscheduler
+import health
+import pytest
+
+class Camera(object):
+    defaultPreset = 1
+
+    def __init__(self, failures=0):
+        self.preset = 1
+        self.presetTime = 0.0
+        self.failures = failures
+        self.snapshots = 0
+        self.breaker = health.CircuitBreaker(failures=100, reset_timeout=0.05)
+
+    def goto_preset(self, preset):
+        self.preset = preset
+        self.presetTime = time.time()
+
+    def snapshot(self, resolution='VGA', fresh=False):
+        self.snapshots += 1
+        if self.snapshots <= self.failures: raise ConnectionResetError('camera went away')
+        return b'\xff\xd8' + bytes([self.snapshots]) + b'\xff\xd9'
+
+def wait_idle(s, timeout=5.0):
+    deadline = time.time() + timeout
+    while (len(s.queue) or s.thread is not None) and time.time() < deadline: time.sleep(0.01)
+
+def test_callback_error_does_not_retake_snapshot():
+    camera = Camera()
+    s = camscheduler.FoscamScheduler(camera)
+    calls = []
+    def good(image, preset, final, userdata): calls.append('good')
+    def bad(image, preset, final, userdata):
+        calls.append('bad')
+        raise TypeError('bad callback')
+    s.snapshot(0, 1, good)
+    s.snapshot(0, 1, bad)
+    wait_idle(s)
+    assert camera.snapshots == 1
+    assert sorted(calls) == ['bad', 'good']
+
+def test_transport_failure_retried_a_limited_number_of_times():
+    camera = Camera(failures=2)
+    s = camscheduler.FoscamScheduler(camera)
+    got = threading.Event()
+    s.snapshot(0, 1, lambda *args: got.set())
+    assert got.wait(5.0)
+    assert camera.snapshots == 3
+
+    camera = Camera(failures=100)
+    s = camscheduler.FoscamScheduler(camera, retries=2)
+    s.snapshot(0, 1, lambda *args: None)
+    wait_idle(s)
+    assert camera.snapshots == 3 # The first try and two retries
+
+def test_transport_failure_not_retried_past_expiry():
+    camera = Camera(failures=100)
+    s = camscheduler.FoscamScheduler(camera, retries=100)
+    s.snapshot(0, 1, lambda *args: None, expire=time.time() + 0.12)
+    wait_idle(s)
+    assert camera.snapshots <= 3
+
+def jpeg(np, scene, shift):
+    import io
+    from PIL import Image
+    out = io.BytesIO()
+    Image.fromarray(np.roll(scene, shift, axis=1)).save(out, 'JPEG', quality=75)
+    return out.getvalue()
+
+class PanningCamera(Camera):
+    "Pans across a scene for a number of snapshots after each seek, then holds still"
+
+    def __init__(self, frames):
+        Camera.__init__(self)
+        self.frames = frames
+
+    def snapshot(self, resolution='VGA', fresh=False):
+        self.snapshots += 1
+        return self.frames[min(self.snapshots, len(self.frames)) - 1]
+
+def test_settle_detector_sees_pan_with_steady_jpeg_size():
+    np = pytest.importorskip('numpy')
+    pytest.importorskip('PIL')
+    scene = np.random.RandomState(0).randint(0, 256, (120, 160)).astype(np.uint8) # Same content, so similar sizes
+    frames = [jpeg(np, scene, 8 * n) for n in range(6)] # Panning
+    camera = PanningCamera(frames + [frames[-1]] * 4)
+    detector = camscheduler.SettleDetector(camera, pollInterval=0.01, threshold=0.02, stablePolls=2)
+    sizes = [len(frame) for frame in frames]
+    assert max(sizes) - min(sizes) <= 0.02 * max(sizes) # Sizes alone would call the camera still
+    now = detector.seek(2)
+    while True:
+        settled, again = detector.check(now)
+        if settled is not None: break
+        now = again
+    assert camera.snapshots == len(frames) + 2
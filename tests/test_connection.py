@@ -0,0 +1,66 @@
+import time
+import threading
+import pytest
+from urllib.error import HTTPError
+import connection
+from emulator import FoscamEmulator
+
+STATUS = '/get_status.cgi?user=admin&pwd='
+
+@pytest.fixture
+def emulator():
+    e = FoscamEmulator().start()
+    yield e
+    e.stop()
+
+def test_requests_reuse_one_connection(emulator):
+    pool = connection.ConnectionPool(emulator.url)
+    for n in range(20):
+        assert b'var id=' in pool.request(STATUS)
+    assert emulator.counters['connections'] == 1
+    assert len(pool) == 1
+    pool.close()
+
+def test_connection_dropped_by_camera_is_retried(emulator):
+    emulator.idle_timeout = 0.1
+    pool = connection.ConnectionPool(emulator.url)
+    pool.request(STATUS)
+    time.sleep(0.3) # The camera hangs up on the idle connection
+    assert b'var id=' in pool.request(STATUS)
+    assert emulator.counters['connections'] == 2
+    pool.close()
+
+def test_idle_connections_expire(emulator):
+    pool = connection.ConnectionPool(emulator.url, idle_timeout=0.1)
+    pool.request(STATUS)
+    time.sleep(0.2)
+    pool.request(STATUS)
+    assert emulator.counters['connections'] == 2
+    assert len(pool) == 1
+    pool.close()
+
+def test_concurrent_requests_keep_at_most_maxsize(emulator):
+    emulator.latency = 0.05
+    pool = connection.ConnectionPool(emulator.url, maxsize=2)
+    errors = []
+    def work():
+        try:
+            pool.request(STATUS)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=work) for n in range(6)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert not errors
+    assert emulator.counters['connections'] == 6
+    assert len(pool) == 2
+    pool.close()
+
+def test_failed_request_not_pooled(emulator):
+    emulator.error_rate = 1.0
+    pool = connection.ConnectionPool(emulator.url)
+    with pytest.raises(HTTPError) as error:
+        pool.request(STATUS)
+    assert error.value.code == 500
+    assert len(pool) == 0
+    pool.close()
@@ -0,0 +1,83 @@
+import time
+import pytest
+import control
+import snapcache
+from emulator import FoscamEmulator
+
+@pytest.fixture
+def emulator():
+    e = FoscamEmulator(seek_time=0.3).start()
+    yield e
+    e.stop()
+
+def cached_camera(emulator):
+    return control.FoscamControl(emulator.url, 'admin', '', snapshot_cache=snapcache.SnapshotCache(maxAge=60.0), limiter=False, settle_time=0.3)
+
+def test_snapshots_cached_once_settled(emulator):
+    cam = cached_camera(emulator)
+    cam.goto_preset(1)
+    time.sleep(0.35)
+    assert cam.snapshot() is cam.snapshot()
+
+def test_no_cached_snapshot_after_manual_move(emulator):
+    cam = cached_camera(emulator)
+    cam.goto_preset(1)
+    time.sleep(0.35)
+    before = cam.snapshot()
+    cam.control('LEFT')
+    after = cam.snapshot()
+    assert after != before
+    assert cam.snapshot() != after # Position unknown, never cached
+
+def test_snapshot_while_seeking_not_served_once_settled(emulator):
+    cam = cached_camera(emulator)
+    cam.goto_preset(1)
+    time.sleep(0.35)
+    settled = cam.snapshot()
+    cam.goto_preset(2)
+    moving = cam.snapshot()
+    assert moving != settled
+    time.sleep(0.35)
+    assert cam.snapshot() != moving
+
+def test_settle_detection_enables_caching(emulator):
+    cam = cached_camera(emulator)
+    cam.settle_time = 60.0
+    cam.goto_preset(1)
+    assert cam.snapshot() != cam.snapshot()
+    cam.settled = time.time()
+    assert cam.snapshot() is cam.snapshot()
+
+def test_setter_drops_results_cached_while_it_ran(emulator):
+    class Racing(control.FoscamControl):
+        def _read_raw(self, cgi, args=None, timeout=None):
+            if cgi == 'set_misc.cgi': self.get_misc() # Another thread reads the old setting meanwhile
+            return control.FoscamControl._read_raw(self, cgi, args, timeout)
+    cam = Racing(emulator.url, 'admin', '', limiter=False, cache_ttl=control.FoscamControl.CACHE_TTL)
+    assert cam.get_misc().led_mode == 0
+    cam.set_misc(led_mode=1)
+    assert cam.get_misc().led_mode == 1
+
+def test_results_not_cached_by_default(emulator):
+    cam = control.FoscamControl(emulator.url, 'admin', '', limiter=False)
+    assert cam.get_misc().led_mode == 0
+    emulator.misc['led_mode'] = 1 # Changed behind the driver's back, e.g. through the camera's web page
+    assert cam.get_misc().led_mode == 1
+    assert cam.results == {}
+
+def test_cached_results_are_copies(emulator):
+    cam = control.FoscamControl(emulator.url, 'admin', '', limiter=False, cache_ttl=control.FoscamControl.CACHE_TTL)
+    first = cam.get_misc()
+    first.led_mode = 5
+    first.extra['x'] = 1
+    second = cam.get_misc()
+    assert second.led_mode == 0 and 'x' not in second
+    assert second == cam.get_misc() and second is not cam.get_misc()
+
+def test_parse_vars():
+    raw = b"var id='000DC5';\nvar now=1357560000;\nvar tz=-3600;\nvar alias='';\nvar p2p_status= 1 ;\nvar other='a b';\nvar odd=x1;\n"
+    status = control.parse_vars(raw, control.StatusRecord)
+    assert (status.id, status.now, status.tz, status.alias, status.p2p_status) == ('000DC5', 1357560000, -3600, '', 1)
+    assert status.extra == {'other': 'a b', 'odd': 'x1'}
+    assert status.wifi_status is None and 'wifi_status' not in status
+    assert control.parse_vars(b"var tz='abc';", control.StatusRecord).tz == 'abc'
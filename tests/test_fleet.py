@@ -0,0 +1,59 @@
+import pytest
+import fleet
+import control
+from emulator import FoscamEmulator
+
+@pytest.fixture
+def emulators():
+    started = []
+    def start(*latencies):
+        started.extend(FoscamEmulator(latency=latency).start() for latency in latencies)
+        return started
+    yield start
+    for e in started: e.stop()
+
+def make_fleet(emulators, workers=32, timeout=10.0):
+    cameras = dict(('cam%d' % n, control.FoscamControl(e.url, 'admin', '', limiter=False)) for n, e in enumerate(emulators))
+    return fleet.FoscamFleet(cameras, workers, timeout)
+
+def test_results_in_completion_order(emulators):
+    cameras = make_fleet(emulators(0.4, 0.0, 0.2))
+    try:
+        results = list(cameras.get_status_all())
+        assert [result.name for result in results] == ['cam1', 'cam2', 'cam0']
+        assert all(result.error is None and result.value.id for result in results)
+        assert results[0].elapsed < results[1].elapsed < results[2].elapsed
+    finally:
+        cameras.close()
+
+def test_slow_camera_times_out_alone(emulators):
+    cameras = make_fleet(emulators(0.0, 1.0, 0.0))
+    try:
+        results = dict((result.name, result) for result in cameras.get_status_all(timeout=0.3))
+        assert sorted(results) == ['cam0', 'cam1', 'cam2']
+        assert results['cam0'].error is None and results['cam2'].error is None
+        assert isinstance(results['cam1'].error, fleet.TimeoutError)
+        assert 0.3 <= results['cam1'].elapsed < 1.0
+    finally:
+        cameras.close()
+
+def test_timeout_counts_from_when_a_call_starts(emulators):
+    cameras = make_fleet(emulators(0.3, 0.3), workers=1) # The second camera waits for the first's worker
+    try:
+        results = list(cameras.get_status_all(timeout=0.5))
+        assert [result.name for result in results] == ['cam0', 'cam1']
+        assert [result.error for result in results] == [None, None]
+        assert all(result.elapsed < 0.5 for result in results)
+    finally:
+        cameras.close()
+
+def test_run_calls_reports_errors_by_name(emulators):
+    cameras = make_fleet(emulators(0.0))
+    def fail():
+        raise ValueError('bad response')
+    try:
+        results = dict((result.name, result) for result in cameras.run_calls({'ok': lambda: 1, 'bad': fail}))
+        assert results['ok'].value == 1 and results['ok'].error is None
+        assert results['bad'].value is None and isinstance(results['bad'].error, ValueError)
+    finally:
+        cameras.close()
@@ -0,0 +1,82 @@
+import json
+import time
+import foscamqtt
+
+IMAGE = b'\xff\xd8same\xff\xd9'
+
+class Camera(object):
+    defaultPreset = 1
+
+    def __init__(self, fail=False):
+        self.preset = 1
+        self.presetTime = 0.0
+        self.fail = fail
+        self.snapshots = 0
+
+    def goto_preset(self, preset):
+        self.preset = preset
+        self.presetTime = time.time()
+
+    def snapshot(self, resolution='VGA', fresh=False):
+        self.snapshots += 1
+        if self.fail: raise ValueError('bad response')
+        return IMAGE # The same object every time, as the snapshot cache hands out
+
+class Message(object):
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+class Server(foscamqtt.CamqttServer):
+    def __init__(self, camera):
+        self.published = []
+        foscamqtt.CamqttServer.__init__(self, 'test', None, {'cam': camera})
+
+    def publish_snapshot(self, camera, preset, final, snapshot):
+        self.published.append((camera, preset, final, snapshot))
+
+def request(server, command, args):
+    server.on_message(server, None, Message('cam' + server.REQUEST_SUFFIX, json.dumps([command, args]).encode()))
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline: time.sleep(0.01)
+    return condition()
+
+def test_failed_request_does_not_block_identical_ones():
+    camera = Camera(fail=True)
+    server = Server(camera)
+    try:
+        request(server, 'snapshot', {'priority': 0, 'preset': 1})
+        assert wait_for(lambda: camera.snapshots == 1 and not server.pending)
+        request(server, 'snapshot', {'priority': 0, 'preset': 1})
+        assert wait_for(lambda: camera.snapshots == 2)
+        assert server.duplicates == 0
+    finally:
+        server.close()
+
+def test_expired_request_does_not_block_identical_ones():
+    camera = Camera()
+    server = Server(camera)
+    try:
+        args = {'priority': 0, 'preset': 1, 'expire': time.time() + 0.1}
+        server.schedulers['cam'].pause()
+        request(server, 'snapshot', args)
+        time.sleep(0.2)
+        request(server, 'snapshot', args)
+        assert server.duplicates == 0
+    finally:
+        server.schedulers['cam'].resume()
+        server.close()
+
+def test_separate_requests_sharing_an_image_are_both_published():
+    camera = Camera()
+    server = Server(camera)
+    try:
+        request(server, 'snapshot', {'priority': 0, 'preset': 1})
+        assert wait_for(lambda: len(server.published) == 1)
+        request(server, 'snapshot', {'priority': 1, 'preset': 1})
+        assert wait_for(lambda: len(server.published) == 2)
+        assert server.published[0][3] is server.published[1][3]
+    finally:
+        server.close()
@@ -0,0 +1,98 @@
+import time
+import asyncio
+import pytest
+import health
+import control
+import asynccontrol
+import camscheduler
+from emulator import FoscamEmulator
+
+@pytest.fixture
+def emulator():
+    e = FoscamEmulator().start()
+    yield e
+    e.down = False
+    e.stop()
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline: time.sleep(0.01)
+    return condition()
+
+def test_breaker_opens_probes_once_and_closes():
+    breaker = health.CircuitBreaker(failures=2, reset_timeout=0.05)
+    changes = []
+    breaker.listeners.append(lambda b, old, new: changes.append((old, new)))
+    breaker.before()
+    breaker.failure()
+    assert breaker.state == health.CLOSED
+    breaker.failure()
+    assert breaker.state == health.OPEN
+    with pytest.raises(health.CameraUnavailable):
+        breaker.before()
+    time.sleep(0.06)
+    assert breaker.allow() # The probe
+    assert breaker.state == health.HALF_OPEN
+    assert not breaker.allow() # Only one probe at a time
+    breaker.success()
+    assert breaker.state == health.CLOSED and breaker.allow()
+    assert changes == [(health.CLOSED, health.OPEN), (health.OPEN, health.HALF_OPEN), (health.HALF_OPEN, health.CLOSED)]
+    assert breaker.outages == 1
+
+def test_failed_probe_backs_off_further():
+    breaker = health.CircuitBreaker(failures=1, reset_timeout=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == health.OPEN and breaker.backoff == 0.1
+    time.sleep(0.06)
+    assert not breaker.allow()
+    time.sleep(0.05)
+    assert breaker.allow()
+
+def test_abandoned_probe_allows_another():
+    breaker = health.CircuitBreaker(failures=1, reset_timeout=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.abandon()
+    assert breaker.state == health.OPEN and not breaker.probing and breaker.backoff == 0.05
+    time.sleep(0.06)
+    assert breaker.allow()
+
+def test_cancelled_async_probe_does_not_wedge_the_breaker(emulator):
+    breaker = health.CircuitBreaker(failures=1, reset_timeout=0.05)
+    cam = asynccontrol.AsyncFoscamControl(emulator.url, 'admin', '', limiter=False, breaker=breaker)
+    async def main():
+        emulator.down = True
+        with pytest.raises(asyncio.TimeoutError):
+            await cam.get_status(timeout=0.1)
+        assert breaker.state == health.OPEN
+        await asyncio.sleep(0.06)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(cam.get_status(), 0.1) # The probe, cancelled by the caller
+        emulator.down = False
+        await asyncio.sleep(0.06)
+        status = await cam.get_status(timeout=1.0)
+        assert status.id == emulator.params['id']
+        assert breaker.state == health.CLOSED
+        cam.pool.close()
+    asyncio.run(main())
+
+def test_monitor_pauses_and_recovers_camera(emulator):
+    cam = control.FoscamControl(emulator.url, 'admin', '', limiter=False)
+    scheduler = camscheduler.FoscamScheduler(cam)
+    monitor = health.HealthMonitor(min_interval=0.05, max_interval=0.2, timeout=0.2, failures=1, reset_timeout=0.1, max_reset_timeout=0.2)
+    try:
+        camera = monitor.add('cam', cam, scheduler)
+        assert wait_for(lambda: camera.polls >= 1 and cam.breaker.state == health.CLOSED)
+        cam.goto_preset(3)
+        emulator.down = True
+        assert wait_for(lambda: cam.breaker.state != health.CLOSED and scheduler.paused)
+        emulator.down = False
+        assert wait_for(lambda: cam.breaker.state == health.CLOSED and not scheduler.paused)
+        assert camera.recoveries == 1
+        assert emulator.preset == cam.defaultPreset # Sent back to the default preset
+    finally:
+        monitor.close()
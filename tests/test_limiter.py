@@ -0,0 +1,81 @@
+import time
+import asyncio
+import threading
+import pytest
+import limiter
+
+class Clock(object):
+    "A clock which only moves when told to"
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def started(lim, timeout=0):
+    "True if a request may start on the limiter, taking its slot"
+    try:
+        lim.acquire(timeout=timeout)
+    except TimeoutError:
+        return False
+    return True
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline: time.sleep(0.01)
+    return condition()
+
+def test_token_bucket_rate():
+    clock = Clock()
+    lim = limiter.HostLimiter(rate=2.0, burst=2, max_inflight=None, clock=clock)
+    assert started(lim) and started(lim)
+    assert not started(lim)
+    clock.now += 0.25
+    assert not started(lim)
+    clock.now += 0.25
+    assert started(lim)
+    assert not started(lim)
+    clock.now += 60.0 # Tokens don't pile up beyond the burst
+    assert [started(lim) for n in range(3)] == [True, True, False]
+
+def test_inflight_cap():
+    lim = limiter.HostLimiter(max_inflight=2, clock=Clock())
+    assert started(lim) and started(lim)
+    assert not started(lim)
+    lim.release()
+    assert started(lim)
+    assert not started(lim)
+    assert lim.inflight == 2
+
+def test_lanes_served_highest_first_then_in_arrival_order():
+    lim = limiter.HostLimiter(max_inflight=1, clock=Clock())
+    lim.acquire()
+    order = []
+    def request(name, lane):
+        with lim.slot(lane): order.append(name)
+    threads = []
+    for name, lane in (('bulk', limiter.BULK), ('normal1', limiter.NORMAL), ('control', limiter.CONTROL), ('normal2', limiter.NORMAL)):
+        threads.append(threading.Thread(target=request, args=(name, lane)))
+        threads[-1].start()
+        assert wait_for(lambda: len(lim) == len(threads))
+    lim.release()
+    for thread in threads: thread.join(5.0)
+    assert order == ['control', 'normal1', 'normal2', 'bulk']
+    assert lim.inflight == 0
+
+def test_acquire_times_out_without_taking_a_slot():
+    lim = limiter.HostLimiter(max_inflight=1)
+    lim.acquire()
+    with pytest.raises(TimeoutError):
+        lim.acquire(timeout=0.05)
+    lim.release()
+    assert started(lim) # The waiter which gave up didn't get the released slot
+    assert lim.inflight == 1
+
+def test_async_acquire_times_out_without_taking_a_slot():
+    lim = limiter.HostLimiter(max_inflight=1)
+    lim.acquire()
+    with pytest.raises(TimeoutError):
+        asyncio.run(lim.aacquire(timeout=0.05))
+    lim.release()
+    assert started(lim)
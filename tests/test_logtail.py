@@ -0,0 +1,84 @@
+import time
+import pytest
+import fleet
+import control
+import logtail
+from emulator import FoscamEmulator
+
+def log(*lines):
+    "A get_log.cgi response of lines"
+    return ("var log_text='%s';\n" % '\\n'.join(lines)).encode()
+
+def line(second, event='access', user='admin'):
+    return 'Mon, 2013-01-07 12:00:%02d %s 127.0.0.1 %s' % (second, user, event)
+
+class Camera(object):
+    name = 'camera'
+
+    def __init__(self, *lines):
+        self.lines = list(lines)
+
+    def get_log(self, timeout=None):
+        return log(*self.lines)
+
+@pytest.fixture
+def emulator():
+    e = FoscamEmulator().start()
+    yield e
+    e.stop()
+
+def test_timed_out_poll_loses_no_entries(emulator):
+    emulator.log = [line(n) for n in range(3)]
+    cameras = fleet.FoscamFleet({'cam': control.FoscamControl(emulator.url, 'admin', '', limiter=False)})
+    tails = logtail.FleetLogTail(cameras)
+    try:
+        assert [len(result.value) for result in tails.poll(timeout=1.0)] == [3]
+        emulator.log.append(line(10, 'login'))
+        emulator.latency = 0.3
+        results = list(tails.poll(timeout=0.1))
+        assert results[0].error is not None
+        time.sleep(0.4) # Let the timed out download finish
+        emulator.latency = 0.0
+        results = list(tails.poll(timeout=1.0))
+        assert [entry.event for entry in results[0].value] == ['login']
+    finally:
+        cameras.close()
+
+def test_only_new_entries_returned():
+    camera = Camera(line(0), line(1))
+    tail = logtail.LogTail(camera)
+    assert [entry.raw for entry in tail.poll()] == [line(0), line(1)]
+    assert tail.poll() == []
+    camera.lines += [line(1, 'logout'), line(2)]
+    assert [entry.raw for entry in tail.poll()] == [line(1, 'logout'), line(2)]
+
+def test_no_history():
+    camera = Camera(line(0), line(1))
+    tail = logtail.LogTail(camera, history=False)
+    assert tail.poll() == []
+    camera.lines.append(line(2))
+    assert [entry.raw for entry in tail.poll()] == [line(2)]
+
+def test_cleared_log_keeps_entries_of_the_newest_second():
+    camera = Camera(line(0), line(5, 'login'))
+    tail = logtail.LogTail(camera)
+    tail.poll()
+    camera.lines = [line(5, 'motion'), line(6)] # Cleared, then a burst within the same second
+    assert [entry.raw for entry in tail.poll()] == [line(5, 'motion'), line(6)]
+
+def test_wrapped_log_skips_entries_already_seen():
+    camera = Camera(*[line(n) for n in range(5)] + [line(5, 'login')])
+    tail = logtail.LogTail(camera, anchor=2)
+    tail.poll()
+    camera.lines = [line(5, 'login'), line(5, 'motion'), line(7)] # The oldest entries and the anchor's first fell off
+    assert [entry.raw for entry in tail.poll()] == [line(5, 'motion'), line(7)]
+
+def test_state_restores_the_tail():
+    camera = Camera(line(0), line(1))
+    tail = logtail.LogTail(camera)
+    tail.poll()
+    camera.lines.append(line(2, 'r\xe9boot'))
+    restored = logtail.LogTail(camera, state=tail.state)
+    assert [entry.raw for entry in restored.poll()] == [line(2, 'r\xe9boot')]
+    camera.lines = [line(2, 'r\xe9boot'), line(3)] # Wrapped after a restart
+    assert [entry.raw for entry in logtail.LogTail(camera, state=restored.state).poll()] == [line(3)]
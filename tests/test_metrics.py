@@ -0,0 +1,32 @@
+import metrics
+
+def test_render_escapes_labels_and_help():
+    registry = metrics.Registry()
+    requests = registry.counter('foscam_requests_total', 'Requests sent\nby "cgi"', ('camera', 'cgi'))
+    requests.labels('back\\door "west"\nside', 'get_status.cgi').inc(3)
+    assert registry.render() == (
+        '# HELP foscam_requests_total Requests sent\\nby "cgi"\n'
+        '# TYPE foscam_requests_total counter\n'
+        'foscam_requests_total{camera="back\\\\door \\"west\\"\\nside",cgi="get_status.cgi"} 3\n')
+
+def test_render_histogram():
+    registry = metrics.Registry()
+    latency = registry.histogram('foscam_request_seconds', 'Request latency', ('camera',), buckets=(1.0, 0.125))
+    for value in (0.0625, 0.125, 0.5, 4.0): latency.labels('cam').observe(value)
+    assert registry.render().splitlines()[2:] == [
+        'foscam_request_seconds_bucket{camera="cam",le="0.125"} 2', # Bounds are inclusive
+        'foscam_request_seconds_bucket{camera="cam",le="1"} 3',
+        'foscam_request_seconds_bucket{camera="cam",le="+Inf"} 4',
+        'foscam_request_seconds_sum{camera="cam"} 4.6875',
+        'foscam_request_seconds_count{camera="cam"} 4']
+    assert latency.labels('cam').percentile(0.5) == 0.125
+    assert latency.labels('cam').percentile(0.9) == float('inf')
+
+def test_render_unlabelled_metrics_in_name_order():
+    registry = metrics.Registry()
+    registry.histogram('b_seconds', 'B', buckets=(1.0,)).observe(2.0)
+    registry.gauge('a_depth', 'A').set(1.5)
+    assert registry.render() == (
+        '# HELP a_depth A\n# TYPE a_depth gauge\na_depth 1.5\n'
+        '# HELP b_seconds B\n# TYPE b_seconds histogram\n'
+        'b_seconds_bucket{le="1"} 0\nb_seconds_bucket{le="+Inf"} 1\nb_seconds_sum 2\nb_seconds_count 1\n')
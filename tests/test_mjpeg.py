@@ -0,0 +1,103 @@
+import io
+import time
+import pytest
+import mjpeg
+
+BOUNDARY = b'--ipcamera'
+
+def jpeg(n, size=200):
+    "A fake JPEG, with 0xff bytes in the body which aren't markers"
+    return mjpeg.SOI + (b'frame%d\xff\x00' % n).ljust(size, b'\x01') + mjpeg.EOI
+
+def part(image, length=True):
+    "A multipart part, length is True for the right Content-Length, False for none or the number to give"
+    header = BOUNDARY + b'\r\nContent-Type: image/jpeg\r\n'
+    if length is not False:
+        header += b'Content-Length: %d\r\n' % (len(image) if length is True else length)
+    return header + b'\r\n' + image + b'\r\n'
+
+class Chunked(object):
+    "A stream without readinto which returns data in the given sized pieces"
+    def __init__(self, data, sizes):
+        self.data = data
+        self.sizes = sizes
+        self.closed = False
+
+    def read(self, n):
+        size = min(n, self.sizes[0] if self.sizes else n)
+        if self.sizes: self.sizes = self.sizes[1:]
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+    def close(self):
+        self.closed = True
+
+def parse(stream, chunk=65536, bufsize=1<<20):
+    return [bytes(frame.data) for frame in mjpeg.frames(stream, chunk, bufsize)]
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline: time.sleep(0.01)
+    return condition()
+
+@pytest.mark.parametrize('length', [True, False])
+def test_frames_split_across_reads(length):
+    images = [jpeg(n) for n in range(5)]
+    data = b''.join(part(image, length) for image in images)
+    assert parse(io.BytesIO(data), chunk=1) == images
+    assert parse(Chunked(data, [1, 3, 2, len(BOUNDARY) + 1, 100, 7, 250, 5])) == images
+
+def test_split_markers():
+    "The SOI and EOI markers themselves arrive in separate reads"
+    images = [jpeg(n) for n in range(3)]
+    data = b''.join(part(image, False) for image in images)
+    sizes = []
+    for image in images:
+        header = len(part(image, False)) - len(image) - 2
+        sizes += [header + 1, len(image) - 2, 1, 1 + 2]
+    assert parse(Chunked(data, sizes)) == images
+
+def test_frames_larger_than_the_buffer():
+    images = [jpeg(n, size=5000) for n in range(3)]
+    assert parse(io.BytesIO(b''.join(part(image) for image in images)), chunk=700, bufsize=1024) == images
+
+@pytest.mark.parametrize('error', [-20, -1, 1, 30])
+def test_wrong_content_length(error):
+    images = [jpeg(n) for n in range(4)]
+    data = b''.join(part(image, len(image) + error if n == 1 else True) for n, image in enumerate(images))
+    assert parse(io.BytesIO(data), chunk=64) == images
+
+def test_raw_concatenated_jpegs():
+    images = [jpeg(n) for n in range(3)]
+    assert parse(Chunked(b''.join(images), [10] * 100)) == images
+
+def test_reader_drops_oldest_frames():
+    images = [jpeg(n) for n in range(10)]
+    stream = io.BytesIO(b''.join(part(image) for image in images))
+    reader = mjpeg.FrameReader(stream, maxframes=3, policy='drop')
+    reader.thread.join(5.0)
+    assert stream.closed
+    assert [frame.data for frame in reader] == images[-3:]
+    assert reader.dropped == 7 and reader.error is None
+
+def test_reader_blocks_until_consumer_catches_up():
+    images = [jpeg(n) for n in range(10)]
+    stream = io.BytesIO(b''.join(part(image) for image in images))
+    reader = mjpeg.FrameReader(stream, maxframes=3, policy='block', chunk=100)
+    assert wait_for(lambda: len(reader.queue) == 3)
+    time.sleep(0.05)
+    assert reader.thread.is_alive() and not stream.closed and len(reader.queue) == 3
+    assert [frame.data for frame in reader] == images
+    assert reader.dropped == 0
+
+def test_reader_close_stops_blocked_reader():
+    stream = io.BytesIO(b''.join(part(jpeg(n)) for n in range(10)))
+    reader = mjpeg.FrameReader(stream, maxframes=1, policy='block', chunk=100)
+    assert wait_for(lambda: len(reader.queue) == 1)
+    reader.close()
+    reader.thread.join(5.0)
+    assert not reader.thread.is_alive() and stream.closed
+
+def test_reader_rejects_unknown_policy():
+    with pytest.raises(ValueError):
+        mjpeg.FrameReader(io.BytesIO(), policy='skip')
@@ -0,0 +1,85 @@
+import time
+import pytest
+motion = pytest.importorskip('motion')
+if motion.np is None: pytest.skip('numpy is not installed', allow_module_level=True)
+np = motion.np
+
+class Camera(object):
+    "A camera whose video streams end straight away"
+    name = 'camera'
+    preset = 1
+    presetTime = 0.0
+    defaultPreset = 1
+
+    def __init__(self):
+        self.streams = 0
+
+    def frames(self, resolution, rate):
+        self.streams += 1
+        return iter(())
+
+class Scheduler(object):
+    def __init__(self, camera):
+        self.cam = camera
+
+def test_ended_stream_reopened_after_retry():
+    camera = Camera()
+    stage = motion.MotionStage(Scheduler(camera), lambda *args: None, retry=0.2)
+    stage.watch_stream()
+    time.sleep(0.5)
+    began = time.time()
+    stage.stop()
+    assert time.time() - began < 0.1 # Stopping doesn't wait out the retry
+    assert 2 <= camera.streams <= 4
+
+SHAPE = (120, 160)
+
+def scene(rng, level=80, block=None, size=20):
+    "A noisy static frame with an optional bright block at block=(left, top) pixels"
+    frame = np.clip(level + rng.integers(-5, 6, SHAPE), 0, 255).astype(np.uint8)
+    if block is not None:
+        left, top = block
+        frame[top:top + size, left:left + size] = 250
+    return frame
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+def warm(detector, rng, frames=5):
+    return [detector.feed(scene(rng)) for n in range(frames)]
+
+def test_no_motion_during_warmup(rng):
+    detector = motion.MotionDetector(warmup=5)
+    assert [detector.feed(scene(rng, block=(10 * n, 10))) for n in range(5)] == [{}] * 5
+    assert 'all' in detector.feed(scene(rng, block=(100, 80))) # Reported from the first frame after warmup
+
+def test_moving_block_detected_in_its_region(rng):
+    right = np.zeros(SHAPE, bool)
+    right[:, 80:] = True
+    detector = motion.MotionDetector(regions={'left': (0.0, 0.0, 0.5, 1.0), 'right': right, 'top': (0.0, 0.0, 1.0, 0.5)})
+    assert warm(detector, rng) == [{}] * 5
+    for x in range(90, 140, 10):
+        found = detector.feed(scene(rng, block=(x, 80)))
+        assert sorted(found) == ['right'] # Low in the right half
+        assert 0.0 < found['right'] < 0.1
+    found = detector.feed(scene(rng, block=(20, 10)))
+    assert 'left' in found and 'top' in found
+
+def test_mask_ignores_pixels(rng):
+    mask = np.ones(SHAPE, bool)
+    mask[:, 80:] = False # A tree waving in the right half
+    detector = motion.MotionDetector(mask=mask)
+    warm(detector, rng)
+    assert [detector.feed(scene(rng, block=(x, 50))) for x in range(90, 140, 10)] == [{}] * 5
+    assert 'all' in detector.feed(scene(rng, block=(20, 50)))
+
+def test_lighting_change_suppressed_once_steady(rng):
+    detector = motion.MotionDetector()
+    warm(detector, rng)
+    detector.feed(scene(rng, level=160)) # The lights come on, indistinguishable from motion in one frame
+    for n in range(5):
+        assert detector.feed(scene(rng, level=160)) == {}
+    assert abs(float(detector.background.mean()) - 160) > detector.threshold # Not because the background caught up
+    assert 'all' in detector.feed(scene(rng, level=160, block=(60, 50))) # Motion under the new light is still seen
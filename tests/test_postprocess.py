@@ -0,0 +1,29 @@
+import io
+import time
+import pytest
+postprocess = pytest.importorskip('postprocess')
+if postprocess.Image is None: pytest.skip('Pillow is not installed', allow_module_level=True)
+
+def jpeg():
+    out = io.BytesIO()
+    postprocess.Image.new('RGB', (640, 480), (10, 20, 30)).save(out, 'JPEG')
+    return out.getvalue()
+
+def test_full_pool_drops_rather_than_blocks():
+    outputs = {'thumb': [postprocess.Resize(160, 120)]}
+    with postprocess.PostProcessor(1, max_pending=1) as processor:
+        first = processor.submit(jpeg(), outputs)
+        second = processor.submit(jpeg(), outputs)
+        with pytest.raises(postprocess.Dropped):
+            second.result(0)
+        assert processor.dropped == 1
+        assert postprocess.Image.open(io.BytesIO(first.result(30)['thumb'])).size == (160, 120)
+        time.sleep(0.1) # The first's slot is released just after its result is set
+        assert 'thumb' in processor.submit(jpeg(), outputs).result(30) # Room again once the first is done
+
+def test_block_policy_waits_for_room():
+    outputs = {'small': [postprocess.Recompress(40)]}
+    with postprocess.PostProcessor(1, max_pending=1, policy='block') as processor:
+        futures = [processor.submit(jpeg(), outputs) for n in range(3)]
+        assert all('small' in future.result(30) for future in futures)
+        assert processor.dropped == 0
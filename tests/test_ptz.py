@@ -0,0 +1,61 @@
+import ptz
+
+class Camera(object):
+    "Records the commands sent, counting moves the way FoscamControl does"
+
+    def __init__(self):
+        self.sent = []
+        self.moves = 0
+
+    def control(self, command, onestep=None, degree=None):
+        self.moves += 1
+        self.sent.append(command)
+
+    def goto_preset(self, preset):
+        self.moves += 1
+        self.sent.append(preset)
+
+def channel():
+    camera = Camera()
+    return camera, ptz.PTZChannel(camera)
+
+def test_stop_matches_the_movement():
+    camera, c = channel()
+    c.control('LEFT')
+    c.flush()
+    c.stop()
+    c.flush()
+    assert camera.sent == ['LEFT', 'STOP_LEFT']
+    c.close()
+
+def test_diagonal_stopped_on_both_axes():
+    camera, c = channel()
+    c.control('DOWN_RIGHT')
+    c.flush()
+    c.stop()
+    c.flush()
+    assert camera.sent == ['DOWN_RIGHT', 'STOP_DOWN', 'STOP_RIGHT']
+    c.close()
+
+def test_unknown_movement_stops_everything_once():
+    camera, c = channel()
+    c.stop()
+    c.flush()
+    assert camera.sent == list(ptz.STOP_ALL)
+    c.stop()
+    c.flush()
+    assert camera.sent == list(ptz.STOP_ALL) # Already stopped
+    c.close()
+
+def test_repeat_sent_after_camera_moved_directly():
+    camera, c = channel()
+    c.control('LEFT')
+    c.flush()
+    c.control('LEFT')
+    c.flush()
+    assert camera.sent == ['LEFT']
+    camera.control('RIGHT') # Not through the channel
+    c.control('LEFT')
+    c.flush()
+    assert camera.sent == ['LEFT', 'RIGHT', 'LEFT']
+    c.close()
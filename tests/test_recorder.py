@@ -0,0 +1,107 @@
+import time
+import threading
+import pytest
+import control
+import recorder
+from emulator import FoscamEmulator
+
+@pytest.fixture
+def emulator():
+    e = FoscamEmulator(stream_frames=60, frame_rate=100.0).start()
+    yield e
+    e.stop()
+
+class Tap(object):
+    "Passes a camera's video frames on, keeping a copy of each"
+
+    def __init__(self, foscam):
+        self.cam = foscam
+        self.sent = []
+        self.ended = threading.Event()
+
+    def frames(self, resolution, rate):
+        try:
+            for timestamp, data in self.cam.frames(resolution, rate):
+                self.sent.append((timestamp, bytes(data)))
+                yield timestamp, data
+        finally:
+            self.ended.set()
+
+def record(emulator, root):
+    cam = control.FoscamControl(emulator.url, 'admin', '', limiter=False)
+    tap = Tap(cam)
+    store = recorder.Recorder(str(root), segment_seconds=0.2, retry=60.0) # Don't reopen the stream once it ends
+    store.record('cam', tap)
+    assert tap.ended.wait(10.0)
+    store.close()
+    return store, tap.sent
+
+def test_recorded_frames_read_back(emulator, tmp_path):
+    store, sent = record(emulator, tmp_path)
+    assert len(sent) == 60
+    segments = store.segments('cam')
+    assert len(segments) > 1 # Rotated every 0.2 s of a 0.6 s stream
+    read = []
+    for base in segments:
+        with recorder.Segment(base) as segment:
+            read += [(timestamp, bytes(data)) for timestamp, data in segment]
+    assert read == sent
+
+def test_frame_at_finds_each_frame(emulator, tmp_path):
+    store, sent = record(emulator, tmp_path)
+    assert store.open_segment('cam', sent[0][0] - 1.0) is None
+    for timestamp, data in sent:
+        segment = store.open_segment('cam', timestamp)
+        try:
+            found, frame = segment.frame_at(timestamp)
+            assert (found, bytes(frame)) == (timestamp, data)
+            del frame
+        finally:
+            segment.close()
+
+class Source(object):
+    "Generates numbered frames every interval, holding them back while paused is set"
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.paused = threading.Event()
+
+    def frames(self, resolution, rate):
+        n = 0
+        while True:
+            while self.paused.is_set(): time.sleep(0.01)
+            yield time.time(), b'\xff\xd8frame%d\xff\xd9' % n
+            n += 1
+            time.sleep(self.interval)
+
+def test_open_segment_sees_frames_recorded_so_far(tmp_path):
+    store = recorder.Recorder(str(tmp_path), segment_seconds=60.0, flush_interval=60.0)
+    recording = store.record('cam', Source())
+    try:
+        for n in range(5):
+            time.sleep(0.05)
+            written = recording.written
+            with store.open_segment('cam', time.time()) as segment:
+                assert len(segment) >= written > 0
+                assert bytes(segment.frame(written - 1)[1]) == b'\xff\xd8frame%d\xff\xd9' % (written - 1)
+    finally:
+        store.close()
+
+def test_open_segment_of_stalled_stream_times_out(tmp_path):
+    source = Source()
+    store = recorder.Recorder(str(tmp_path), segment_seconds=60.0, flush_interval=60.0)
+    recording = store.record('cam', source)
+    try:
+        time.sleep(0.05)
+        source.paused.set()
+        time.sleep(0.05)
+        start = time.time()
+        with store.open_segment('cam', time.time(), timeout=0.1) as segment:
+            assert 0.1 <= time.time() - start < 1.0
+            assert len(segment) < recording.written
+        source.paused.clear()
+        with store.open_segment('cam', time.time()) as segment:
+            assert len(segment) >= recording.written - 1
+    finally:
+        source.paused.clear()
+        store.close()
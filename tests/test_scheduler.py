@@ -0,0 +1,120 @@
+import time
+import threading
+import scheduler
+
+class Task(object):
+    def __init__(self, name, ran, duration=0.0, expire=None):
+        self.name = name
+        self.ran = ran
+        self.duration = duration
+        self.expire = expire
+        self.start = None
+        self.hold = False
+
+    def run(self):
+        self.ran.append(self.name)
+        time.sleep(self.duration)
+        return False
+
+class Holding(Task):
+    "Runs once and asks to be run again later, holding the scheduler meanwhile"
+
+    def run(self):
+        self.ran.append(self.name)
+        if len([n for n in self.ran if n == self.name]) > 1: return False
+        self.start = time.time() + 0.1
+        self.hold = True
+        return True
+
+def test_expired_holder_releases_hold():
+    ran = []
+    done = threading.Event()
+    s = scheduler.Scheduler()
+    s.queueDone = done.set
+    s.append(5, Holding('held', ran, expire=time.time() + 0.3))
+    time.sleep(0.05) # Held, waiting for its start
+    s.append(10, Task('slow', ran, duration=0.5)) # Runs past the held task's expiry
+    s.append(1, Task('low', ran))
+    assert done.wait(5.0)
+    assert ran == ['held', 'slow', 'low']
+    assert len(s.queue) == 0
+
+def test_expired_holder_releases_hold_on_engine():
+    ran = []
+    done = threading.Event()
+    engine = scheduler.Engine(2)
+    try:
+        s = scheduler.Scheduler(engine=engine)
+        s.queueDone = done.set
+        s.append(5, Holding('held', ran, expire=time.time() + 0.3))
+        time.sleep(0.05)
+        s.append(10, Task('slow', ran, duration=0.5))
+        s.append(1, Task('low', ran))
+        assert done.wait(5.0)
+        assert ran == ['held', 'slow', 'low']
+    finally:
+        engine.close()
+
+def pop_all(q):
+    popped = []
+    while True:
+        try:
+            popped.append(q.pop())
+        except IndexError:
+            return popped
+
+def test_queue_pops_equal_priorities_in_order():
+    q = scheduler.PriorityQueue()
+    for n, priority in enumerate([1, 5, 1, 5, 1, 3]):
+        q.append(priority, 'p%d-%d' % (priority, n))
+    assert pop_all(q) == [(5, 'p5-1'), (5, 'p5-3'), (3, 'p3-5'), (1, 'p1-0'), (1, 'p1-2'), (1, 'p1-4')]
+    assert q.empty
+
+def test_queue_first_goes_ahead_of_equal_priorities_only():
+    q = scheduler.PriorityQueue()
+    q.append(1, 'a')
+    q.append(1, 'b')
+    q.append(2, 'high')
+    q.append(1, 'c', first=True)
+    q.append(1, 'd', first=True)
+    assert pop_all(q) == [(2, 'high'), (1, 'd'), (1, 'c'), (1, 'a'), (1, 'b')]
+
+def test_queue_cancel_then_pop():
+    q = scheduler.PriorityQueue()
+    a, b, c = [q.append(1, name) for name in 'abc']
+    assert q.cancel(b)
+    assert not q.cancel(b)
+    assert len(q) == 2
+    assert q.pop() == (1, 'a')
+    assert not q.cancel(a) # Already popped
+    assert pop_all(q) == [(1, 'c')]
+    assert len(q) == 0
+
+def test_queue_cancel_compacts_and_keeps_order():
+    q = scheduler.PriorityQueue()
+    handles = [q.append(n % 3, n) for n in range(200)]
+    for handle in handles[:150]: q.cancel(handle)
+    assert len(q) == 50 and len(q.q) < 200
+    assert [obj for priority, obj in pop_all(q)] == sorted(range(150, 200), key=lambda n: (-(n % 3), n))
+
+def test_queue_reprioritize_keeps_arrival_order():
+    q = scheduler.PriorityQueue()
+    a = q.append(1, 'a')
+    q.append(5, 'b')
+    q.append(5, 'c')
+    a = q.reprioritize(a, 5)
+    assert a is not None
+    assert pop_all(q) == [(5, 'a'), (5, 'b'), (5, 'c')]
+    assert q.reprioritize(a, 9) is None
+
+def test_queue_reprioritize_waiting_entry():
+    q = scheduler.PriorityQueue()
+    later = q.append(1, 'later', start=time.time() + 0.2)
+    q.append(5, 'now')
+    later = q.reprioritize(later, 10)
+    assert len(q) == 2
+    assert pop_all(q) == [(5, 'now')] # Still waits for its start time
+    assert q.next_start() is not None
+    time.sleep(0.25)
+    assert pop_all(q) == [(10, 'later')]
+    assert q.next_start() is None and q.empty
@@ -0,0 +1,87 @@
+import time
+import threading
+import snapcache
+
+class Fetcher(object):
+    "Counts fetches, which return a new image each time and can be held until released"
+    def __init__(self, size=10, hold=False):
+        self.size = size
+        self.calls = 0
+        self.release = threading.Event()
+        if not hold: self.release.set()
+
+    def __call__(self):
+        self.calls += 1
+        self.release.wait(5.0)
+        return (b'%d' % self.calls).ljust(self.size, b'.')
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline: time.sleep(0.01)
+    return condition()
+
+def test_expired_snapshots_are_fetched_again():
+    cache = snapcache.SnapshotCache(maxAge=0.1)
+    fetch = Fetcher()
+    first = cache.get('a', fetch)
+    assert cache.get('a', fetch) is first
+    assert cache.get('a', fetch, maxAge=0.0) is not first # Per call maximum age
+    time.sleep(0.15)
+    assert cache.get('a', fetch) is not first
+    assert fetch.calls == 3
+    assert (cache.hits, cache.misses) == (1, 3)
+
+def test_least_recently_used_evicted_by_bytes():
+    cache = snapcache.SnapshotCache(maxAge=60.0, maxBytes=30)
+    fetch = Fetcher(size=10)
+    for key in 'abc': cache.get(key, fetch)
+    cache.get('a', fetch) # Now b is the least recently used
+    cache.get('d', fetch)
+    assert list(cache.entries) == ['c', 'a', 'd'] and cache.bytes == 30
+    cache.get('e', Fetcher(size=25))
+    assert list(cache.entries) == ['e'] and cache.bytes == 25
+    cache.get('f', Fetcher(size=31)) # Too big to keep at all
+    assert list(cache.entries) == ['e'] and cache.bytes == 25
+    cache.invalidate(lambda key: key == 'e')
+    assert len(cache) == 0 and cache.bytes == 0
+
+def test_concurrent_fetches_are_coalesced():
+    cache = snapcache.SnapshotCache(maxAge=60.0)
+    fetch = Fetcher(hold=True)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('a', fetch))) for n in range(5)]
+    threads[0].start()
+    assert wait_for(lambda: fetch.calls == 1)
+    for thread in threads[1:]: thread.start()
+    assert wait_for(lambda: cache.coalesced == 4)
+    fetch.release.set()
+    for thread in threads: thread.join(5.0)
+    assert fetch.calls == 1 and len(results) == 5
+    assert all(result is results[0] for result in results)
+    assert cache.get('a', fetch) is results[0]
+
+def test_failed_fetch_raised_to_waiters_and_not_cached():
+    cache = snapcache.SnapshotCache(maxAge=60.0)
+    started = threading.Event()
+    release = threading.Event()
+    def fail():
+        started.set()
+        release.wait(5.0)
+        raise ValueError('bad response')
+    errors = []
+    def get():
+        try:
+            cache.get('a', fail)
+        except ValueError as e:
+            errors.append(e)
+    leader = threading.Thread(target=get)
+    leader.start()
+    assert started.wait(5.0)
+    follower = threading.Thread(target=get)
+    follower.start()
+    assert wait_for(lambda: cache.coalesced == 1)
+    release.set()
+    leader.join(5.0)
+    follower.join(5.0)
+    assert len(errors) == 2 and len(cache) == 0 and not cache.inflight
+    assert cache.get('a', Fetcher()) == b'1'.ljust(10, b'.')
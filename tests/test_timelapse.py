@@ -0,0 +1,54 @@
+import time
+import pytest
+import camscheduler
+import control
+import timelapse
+from emulator import FoscamEmulator
+
+PERIOD = 0.2
+PRESETS = (1, 2)
+
+@pytest.fixture
+def camera(monkeypatch):
+    monkeypatch.setattr(camscheduler, 'SEEK_TIME', 0.04) # Time scaled down with the emulator's seeks
+    e = FoscamEmulator(seek_time=0.03).start()
+    e.presets.add(2)
+    yield control.FoscamControl(e.url, 'admin', '', limiter=False)
+    e.stop()
+
+def test_frames_taken_on_the_tick_grid(camera, tmp_path):
+    s = camscheduler.FoscamScheduler(camera)
+    start = time.time() + 0.1
+    ticks = 12
+    lapse = timelapse.TimeLapse(s, str(tmp_path), PRESETS, PERIOD, start=start, end=start + (ticks - 0.5) * PERIOD)
+    assert lapse.wait(10.0)
+    lapse.close()
+    stats = lapse.stats
+    assert stats['frames'] + stats['missed'] == ticks * len(PRESETS)
+    assert stats['missed'] <= 1 # A loaded machine may miss the odd frame, not a series
+    for index, preset in enumerate(PRESETS):
+        with lapse.open_segment(preset, time.time()) as segment:
+            for taken, frame in segment:
+                tick = round((taken - start - index * lapse.spacing) / PERIOD)
+                error = taken - lapse.due(tick, index)
+                assert -0.005 <= error <= lapse.tolerance
+            frame = None # Release the view before the segment is closed
+    assert stats['max_ms'] <= lapse.tolerance * 1000.0
+
+def test_resumes_on_the_same_grid(camera, tmp_path):
+    s = camscheduler.FoscamScheduler(camera)
+    start = time.time() + 0.1
+    lapse = timelapse.TimeLapse(s, str(tmp_path), PRESETS, PERIOD, start=start)
+    time.sleep(0.5)
+    lapse.close()
+    frames = lapse.stats['frames']
+    assert frames > 0
+    time.sleep(0.3)
+    lapse = timelapse.TimeLapse(s, str(tmp_path), PRESETS, 1.0, start=time.time())
+    try:
+        assert (lapse.start, lapse.period) == (start, PERIOD)
+        assert lapse.tick * PERIOD + start >= time.time() - PERIOD # Carries on from the next tick, not the missed ones
+        time.sleep(0.5)
+        assert lapse.stats['frames'] > frames
+    finally:
+        lapse.close()
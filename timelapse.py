@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Time lapse capture through a FoscamScheduler.
+Captures are due at absolute ticks, start + n * period, rather than a period after the previous capture, so a long
+series never drifts however long each capture takes. Each tick can cover several presets, spread over the period. The
+frames of each preset are written as they arrive to recorder segments, the indexed container continuous recordings use,
+under a sub directory per preset. The progress is saved in a JSON file next to them so a time lapse which is stopped
+or crashes carries on from the next tick when started again, on the same tick grid. The timing error of every frame is
+kept for jitter statistics.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import os
+import json
+import math
+import time
+import threading
+from collections import deque
+import metrics
+import recorder
+
+STATE_FILE = 'timelapse.json'
+
+TIMING_ERROR = metrics.REGISTRY.histogram('foscam_timelapse_error_seconds', 'Time from when time lapse frames were due until they were taken', ('camera',),
+                                          buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+MISSED_FRAMES = metrics.REGISTRY.counter('foscam_timelapse_missed_total', 'Time lapse frames not taken in time', ('camera',))
+
+def preset_name(preset):
+    "Name of the sub directory of a preset's frames"
+    return 'preset%s' % preset
+
+class TimeLapse(object):
+    """
+    Takes a time lapse of one or more presets of a camera with its FoscamScheduler.
+    A thread posts each tick's snapshots to the scheduler a period ahead with snapshot_at, which moves the camera from
+    the previous preset in time to take each one when it is due. Preset i of a tick is due at the tick plus i times spacing. A frame which
+    can't be taken within tolerance of when it was due is missed, the series carries on with the next tick.
+    """
+
+    def __init__(self, scheduler, root, presets, period, start=None, end=None, priority=0, spacing=None, tolerance=None,
+                 segment_seconds=3600.0, history=10000):
+        """Start the time lapse, or resume the one saved in root
+        @param scheduler camscheduler.FoscamScheduler of the camera
+        @param root Directory to write the frames and state to
+        @param presets Presets to capture at each tick
+        @param period Seconds between ticks
+        @param start Time of the first tick, None for now. A time lapse resumed from root keeps its start and period.
+        @param end Time after which no more ticks are captured, None to carry on until closed
+        @param priority Priority of the snapshot requests
+        @param spacing Seconds between the presets of a tick, None to spread them evenly over the period. Must leave
+               time for the camera to move between presets.
+        @param tolerance Seconds late a frame may still be taken, None for half the spacing or period
+        @param segment_seconds Seconds of frames in each segment file
+        @param history Number of most recent timing errors to keep for the percentiles
+        """
+        self.scheduler = scheduler
+        self.cam = scheduler.cam
+        self.root = root
+        self.presets = list(presets)
+        self.priority = priority
+        self.end = end
+        self.segment_seconds = segment_seconds
+        self.path = os.path.join(root, STATE_FILE)
+        self.store = recorder.Recorder(root, segment_seconds) # Only used to read the segments back
+        self.start = time.time() if start is None else start
+        self.period = period
+        self.frames = 0
+        self.missed = 0
+        self.captured = {} # preset: last tick captured
+        if os.path.isfile(self.path):
+            with open(self.path) as fh:
+                state = json.load(fh)
+            self.start = state['start']
+            self.period = state['period']
+            self.frames = state['frames']
+            self.missed = state['missed']
+            self.captured = dict((int(p) if p.isdigit() else p, t) for p, t in state['captured'].items())
+        self.spacing = self.period / len(self.presets) if spacing is None else spacing
+        self.tolerance = (self.spacing if len(self.presets) > 1 else self.period) / 2.0 if tolerance is None else tolerance
+        first = max(0, int(math.ceil((time.time() - self.start) / self.period))) # The next tick still to come
+        resumed = max(self.captured.values()) + 1 if self.captured else 0
+        if first > resumed and self.captured: self.missed += (first - resumed) * len(self.presets)
+        self.tick = max(first, resumed) # Next tick to post
+        self.errors = deque(maxlen=history) # Recent timing errors
+        self.timed = 0 # Frames taken since started or resumed
+        self.errorSum = 0.0
+        self.errorMax = 0.0
+        self.writers = {} # preset: recorder.SegmentWriter
+        self.outstanding = {} # (tick, preset): SnapshotAction
+        self.lock = threading.Lock()
+        self.timing = TIMING_ERROR.labels(getattr(self.cam, 'name', 'camera'))
+        self.missedFrames = MISSED_FRAMES.labels(getattr(self.cam, 'name', 'camera'))
+        self.running = True
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='time lapse')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def due(self, tick, index=0):
+        "When preset number index of a tick is due"
+        return self.start + tick * self.period + index * self.spacing
+
+    def _run(self):
+        while not self.stop.is_set():
+            tick = self.tick
+            if self.end is not None and self.due(tick) > self.end: break
+            with self.lock:
+                self._expire(time.time())
+                for index, preset in enumerate(self.presets):
+                    when = self.due(tick, index)
+                    userdata = {'tick': tick, 'when': when}
+                    userdata['action'] = self.outstanding[(tick, preset)] = self.scheduler.snapshot_at(
+                        self.priority, preset, self._captured, when, when + self.tolerance, userdata, self.presets[index - 1])
+                self.tick = tick + 1
+            self.stop.wait(max(0.0, self.due(tick) - time.time())) # Post each tick a period ahead
+
+    def _expire(self, now):
+        "Count the outstanding frames which can no longer be taken as missed, called with the lock held"
+        for key, action in list(self.outstanding.items()):
+            if action.expire is not None and action.expire < now:
+                del self.outstanding[key]
+                self.missed += 1
+                self.missedFrames.inc()
+
+    def _captured(self, image, preset, final, userdata):
+        "Snapshot callback, runs on the scheduler's thread"
+        with self.lock:
+            if not self.running: return
+            tick = userdata['tick']
+            taken = userdata['action'].taken
+            error = taken - userdata['when']
+            self.outstanding.pop((tick, preset), None)
+            writer = self.writers.get(preset)
+            if writer is None or taken - writer.start >= self.segment_seconds:
+                if writer is not None: writer.close()
+                directory = self.store.directory(preset_name(preset))
+                if not os.path.isdir(directory): os.makedirs(directory)
+                writer = self.writers[preset] = recorder.SegmentWriter(os.path.join(directory, recorder.segment_name(taken)), taken, 1<<16)
+            writer.write(taken, image)
+            writer.sync() # Frames are far apart, make each one durable before it counts as captured
+            self.frames += 1
+            self.errors.append(error)
+            self.timed += 1
+            self.errorSum += error
+            self.errorMax = max(self.errorMax, abs(error))
+            self.timing.observe(error)
+            self.captured[preset] = max(tick, self.captured.get(preset, -1))
+            self._save()
+
+    def _save(self):
+        "Write the progress to the state file, called with the lock held"
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump({'start': self.start, 'period': self.period, 'presets': self.presets, 'frames': self.frames,
+                       'missed': self.missed, 'captured': dict((str(p), t) for p, t in self.captured.items())}, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.path)
+
+    @property
+    def done(self):
+        "True once every tick up to end has been captured or missed"
+        with self.lock:
+            self._expire(time.time())
+            return not self.thread.is_alive() and not self.outstanding
+
+    def wait(self, timeout=None):
+        """Wait until the time lapse is done, only returns early if it has no end
+        @return True if it is done"""
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.done:
+            if deadline is not None and time.time() >= deadline: return False
+            time.sleep(min(self.period, 0.1))
+        return True
+
+    def open_segment(self, preset, t):
+        """Open the segment of a preset's frames holding time t
+        @return A recorder.Segment, which the caller must close, or None if there are no frames from before t"""
+        return self.store.open_segment(preset_name(preset), t)
+
+    def segments(self, preset):
+        "Sorted base paths of a preset's segments"
+        return self.store.segments(preset_name(preset))
+
+    @property
+    def stats(self):
+        """Dictionary of frames taken and missed, including before a resume, and the mean, median, 99th percentile and
+        largest timing errors in ms since started or resumed"""
+        with self.lock:
+            errors = sorted(self.errors)
+            stats = {'frames': self.frames, 'missed': self.missed,
+                     'mean_ms': self.errorSum / self.timed * 1000.0 if self.timed else None,
+                     'max_ms': self.errorMax * 1000.0}
+        for name, fraction in (('p50_ms', 0.5), ('p99_ms', 0.99)):
+            stats[name] = errors[min(len(errors) - 1, int(fraction * len(errors)))] * 1000.0 if errors else None
+        return stats
+
+    def close(self):
+        "Stop posting ticks, cancel the snapshots still to come and close the segment files. The state file stays."
+        self.stop.set()
+        self.thread.join()
+        with self.lock:
+            self.running = False
+            for action in self.outstanding.values():
+                if action.queued is not None: self.scheduler.cancel(action.queued[1])
+            self.outstanding = {}
+            for writer in self.writers.values(): writer.close()
+            self.writers = {}